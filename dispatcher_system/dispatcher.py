@@ -2,11 +2,15 @@
 from pathlib import Path
 import os
 import sys
-import copy
 
 print(f"dispatcher environment: {os.environ['CONDA_DEFAULT_ENV']}")
 
-from face_rhythm import util
+## Import dispatcher_system modules. Copy the whole dispatcher_system directory (not just this file) to the server.
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import sweep
+import job_cache
+import submitter
+import rightsize
 
 path_self, path_script, dir_save, dir_videos, path_ROIs, name_job, name_slurm, name_env = sys.argv
 
@@ -192,14 +196,16 @@ params_template = {
 }
 
 
-## make params dicts with grid swept values
-params = copy.deepcopy(params_template)
-params = [params]
-# params = [container_helpers.deep_update_dict(params_template, ['db', 'save_path0'], str(Path(val).resolve() / (name_save+str(ii)))) for val in dir_save]
-# params = [helpers.deep_update_dict(param, ['db', 'save_path0'], val) for param, val in zip(params_template, dirs_save_all)]
-# params = container_helpers.flatten_list([[container_helpers.deep_update_dict(p, ['lr'], val) for val in [0.00001, 0.0001, 0.001]] for p in params])
-
-# params_unchanging, params_changing = container_helpers.find_differences_across_dictionaries(params)
+## define the parameter sweep. Each point of the sweep is one job. See sweep.py.
+sweep_jobs = sweep.single()  ## one job with params_template as is
+# sweep_jobs = sweep.product(
+#     sweep.grid('TCA.fit.params_method.rank', [5, 10, 20]),
+#     sweep.zip_(
+#         sweep.grid('PointTracker.params_optical_flow.mesh_rigidity', [0.001, 0.005, 0.01]),
+#         sweep.grid('PointTracker.params_optical_flow.relaxation', [0.0005, 0.001, 0.002]),
+#     ),
+# )
+# sweep_jobs = sweep.latin_hypercube({'VQT_Analyzer.params_VQT.Q_lowF': (1.0, 6.0), 'VQT_Analyzer.params_VQT.F_min': ('log', 0.5, 2.0)}, n=50, seed=0)
 
 
 ## notes that will be saved as a text file in the outer directory
@@ -207,121 +213,126 @@ notes = \
 """
 First attempt
 """
-with open(str(Path(dir_save) / 'notes.txt'), mode='a') as f:
-    f.write(notes)
 
 
+## skip jobs that already completed (or are still queued) in dir_save. See job_cache.py.
+## Jobs are keyed by the content of path_script, their params, and fingerprints of their inputs.
+cache = job_cache.JobCache(
+    dir_save=dir_save,
+    path_script=path_script,
+    name_job=name_job,
+    inputs=['paths_videos.directory_videos', 'ROIs.initialize.path_file'],  ## key paths in params to input files / directories
+    markers=job_cache.markers_from_steps(params_template['steps']),  ## outputs that exist only if a job finished
+    keys_ignore=[],  ## e.g. ['project.verbose']
+    method_fingerprint='stat',  ## 'stat', 'size', or 'content'
+    verbose=1,
+)
+plan = cache.plan(sweep.iter_params(params_template, sweep_jobs))
+jobs_submit = plan['submit']
 
-## copy script .py file to dir_save
-import shutil
-Path(dir_save).mkdir(parents=True, exist_ok=True)
-print(f'Copying {path_script} to {str(Path(dir_save) / Path(path_script).name)}')
-shutil.copyfile(path_script, str(Path(dir_save) / Path(path_script).name))
+if len(jobs_submit) > 0:
+    with open(str(Path(dir_save) / 'notes.txt'), mode='a') as f:
+        f.write(notes)
 
+    ## copy script .py file to dir_save
+    import shutil
+    Path(dir_save).mkdir(parents=True, exist_ok=True)
+    print(f'Copying {path_script} to {str(Path(dir_save) / Path(path_script).name)}')
+    shutil.copyfile(path_script, str(Path(dir_save) / Path(path_script).name))
 
 
-## save parameters to file
-parameters_batch = {
-    'params': params,
-    # 'params_unchanging': params_unchanging,
-    # 'params_changing': params_changing
-}
-import json
-with open(str(Path(dir_save) / 'parameters_batch.json'), 'w') as f:
-    json.dump(parameters_batch, f)
 
-# with open(str(Path(dir_save) / 'parameters_batch.json')) as f:
-#     test = json.load(f)
+## save parameters to files, one job at a time: parameters_batch.jsonl, parameters_batch_changing.jsonl, parameters_batch_unchanging.json
+sweep_written = sweep.write_sweep(dir_save=dir_save, params_template=params_template, sweep=sweep_jobs, name='parameters_batch', verbose=1)
+
+# params = sweep.read_params(str(Path(dir_save) / 'parameters_batch.jsonl'))
     
 ## change permissions of the data files
 # [os.system(f"chmod -R 777 {p}") for p in [dir_save, dir_videos, path_ROIs]]
 
-## run batch_run function
-paths_scripts = [path_script]
-params_list = params
-max_n_jobs=1
-name_save=name_job
-
-
-## define print log paths
-paths_log = [str(Path(dir_save) / f'{name_save}{jobNum}' / 'print_log_%j.log') for jobNum in range(len(params))]
-
-## define slurm SBATCH parameters
-# sbatch_config_list = \
-# [f"""#!/usr/bin/bash
-# #SBATCH --job-name={name_slurm}
-# #SBATCH --output={path}
-# #SBATCH --constraint=intel
-# #SBATCH --partition=medium
-# #SBATCH -c 16
-# #SBATCH -n 1
-# #SBATCH --mem=64GB
-# #SBATCH --time=0-23:59:00
-
-# unset XDG_RUNTIME_DIR
-
-# cd /n/data1/hms/neurobio/sabatini/rich/
-
-# date
-
-# echo "loading modules"
-# module load gcc/9.2.0
-
-# echo "activating environment"
-# source activate {name_env}
-
-# echo "starting job"
-# python "$@"
-# """ for path in paths_log]
-
-# # SBATCH --constraint=intel
-# # SBATCH --gres=gpu:1,vram:23G
-# # SBATCH --partition=gpu_requeue
-
-# # SBATCH --partition=gpu_quad
-# # SBATCH --gres=gpu:1,vram:31G
-
-# # SBATCH --constraint=intel
-# # SBATCH --partition=short
-
-
-
-
-
-
-sbatch_config_list = \
-[f"""#!/usr/bin/bash
-#SBATCH --account=kempner_bsabatini_lab  # The account name for the job.
-#SBATCH --job-name={name_slurm}          # Job name
-#SBATCH --output={path}                  # File to write: STDOUT (and STDERR if --error is not used)
-#SBATCH --partition=kempner_requeue      # Partition (job queue)
-#SBATCH --gres=gpu:1                     # Number of GPUs
-#SBATCH -c 16                            # Number of cores (-c) on one node
-#SBATCH -n 1                             # Number of nodes (-n)
-#SBATCH --mem=48GB                       # Memory pool for all cores (see also --mem-per-cpu)
-#SBATCH --time=0-8:00:00                 # Runtime in D-HH:MM:SS
-#SBATCH --requeue                        # Requeue the job if it is preempted
-
-echo "Unsetting XDG_RUNTIME_DIR"
-unset XDG_RUNTIME_DIR                    # This prevents an error with the conda environment
-
-echo "activating environment"
-source activate {name_env}
-
-echo "starting job with call: python $@"
-python "$@"
-""" for path in paths_log]
-
-#SBATCH --mail-type=FAIL                 # Type of email notification- BEGIN,END,FAIL,ALL
-#SBATCH --hold                           # Hold the job in the queue
-
-
-util.batch_run(
-    paths_scripts=paths_scripts,
-    params_list=params_list,
-    sbatch_config_list=sbatch_config_list,
-    max_n_jobs=max_n_jobs,
-    dir_save=str(dir_save),
-    name_save=name_save,
-    verbose=True,
+## submit jobs as slurm job arrays. See submitter.py.
+max_n_jobs=1  ## safety cap on the number of jobs submitted by one dispatch
+max_n_running=None  ## max number of array tasks running at once (--array=0-N%max_n_running). None for no limit.
+pack_size=1  ## number of jobs run in each allocation (array task). >1 packs short jobs together; set '--time' for the whole pack. See runner.py.
+n_workers=1  ## number of jobs of a pack run at once in an allocation. They share its cores, memory and GPU.
+assert len(jobs_submit) <= max_n_jobs, f"Too many jobs to submit: {len(jobs_submit)} > max_n_jobs={max_n_jobs}"
+
+
+## define slurm SBATCH parameters. --array and --output are set by the submitter; each job prints to {dir_job}/print_log_{array job id}_{index}.log.
+## Jobs can override these with a 'directives' dict (e.g. job['directives'] = {'--mem': '96GB'}); jobs with the same directives share one array.
+# sbatch_directives = {
+#     '--job-name': name_slurm,
+#     '--constraint': 'intel',
+#     '--partition': 'medium',  ## or gpu_requeue / gpu_quad with '--gres': 'gpu:1,vram:23G' / 'gpu:1,vram:31G', or short
+#     '-c': 16,
+#     '-n': 1,
+#     '--mem': '64GB',
+#     '--time': '0-23:59:00',
+# }
+# sbatch_setup = [
+#     'unset XDG_RUNTIME_DIR',
+#     'cd /n/data1/hms/neurobio/sabatini/rich/',
+#     'date',
+#     'echo "loading modules"',
+#     'module load gcc/9.2.0',
+#     'echo "activating environment"',
+#     f'source activate {name_env}',
+# ]
+
+sbatch_directives = {
+    '--account': 'kempner_bsabatini_lab',  ## The account name for the job.
+    '--job-name': name_slurm,  ## Job name
+    '--partition': 'kempner_requeue',  ## Partition (job queue)
+    '--gres': 'gpu:1',  ## Number of GPUs
+    '-c': 16,  ## Number of cores (-c) on one node
+    '-n': 1,  ## Number of nodes (-n)
+    '--mem': '48GB',  ## Memory pool for all cores (see also --mem-per-cpu)
+    '--time': '0-8:00:00',  ## Runtime in D-HH:MM:SS
+    '--requeue': True,  ## Requeue the job if it is preempted
+    # '--mail-type': 'FAIL',  ## Type of email notification- BEGIN,END,FAIL,ALL
+    # '--hold': True,  ## Hold the job in the queue
+}
+sbatch_setup = [
+    'echo "Unsetting XDG_RUNTIME_DIR"',
+    'unset XDG_RUNTIME_DIR  # This prevents an error with the conda environment',
+    'echo "activating environment"',
+    f'source activate {name_env}',
+]
+
+
+## right-size --mem, --time and -c of each job from the resources used by past jobs of this script. See rightsize.py.
+## The history of jobs is kept in ~/.dispatcher_history.sqlite. Requests are never above sbatch_directives.
+use_rightsize = True
+rightsize_name_prefix = ''  ## only use past jobs whose --job-name starts with this (e.g. the mouse name)
+history = rightsize.History(path_db=rightsize.PATH_DB_DEFAULT, verbose=1)
+if use_rightsize and (pack_size == 1) and (len(jobs_submit) > 0):  ## packed jobs share an allocation; size those by hand
+    history.import_sacct(script=Path(path_script).name, name_prefix=rightsize_name_prefix)  ## past jobs that were not registered
+    history.update()
+    rightsize.rightsize(
+        history=history,
+        jobs=jobs_submit,
+        script=Path(path_script).name,
+        directives=sbatch_directives,
+        name_prefix=rightsize_name_prefix,
+        margin=0.2,  ## safety margin over the estimated need
+        quantum_mem_gb=4,
+        quantum_time_s=1800,
+        allow_increase=False,
+        verbose=1,
+    )
+
+
+arrays = submitter.submit_jobs(
+    jobs=jobs_submit,
+    path_script=path_script,
+    dir_save=dir_save,
+    directives=sbatch_directives,
+    setup=sbatch_setup,
+    max_n_running=max_n_running,
+    pack_size=pack_size,
+    n_workers=n_workers,
+    name=name_slurm,
+    verbose=1,
 )
+cache.mark_submitted(jobs_submit)
+history.register(jobs_submit, name=name_slurm, script=Path(path_script).name, directives=sbatch_directives, pack_size=pack_size)
@@ -0,0 +1,361 @@
+"""
+JOB_CACHE
+RH 2024
+
+Content-addressed dedup of dispatched jobs. Pure/native Python 3.
+
+Each job is keyed by a hash of:\n
+    * The content of the script it runs.\n
+    * Its params, canonicalised (sorted keys, no whitespace).\n
+    * Fingerprints of its input files / directories (e.g. the video
+      directory and the ROIs file), found from the params.\n
+The key names the job's directory in dir_save, so the same job always lands
+in the same directory, regardless of its position in the sweep. Before
+submitting, each job is classified as:\n
+    * 'complete': Its output markers exist. Skipped.\n
+    * 'active': It is pending or running in squeue (or squeue failed and
+      its directory exists). Skipped.\n
+    * 'failed': Its directory exists but it is neither complete nor active.
+      Resubmitted.\n
+    * 'new': Never submitted. Submitted.\n
+The results are kept in a small JSON index in dir_save
+(job_cache_index.json), so that complete jobs are skipped without touching
+their directories on later runs.
+
+Demo:
+    cache = JobCache(
+        dir_save=dir_save,
+        path_script=path_script,
+        name_job='jobNum_',
+        inputs=['paths_videos.directory_videos', 'ROIs.initialize.path_file'],
+        markers=markers_from_steps(params_template['steps']),
+    )
+    plan = cache.plan(params_all)
+    for job in plan['submit']:
+        ...  ## submit job['params'] into job['dir_job']
+    cache.mark_submitted(plan['submit'])
+"""
+
+import getpass
+import hashlib
+import json
+import os
+import subprocess
+import time
+from pathlib import Path
+
+import submitter
+import sweep
+
+
+## Output file of each face-rhythm pipeline step: <project>/analysis_files/<module_name>.h5
+STEP_OUTPUTS = {
+    'load_videos': 'Dataset_videos.h5',
+    'ROIs': 'ROIs.h5',
+    'point_tracking': 'PointTracker.h5',
+    'VQT': 'VQT_Analyzer.h5',
+    'TCA': 'TCA.h5',
+}
+
+
+def markers_from_steps(steps):
+    """
+    Makes the output markers of a face-rhythm job: the output file of its
+    last step, searched for anywhere in the job directory.
+    """
+    return [f'**/analysis_files/{STEP_OUTPUTS[steps[-1]]}']
+
+
+def canonical_json(obj):
+    """
+    Serializes obj to a canonical JSON string: sorted keys, no whitespace.
+    Tuples are written as lists and unknown types with str, so equal params
+    always give equal strings.
+    """
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'), default=str)
+
+
+def hash_file(path, chunk_size=2**20):
+    """Returns the sha256 hex digest of the content of a file."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def fingerprint_path(path, method='stat'):
+    """
+    Makes a fingerprint of a file or directory (recursively).
+    RH 2024
+
+    Args:
+        path (str):
+            Path to a file or directory.
+        method (str):
+            How files are fingerprinted. Either \n
+            * 'stat': Relative path, size and modification time. Fast; this
+              is what rsync uses to decide if a file changed. \n
+            * 'size': Relative path and size. Survives copies that do not
+              keep modification times. \n
+            * 'content': Relative path and sha256 of the content. Slow for
+              large files (e.g. videos). \n
+
+    Returns:
+        (str):
+            sha256 hex digest. 'missing' if the path does not exist.
+    """
+    assert method in ['stat', 'size', 'content'], f"method must be 'stat', 'size' or 'content', not {method}"
+    path = Path(path)
+    if not path.exists():
+        return 'missing'
+    if path.is_file():
+        paths_files = [(path.name, path)]
+    else:
+        paths_files = sorted(
+            (str(Path(root, name).relative_to(path)), Path(root, name))
+            for root, dirs, files in os.walk(path) for name in files
+        )
+    h = hashlib.sha256()
+    for name, p in paths_files:
+        if method == 'content':
+            token = hash_file(p)
+        else:
+            st = p.stat()
+            token = f'{st.st_size}' if method == 'size' else f'{st.st_size},{st.st_mtime_ns}'
+        h.update(f'{name}\0{token}\n'.encode())
+    return h.hexdigest()
+
+
+def squeue_active_dirs(user=None):
+    """
+    Finds the job directories of the user's jobs that are pending or running.
+    Makes one squeue call. The command of a job is its sbatch script:\n
+        * Arrays from submitter.submit_jobs: {dir_array}/sbatch_array.sh. The
+          directories of each task are read from {dir_array}/jobs.txt.\n
+        * Jobs from util.batch_run: {dir_job}/sbatch_config.sh. The directory
+          is the parent of the command.\n
+
+    Returns:
+        (set or None):
+            Resolved job directories. None if squeue failed (e.g. not on the
+            cluster).
+    """
+    user = getpass.getuser() if user is None else user
+    try:
+        out = subprocess.run(
+            ['squeue', '-u', user, '--noheader', '--format=%o|%K'],
+            capture_output=True, text=True, timeout=60, check=True,
+        ).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    dirs = set()
+    jobs_arrays = {}  ## {path_jobs: [dir_job, ...]}. Read each jobs.txt once.
+    for line in out.splitlines():
+        command, _, idx_array = line.strip().rpartition('|')
+        if not command:
+            continue
+        path_jobs = Path(command).parent / 'jobs.txt'
+        idx = submitter.parse_array_range(idx_array)
+        if len(idx) == 0 or not path_jobs.exists():
+            dirs.add(str(Path(command).parent))
+            continue
+        if path_jobs not in jobs_arrays:
+            with open(path_jobs, 'r') as f:
+                jobs_arrays[path_jobs] = f.read().splitlines()
+        for i in idx:
+            if i < len(jobs_arrays[path_jobs]):
+                dirs.update(jobs_arrays[path_jobs][i].split('\t'))  ## Packed jobs share a line
+    return dirs
+
+
+class JobCache:
+    """
+    Content-addressed index of the jobs dispatched into dir_save.
+    RH 2024
+
+    Args:
+        dir_save (str):
+            Outer directory of the jobs.
+        path_script (str):
+            Path to the script run by every job.
+        name_job (str):
+            Prefix of the job directory names.
+        inputs (list):
+            Key paths (tuples or dotted strings) into the params of each job
+            whose values are paths to input files or directories. Their
+            fingerprints are part of the key.
+        markers (list):
+            Glob patterns, relative to the job directory, of the outputs of
+            a complete job. A job is complete if every pattern matches at
+            least one file.
+        keys_ignore (list):
+            Key paths into the params that do not change the results (e.g.
+            verbosity). They are left out of the key.
+        method_fingerprint (str):
+            How input files are fingerprinted. See fingerprint_path.
+        len_key (int):
+            Number of hex characters of the key used in directory names.
+        verbose (int):
+            Verbosity level.
+    """
+    def __init__(
+        self,
+        dir_save,
+        path_script,
+        name_job='jobNum_',
+        inputs=[],
+        markers=[],
+        keys_ignore=[],
+        method_fingerprint='stat',
+        len_key=16,
+        verbose=1,
+    ):
+        self.dir_save = Path(dir_save).resolve()
+        self.name_job = name_job
+        self.inputs = [sweep.as_key_path(k) for k in inputs]
+        self.markers = list(markers)
+        self.keys_ignore = [sweep.as_key_path(k) for k in keys_ignore]
+        self.method_fingerprint = method_fingerprint
+        self.len_key = len_key
+        self.verbose = verbose
+
+        self.hash_script = hash_file(path_script)
+        self._fingerprints = {}  ## {path: fingerprint}. Inputs are often shared by many jobs.
+
+        self.path_index = self.dir_save / 'job_cache_index.json'
+        self.index = self._load_index()
+
+    def _load_index(self):
+        if not self.path_index.exists():
+            return {}
+        try:
+            with open(self.path_index, 'r') as f:
+                return json.load(f)['jobs']
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not read job cache index {self.path_index}: {e}. Starting a new one.") if self.verbose > 0 else None
+            return {}
+
+    def save(self):
+        """Writes the index atomically (write to a temporary file, then rename)."""
+        self.dir_save.mkdir(parents=True, exist_ok=True)
+        path_tmp = self.path_index.with_suffix('.json.tmp')
+        with open(path_tmp, 'w') as f:
+            json.dump({'version': 1, 'jobs': self.index}, f, indent=1)
+        os.replace(path_tmp, self.path_index)
+
+    def fingerprint(self, path):
+        """Fingerprint of an input path. Memoized."""
+        path = str(path)
+        if path not in self._fingerprints:
+            self._fingerprints[path] = fingerprint_path(path, method=self.method_fingerprint)
+        return self._fingerprints[path]
+
+    def key(self, params):
+        """Content hash of a job: script + canonical params + input fingerprints."""
+        params_key = params
+        for k in self.keys_ignore:
+            if sweep.deep_get(params_key, k, default=None) is not None:
+                params_key = sweep.deep_update_dict(params_key, k, None)
+        fingerprints = {}
+        for k in self.inputs:
+            path = sweep.deep_get(params, k, default=None)
+            if path is not None:
+                fingerprints[sweep.key_to_str(k)] = self.fingerprint(path)
+        h = hashlib.sha256()
+        h.update(self.hash_script.encode())
+        h.update(canonical_json(params_key).encode())
+        h.update(canonical_json(fingerprints).encode())
+        return h.hexdigest()
+
+    def dir_job(self, key):
+        """Directory of the job with this key."""
+        return self.dir_save / f'{self.name_job}{key[:self.len_key]}'
+
+    def is_complete(self, key):
+        """True if every marker matches a file in the job's directory."""
+        dir_job = self.dir_job(key)
+        if not dir_job.exists():
+            return False
+        return all(next(dir_job.glob(m), None) is not None for m in self.markers)
+
+    def plan(self, params_all, verify=False, check_squeue=True):
+        """
+        Classifies jobs as complete, active, failed or new, and updates the
+        index.
+        RH 2024
+
+        Args:
+            params_all (iterable of dict):
+                Params of each job, in job order.
+            verify (bool):
+                If True, jobs that the index says are complete are checked
+                again on disk. If False, they are skipped without touching
+                their directories.
+            check_squeue (bool):
+                If True, jobs that are pending or running are not
+                resubmitted. Makes one squeue call. If squeue fails, every
+                job directory that exists but is not complete is treated as
+                active, so nothing is resubmitted by mistake. If False, they
+                are all treated as failed and resubmitted.
+
+        Returns:
+            (dict):
+                * submit (list): Jobs to submit: dicts with idx, key, params
+                  and dir_job.\n
+                * counts (dict): Number of jobs per status.\n
+                * status (list): Status of each job, in job order.
+        """
+        dirs_active = squeue_active_dirs() if check_squeue else set()
+        squeue_failed = dirs_active is None
+        if squeue_failed:
+            ## A job that is still running must not be submitted again, so without squeue no directory counts as failed
+            print("squeue failed. Jobs that were submitted before and are not complete are treated as active and not resubmitted.") if self.verbose > 0 else None
+            dirs_active = set()
+
+        submit, status_all = [], []
+        counts = {'complete': 0, 'active': 0, 'failed': 0, 'new': 0}
+        for idx, params in enumerate(params_all):
+            key = self.key(params)
+            entry = self.index.get(key)
+            if (entry is not None) and (entry['status'] == 'complete') and (not verify):
+                status = 'complete'
+            elif self.is_complete(key):
+                status = 'complete'
+                if (entry is None) or (entry['status'] != 'complete'):
+                    self.index[key] = {**(entry or {'n_submitted': 0}), 'dir': self.dir_job(key).name, 'status': 'complete', 'time_complete': time.time()}
+            elif (str(self.dir_job(key)) in dirs_active) or (squeue_failed and self.dir_job(key).exists()):
+                status = 'active'
+            elif self.dir_job(key).exists():
+                status = 'failed'
+            else:
+                status = 'new'
+
+            if (status == 'failed') and (entry is not None) and (entry['status'] != 'failed'):
+                self.index[key] = {**entry, 'status': 'failed'}
+            if status in ['failed', 'new']:
+                submit.append({'idx': idx, 'key': key, 'params': params, 'dir_job': str(self.dir_job(key))})
+            counts[status] += 1
+            status_all.append(status)
+
+        self.save()
+        print(f"Job cache: {counts['complete']} complete, {counts['active']} active, {counts['failed']} failed, {counts['new']} new. Submitting {len(submit)}.") if self.verbose > 0 else None
+        return {'submit': submit, 'counts': counts, 'status': status_all}
+
+    def mark_submitted(self, jobs):
+        """
+        Records jobs (as returned in plan()['submit']) as submitted, with
+        their 'slurm_job_id' if it was set by submitter.submit_jobs.
+        """
+        for job in jobs:
+            entry = self.index.get(job['key'], {'n_submitted': 0})
+            self.index[job['key']] = {
+                **entry,
+                'dir': Path(job['dir_job']).name,
+                'idx': job['idx'],
+                'status': 'submitted',
+                'time_submitted': time.time(),
+                'n_submitted': entry.get('n_submitted', 0) + 1,
+                'slurm_job_id': job.get('slurm_job_id'),
+            }
+        self.save()
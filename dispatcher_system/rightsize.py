@@ -0,0 +1,581 @@
+"""
+RIGHTSIZE
+RH 2024
+
+Right-sizes the Slurm requests of dispatcher jobs from the history of past
+jobs. Pure/native Python 3.
+
+History is kept in a local SQLite database (default
+~/.dispatcher_history.sqlite), shared by all dispatches:\n
+    * register(): Records each submitted job: its Slurm job ID, job name,
+      script name, input features (number and total size of the videos it
+      reads) and requested memory, CPUs and time.\n
+    * update(): Fills in the final state, MaxRSS, elapsed time and CPU
+      efficiency of finished jobs from sacct --parsable2 (a few calls for
+      all unfinished jobs).\n
+    * import_sacct(): Adds past jobs that were not registered (e.g. run
+      before the history existed) from one sacct call: jobs whose name
+      starts with a prefix, found by their sbatch script, with input
+      features rebuilt from the params.json in their job directory.\n
+    * estimate(): For jobs of a script whose job name starts with a prefix,
+      fits memory and time as linear functions of input size, and CPU count
+      from CPU efficiency.\n
+rightsize() then sets per-job directives (job['directives'], see
+submitter.py): predicted peak * the 95th percentile of actual / predicted
+over past jobs * (1 + margin). Requests are rounded up to quanta (4 GB,
+30 min) so that similar jobs still share an array, and are never below the
+request of a past job of the group with a smaller input that ran out of
+memory or time.
+
+Demo:
+    history = History()
+    history.import_sacct(script='run_pipeline_basic.py', name_prefix='PS46')
+    history.update()
+    rightsize(history, jobs, name_prefix='PS46', script='run_pipeline_basic.py', directives=sbatch_directives)
+    arrays = submitter.submit_jobs(jobs, ...)
+    history.register(jobs, name=name_slurm, script='run_pipeline_basic.py', directives=sbatch_directives)
+
+Usage:
+    python rightsize.py update
+    python rightsize.py import --script run_pipeline_basic.py --name_prefix PS46 --days 180
+    python rightsize.py show --script run_pipeline_basic.py --name_prefix PS46
+"""
+
+import argparse
+import getpass
+import json
+import math
+import os
+import re
+import sqlite3
+import subprocess
+import time
+from pathlib import Path
+
+import status
+import sweep
+
+
+PATH_DB_DEFAULT = str(Path.home() / '.dispatcher_history.sqlite')
+## Slurm states whose usage is a lower bound, not the need, of a job
+STATES_OUT_OF = {'OUT_OF_MEMORY': 'mem', 'TIMEOUT': 'time'}
+
+
+def parse_mem_gb(s):
+    """Converts a memory request (e.g. '48GB', '48G', '4000M', 48) to GB."""
+    if isinstance(s, (int, float)):
+        return float(s) / 1024  ## Slurm's default unit is MB
+    m = re.match(r'^([\d.]+)\s*([KMGT]?)B?$', str(s).strip().upper())
+    assert m is not None, f"Could not parse memory: {s}"
+    return float(m.group(1)) * {'K': 2**-20, 'M': 2**-10, '': 2**-10, 'G': 1, 'T': 2**10}[m.group(2)]
+
+
+def format_time(seconds):
+    """Formats seconds as a Slurm time: D-HH:MM:SS."""
+    seconds = int(math.ceil(seconds))
+    return f'{seconds // 86400}-{seconds % 86400 // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+
+def input_features(params, key_dir='paths_videos.directory_videos', key_regex='paths_videos.filename_videos_strMatch', key_depth='paths_videos.depth', _cache={}):
+    """
+    Measures the input of a face-rhythm job: the number and total size (GB)
+    of the files in its video directory whose name matches its regex, within
+    its search depth (like face_rhythm.helpers.find_paths). Memoized per
+    directory.
+
+    Returns:
+        (dict):
+            n_files (int) and size_gb (float). None if the directory is not
+            in params or does not exist.
+    """
+    dir_videos = sweep.deep_get(params, key_dir)
+    if (dir_videos is None) or (not Path(dir_videos).is_dir()):
+        return None
+    regex, depth = sweep.deep_get(params, key_regex, '.*'), sweep.deep_get(params, key_depth, 0)
+    key = (str(dir_videos), regex, depth)
+    if key not in _cache:
+        pattern = re.compile(regex)
+        n_files, size = 0, 0
+        depth_root = str(dir_videos).rstrip(os.sep).count(os.sep)
+        for root, dirs, files in os.walk(dir_videos):
+            if root.rstrip(os.sep).count(os.sep) - depth_root >= depth:
+                dirs[:] = []  ## Do not go deeper
+            for name in files:
+                if pattern.search(name):
+                    n_files += 1
+                    size += os.stat(os.path.join(root, name)).st_size
+        _cache[key] = {'n_files': n_files, 'size_gb': size / 2**30}
+    return _cache[key]
+
+
+def parse_req_mem_gb(s, n_cpus):
+    """
+    Converts sacct's ReqMem to GB per job. Older Slurm versions append 'n'
+    (per node) or 'c' (per CPU, multiplied by n_cpus).
+    """
+    if not s:
+        return None
+    per_cpu = s[-1] == 'c'
+    s = s[:-1] if s[-1] in 'nc' else s
+    return parse_mem_gb(s) * (int(n_cpus or 1) if per_cpu else 1)
+
+
+def find_job_dirs(path_sbatch, index, _cache={}):
+    """
+    Finds the job directories of a Slurm job from its sbatch script, like
+    job_cache.squeue_active_dirs:\n
+        * Arrays from submitter.submit_jobs: line 'index' of
+          {dir_array}/jobs.txt (several directories if jobs were packed).\n
+        * Jobs from util.batch_run: the directory of the script.\n
+    jobs.txt files are read once.
+
+    Returns:
+        (list of str):
+            Job directories. Empty if not found.
+    """
+    path_jobs = Path(path_sbatch).parent / 'jobs.txt'
+    if (index is None) or (not path_jobs.exists()):
+        return [str(Path(path_sbatch).parent)]
+    if path_jobs not in _cache:
+        with open(path_jobs, 'r') as f:
+            _cache[path_jobs] = f.read().splitlines()
+    lines = _cache[path_jobs]
+    return [d for d in lines[index].split('\t') if d] if index < len(lines) else []
+
+
+def fit_linear(x, y):
+    """
+    Least-squares fit of y = a + b * x. Falls back to the mean of y (b = 0)
+    if x has no spread or the slope is negative.
+
+    Returns:
+        (tuple):
+            (a, b)
+    """
+    n = len(x)
+    mean_x, mean_y = sum(x) / n, sum(y) / n
+    var_x = sum((xi - mean_x)**2 for xi in x)
+    if var_x == 0:
+        return mean_y, 0.0
+    b = sum((xi - mean_x) * (yi - mean_y) for xi, yi in zip(x, y)) / var_x
+    if b < 0:
+        return mean_y, 0.0
+    return mean_y - b * mean_x, b
+
+
+def quantile(values, q):
+    """q-th quantile of values (linear interpolation)."""
+    values = sorted(values)
+    i = (len(values) - 1) * q
+    lo, hi = int(math.floor(i)), int(math.ceil(i))
+    return values[lo] + (values[hi] - values[lo]) * (i - lo)
+
+
+class History:
+    """
+    Local database of the resources used by past dispatcher jobs.
+    RH 2024
+
+    Args:
+        path_db (str):
+            Path to the SQLite database. Created if it does not exist.
+        verbose (int):
+            Verbosity level.
+    """
+    def __init__(self, path_db=PATH_DB_DEFAULT, verbose=1):
+        self.path_db = str(path_db)
+        self.verbose = verbose
+        self.conn = sqlite3.connect(self.path_db, timeout=30)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS runs (
+                slurm_job_id TEXT PRIMARY KEY,
+                name TEXT,
+                script TEXT,
+                dir_job TEXT,
+                time_submit REAL,
+                n_files INTEGER,
+                size_gb REAL,
+                pack_size INTEGER,
+                req_mem_gb REAL,
+                req_cpus INTEGER,
+                req_time_s REAL,
+                state TEXT,
+                max_rss_gb REAL,
+                elapsed_s REAL,
+                cpu_eff REAL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS runs_script_name ON runs (script, name)")
+        self.conn.commit()
+
+    def register(self, jobs, name, script, directives, pack_size=1):
+        """
+        Records submitted jobs.
+
+        Args:
+            jobs (list of dict):
+                Jobs with 'slurm_job_id' and 'params' (as set by
+                submitter.submit_jobs), and optionally 'directives'.
+            name (str):
+                Job name (--job-name).
+            script (str):
+                Name of the script run by the jobs.
+            directives (dict):
+                Directives shared by the jobs.
+            pack_size (int):
+                Number of jobs per allocation. Packed jobs share their usage,
+                so they are not used in estimates.
+        """
+        rows = []
+        for job in jobs:
+            if job.get('slurm_job_id') is None:
+                continue
+            d = {**directives, **job.get('directives', {})}
+            features = input_features(job['params']) or {}
+            rows.append((
+                job['slurm_job_id'], name, script, str(job.get('dir_job')), time.time(),
+                features.get('n_files'), features.get('size_gb'), pack_size,
+                parse_mem_gb(d['--mem']) if '--mem' in d else None,
+                int(d.get('-c', d.get('--cpus-per-task', 1))),
+                status.parse_elapsed(d['--time']) if '--time' in d else None,
+            ))
+        self.conn.executemany("""
+            INSERT OR REPLACE INTO runs (slurm_job_id, name, script, dir_job, time_submit, n_files, size_gb, pack_size, req_mem_gb, req_cpus, req_time_s)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        self.conn.commit()
+        print(f"Registered {len(rows)} jobs in {self.path_db}") if self.verbose > 0 else None
+
+    def update(self, chunk_size=500):
+        """
+        Fills in the usage of jobs that have finished since the last update,
+        with sacct --parsable2 (one call per chunk_size jobs).
+
+        Returns:
+            (int):
+                Number of jobs updated.
+        """
+        states_final = tuple(status.STATES_FINAL)
+        ids = [r[0] for r in self.conn.execute(
+            f"SELECT slurm_job_id FROM runs WHERE state IS NULL OR state NOT IN ({','.join('?' * len(states_final))})", states_final,
+        )]
+        n_updated = 0
+        for i in range(0, len(ids), chunk_size):
+            try:
+                out = subprocess.run(
+                    ['sacct', '--noheader', '--parsable2', '-j', ','.join(ids[i:i + chunk_size]),
+                     '--format=JobID,State,ElapsedRaw,TotalCPU,NCPUS,MaxRSS'],
+                    capture_output=True, text=True, timeout=300, check=True,
+                ).stdout
+            except (OSError, subprocess.SubprocessError) as e:
+                print(f"sacct failed: {e}") if self.verbose > 0 else None
+                return n_updated
+            usage = {}
+            for line in out.splitlines():
+                fields = line.split('|')
+                if len(fields) < 6:
+                    continue
+                job_id, state, elapsed, total_cpu, n_cpus, max_rss = fields[:6]
+                job_id, _, step = job_id.partition('.')
+                u = usage.setdefault(job_id, {'state': None, 'elapsed_s': None, 'cpu_eff': None, 'max_rss_gb': None})
+                if not step:
+                    elapsed = float(elapsed) if elapsed else 0
+                    cpu = status.parse_elapsed(total_cpu)
+                    u['state'] = state.split(' ')[0]
+                    u['elapsed_s'] = elapsed
+                    if elapsed > 0 and n_cpus and cpu is not None:
+                        u['cpu_eff'] = cpu / (elapsed * int(n_cpus))
+                if max_rss:
+                    u['max_rss_gb'] = max(u['max_rss_gb'] or 0, status.parse_mem(max_rss))
+            self.conn.executemany(
+                "UPDATE runs SET state = ?, max_rss_gb = ?, elapsed_s = ?, cpu_eff = ? WHERE slurm_job_id = ?",
+                [(u['state'], u['max_rss_gb'], u['elapsed_s'], u['cpu_eff'], job_id) for job_id, u in usage.items() if u['state'] is not None],
+            )
+            self.conn.commit()
+            n_updated += len(usage)
+        print(f"Updated {n_updated} of {len(ids)} unfinished jobs from sacct") if self.verbose > 0 else None
+        return n_updated
+
+    def import_sacct(self, script, name_prefix='', time_start=None, user=None):
+        """
+        Adds past jobs of a script that are not in the history, from one
+        sacct --parsable2 call. Jobs are selected by job name prefix, and by
+        the script name appearing in their sbatch script (from SubmitLine,
+        which needs Slurm >= 20.11). Their input features are rebuilt from
+        the params.json in their job directory (see find_job_dirs), falling
+        back to WorkDir. Jobs already in the history are left unchanged.
+        RH 2024
+
+        Args:
+            script (str):
+                Name of the script run by the jobs.
+            name_prefix (str):
+                Only import jobs whose name starts with this.
+            time_start (float):
+                Unix time from which sacct reports jobs. Default is 90 days
+                ago.
+            user (str):
+                User name. Default is the current user.
+
+        Returns:
+            (int):
+                Number of jobs imported.
+        """
+        user = getpass.getuser() if user is None else user
+        time_start = time.time() - 90 * 86400 if time_start is None else time_start
+        try:
+            out = subprocess.run(
+                ['sacct', '-u', user, '--noheader', '--parsable2',
+                 '-S', time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(time_start)),
+                 '--format=JobID,JobName,State,Submit,SubmitLine,WorkDir,ReqMem,ReqCPUS,Timelimit,ElapsedRaw,TotalCPU,NCPUS,MaxRSS'],
+                capture_output=True, text=True, timeout=300, check=True,
+            ).stdout
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"sacct failed: {e}") if self.verbose > 0 else None
+            return 0
+
+        ## Allocation lines have the job's name and requests; step lines (batch, extern, ...) the peak memory
+        jobs, max_rss = {}, {}
+        for line in out.splitlines():
+            fields = line.split('|')
+            if len(fields) < 13:
+                continue
+            job_id, job_name, state, submit, submit_line, work_dir, req_mem, req_cpus, time_limit, elapsed, total_cpu, n_cpus, rss = fields[:13]
+            job_id, _, step = job_id.partition('.')
+            if rss:
+                max_rss[job_id] = max(max_rss.get(job_id, 0), status.parse_mem(rss))
+            if step or ('[' in job_id) or (not job_name.startswith(name_prefix)):
+                continue  ## Steps, PENDING array ranges and other jobs
+            jobs[job_id] = {
+                'name': job_name, 'state': state.split(' ')[0], 'submit': submit, 'submit_line': submit_line, 'work_dir': work_dir,
+                'req_mem': req_mem, 'req_cpus': req_cpus, 'time_limit': time_limit, 'elapsed': elapsed, 'total_cpu': total_cpu, 'n_cpus': n_cpus,
+            }
+        known = {r[0] for r in self.conn.execute("SELECT slurm_job_id FROM runs")}
+
+        rows, scripts = [], {}  ## {path_sbatch: whether it runs script}. Read each sbatch script once.
+        for job_id, j in jobs.items():
+            if job_id in known:
+                continue
+            path_sbatch = next((t for t in reversed(j['submit_line'].split()) if t.endswith('.sh')), None)
+            if path_sbatch is None:
+                continue
+            path_sbatch = str(Path(j['work_dir']) / path_sbatch)  ## Relative to the submission directory
+            if path_sbatch not in scripts:
+                try:
+                    with open(path_sbatch, 'r') as f:
+                        scripts[path_sbatch] = script in f.read()
+                except OSError:
+                    scripts[path_sbatch] = False
+            if not scripts[path_sbatch]:
+                continue
+            _, _, index = job_id.partition('_')
+            dirs_job = find_job_dirs(path_sbatch, int(index) if index else None)
+            dirs_job = [d for d in dirs_job if (Path(d) / 'params.json').exists()] or ([j['work_dir']] if (Path(j['work_dir']) / 'params.json').exists() else [])
+            features = {}
+            if len(dirs_job) == 1:  ## Packed jobs share their usage: no per-job features
+                with open(Path(dirs_job[0]) / 'params.json', 'r') as f:
+                    features = input_features(json.load(f)) or {}
+            elapsed, cpu = float(j['elapsed'] or 0), status.parse_elapsed(j['total_cpu'])
+            try:
+                time_submit = time.mktime(time.strptime(j['submit'], '%Y-%m-%dT%H:%M:%S'))
+            except ValueError:
+                time_submit = None
+            rows.append((
+                job_id, j['name'], script, dirs_job[0] if len(dirs_job) == 1 else None, time_submit,
+                features.get('n_files'), features.get('size_gb'), max(len(dirs_job), 1),
+                parse_req_mem_gb(j['req_mem'], j['req_cpus']), int(j['req_cpus']) if j['req_cpus'] else None, status.parse_elapsed(j['time_limit']),
+                j['state'], max_rss.get(job_id), elapsed,
+                cpu / (elapsed * int(j['n_cpus'])) if (elapsed > 0 and j['n_cpus'] and cpu is not None) else None,
+            ))
+        self.conn.executemany("""
+            INSERT OR IGNORE INTO runs (slurm_job_id, name, script, dir_job, time_submit, n_files, size_gb, pack_size, req_mem_gb, req_cpus, req_time_s, state, max_rss_gb, elapsed_s, cpu_eff)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        self.conn.commit()
+        print(f"Imported {len(rows)} past jobs of {script} ({name_prefix}*) from sacct") if self.verbose > 0 else None
+        return len(rows)
+
+    def runs(self, script, name_prefix=''):
+        """Finished runs of a script whose job name starts with name_prefix, as dicts."""
+        cursor = self.conn.execute(
+            "SELECT * FROM runs WHERE script = ? AND name LIKE ? ESCAPE '\\' AND state IS NOT NULL",
+            (script, name_prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'),
+        )
+        names = [c[0] for c in cursor.description]
+        return [dict(zip(names, row)) for row in cursor]
+
+    def estimate(self, script, name_prefix='', margin=0.2, q=0.95, min_runs=3):
+        """
+        Fits the resources needed by jobs of a script as a function of input
+        size.
+        RH 2024
+
+        Args:
+            script (str):
+                Name of the script.
+            name_prefix (str):
+                Only use jobs whose name starts with this.
+            margin (float):
+                Safety margin: requests are multiplied by (1 + margin).
+            q (float):
+                Quantile of actual / predicted usage over past runs used to
+                scale predictions.
+            min_runs (int):
+                Minimum number of completed, unpacked runs. Fewer gives None.
+
+        Returns:
+            (dict or None):
+                Model for mem_gb and time_s: a, b (linear fit in size_gb),
+                scale (quantile of actual / predicted) and floors ((size_gb,
+                request * (1 + margin)) of past jobs that ran out of it). For
+                cpus: used (quantile of CPUs used). And n_runs.
+                Use predict() to get requests.
+        """
+        runs = [r for r in self.runs(script, name_prefix) if (r['pack_size'] or 1) == 1]
+        ok = [r for r in runs if r['state'] == 'COMPLETED' and r['max_rss_gb'] is not None and r['elapsed_s']]
+        if len(ok) < min_runs:
+            print(f"Right-sizing: {len(ok)} completed runs of {script} ({name_prefix}*) < min_runs={min_runs}. Keeping requests.") if self.verbose > 0 else None
+            return None
+        x = [r['size_gb'] or 0.0 for r in ok]
+        model = {'margin': margin, 'n_runs': len(ok)}
+        for resource, key in [('mem_gb', 'max_rss_gb'), ('time_s', 'elapsed_s')]:
+            y = [r[key] for r in ok]
+            a, b = fit_linear(x, y)
+            ratios = [yi / max(a + b * xi, 1e-9) for xi, yi in zip(x, y)]
+            req = {'mem_gb': 'req_mem_gb', 'time_s': 'req_time_s'}[resource]
+            floors = [(r['size_gb'] or 0.0, r[req] * (1 + margin)) for r in runs if STATES_OUT_OF.get(r['state']) == resource.split('_')[0] and r[req]]
+            model[resource] = {'a': a, 'b': b, 'scale': max(1.0, quantile(ratios, q)), 'floors': floors}
+        effs = [r['cpu_eff'] * r['req_cpus'] for r in ok if r['cpu_eff'] is not None and r['req_cpus']]  ## CPUs actually used
+        model['cpus'] = {'used': quantile(effs, q) if effs else None}
+        return model
+
+
+def predict(model, size_gb):
+    """
+    Resources to request for a job with an input of size_gb, from a model
+    made by History.estimate.
+
+    Returns:
+        (dict):
+            mem_gb, time_s and cpus (None if unknown).
+    """
+    out = {}
+    for resource in ['mem_gb', 'time_s']:
+        m = model[resource]
+        floor = max([req for size, req in m['floors'] if size <= (size_gb or 0.0)], default=0)  ## A larger input needs more than a smaller one that ran out
+        out[resource] = max((m['a'] + m['b'] * (size_gb or 0.0)) * m['scale'] * (1 + model['margin']), floor)
+    used = model['cpus']['used']
+    out['cpus'] = max(1, math.ceil(used * (1 + model['margin']))) if used is not None else None
+    return out
+
+
+def rightsize(
+    history,
+    jobs,
+    script,
+    directives,
+    name_prefix='',
+    margin=0.2,
+    quantum_mem_gb=4,
+    quantum_time_s=1800,
+    allow_increase=False,
+    min_runs=3,
+    verbose=1,
+):
+    """
+    Sets right-sized --mem, --time and -c directives on each job
+    (job['directives']), from the history of past jobs of the same script
+    and job name prefix. Leaves jobs unchanged if there is not enough
+    history.
+    RH 2024
+
+    Args:
+        history (History):
+            History of past jobs. Call history.update() first.
+        jobs (list of dict):
+            Jobs with 'params'. See submitter.submit_jobs.
+        script (str):
+            Name of the script run by the jobs.
+        directives (dict):
+            Directives of the template. Requests are not above these unless
+            allow_increase is True.
+        name_prefix (str):
+            Only use past jobs whose name starts with this.
+        margin (float):
+            Safety margin: requests are (1 + margin) times the estimate.
+        quantum_mem_gb (float):
+            Memory requests are rounded up to a multiple of this, so that
+            jobs of similar size share an array.
+        quantum_time_s (float):
+            Time requests are rounded up to a multiple of this.
+        allow_increase (bool):
+            If True, requests may be above the template's.
+        min_runs (int):
+            Minimum number of completed past jobs to right-size.
+        verbose (int):
+            Verbosity level.
+
+    Returns:
+        (dict or None):
+            Model used (see History.estimate). None if jobs were not changed.
+    """
+    model = history.estimate(script, name_prefix=name_prefix, margin=margin, min_runs=min_runs)
+    if model is None:
+        return None
+    mem_max = parse_mem_gb(directives['--mem']) if '--mem' in directives else None
+    time_max = status.parse_elapsed(directives['--time']) if '--time' in directives else None
+    cpus_max = int(directives['-c']) if '-c' in directives else None
+    n_capped = 0
+    for job in jobs:
+        features = input_features(job['params']) or {}
+        pred = predict(model, features.get('size_gb'))
+        mem = math.ceil(pred['mem_gb'] / quantum_mem_gb) * quantum_mem_gb
+        time_s = math.ceil(pred['time_s'] / quantum_time_s) * quantum_time_s
+        cpus = pred['cpus']
+        if not allow_increase:
+            n_capped += int((mem_max is not None and mem > mem_max) or (time_max is not None and time_s > time_max))
+            mem = min(mem, mem_max) if mem_max is not None else mem
+            time_s = min(time_s, time_max) if time_max is not None else time_s
+            cpus = min(cpus, cpus_max) if (cpus is not None and cpus_max is not None) else cpus
+        overrides = {'--mem': f'{mem:g}GB', '--time': format_time(time_s)}
+        if cpus is not None:
+            overrides['-c'] = cpus
+        job['directives'] = {**job.get('directives', {}), **overrides}
+    if verbose > 0:
+        requests = sorted({(j['directives']['--mem'], j['directives']['--time'], j['directives'].get('-c')) for j in jobs})
+        print(f"Right-sized {len(jobs)} jobs from {model['n_runs']} past runs. Requests (mem, time, cpus): {requests}")
+        print(f"Warning: {n_capped} jobs are estimated to need more than the template's --mem / --time. Consider allow_increase=True.") if n_capped > 0 else None
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description='History of dispatcher jobs and right-sized requests.')
+    parser.add_argument('command', type=str, choices=['update', 'import', 'show'], help='update: fill in finished jobs from sacct. import: add past jobs of a script from sacct. show: print the fitted model and runs.')
+    parser.add_argument('--path_db', type=str, default=PATH_DB_DEFAULT, help='Path to the history database.')
+    parser.add_argument('--script', type=str, default=None, help='Name of the script (for import and show).')
+    parser.add_argument('--name_prefix', type=str, default='', help='Job name prefix (for import and show).')
+    parser.add_argument('--days', type=float, default=90, help='Import jobs submitted within this many days (for import).')
+    parser.add_argument('--margin', type=float, default=0.2, help='Safety margin (for show).')
+    args = parser.parse_args()
+
+    history = History(args.path_db)
+    if args.command == 'update':
+        history.update()
+    elif args.command == 'import':
+        assert args.script is not None, "--script is required for import"
+        history.import_sacct(args.script, name_prefix=args.name_prefix, time_start=time.time() - args.days * 86400)
+    elif args.command == 'show':
+        assert args.script is not None, "--script is required for show"
+        runs = history.runs(args.script, args.name_prefix)
+        print(f"{'job id':<14} {'state':<14} {'size GB':>8} {'req GB':>7} {'peak GB':>8} {'req h':>6} {'h':>6} {'CPU eff':>8}")
+        for r in runs:
+            fmt = lambda v, f: format(v, f) if v is not None else ''
+            print(f"{r['slurm_job_id']:<14} {r['state']:<14} {fmt(r['size_gb'], '8.2f')} {fmt(r['req_mem_gb'], '7.0f')} {fmt(r['max_rss_gb'], '8.1f')} {fmt(r['req_time_s'] and r['req_time_s'] / 3600, '6.1f')} {fmt(r['elapsed_s'] and r['elapsed_s'] / 3600, '6.2f')} {fmt(r['cpu_eff'], '8.2f')}")
+        model = history.estimate(args.script, name_prefix=args.name_prefix, margin=args.margin)
+        if model is not None:
+            for size_gb in [1, 5, 10, 20, 50]:
+                print(f"Input {size_gb} GB: {predict(model, size_gb)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""
+RUNNER
+RH 2024
+
+Runs a pack of dispatcher jobs inside one Slurm allocation. Pure/native
+Python 3.
+
+Used by submitter.submit_jobs when pack_size > 1: each array task runs this
+script on one line of jobs.txt, which lists the directories of the jobs
+packed into that task (tab separated). Jobs are put in a local queue and run
+by n_workers workers, each job in its own process:\n
+    python {path_script} --path_params {dir_job}/params.json --directory_save {dir_job}\n
+The output of each job goes to {dir_job}/print_log_{array job id}_{index}.log
+(like unpacked jobs), and its state to {dir_job}/status.json. Jobs whose
+status is already 'complete' are skipped, so a requeued (e.g. preempted)
+allocation only reruns unfinished jobs.
+
+Usage:
+    python runner.py --path_jobs jobs.txt --index $SLURM_ARRAY_TASK_ID --path_script script.py --n_workers 4
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+
+def read_pack(path_jobs, index):
+    """Returns the job directories on line index (0-based) of a jobs.txt file."""
+    with open(path_jobs, 'r') as f:
+        for i_line, line in enumerate(f):
+            if i_line == index:
+                return [d for d in line.rstrip('\n').split('\t') if d]
+    raise IndexError(f"Line {index} not found in {path_jobs}")
+
+
+def read_status(dir_job):
+    """Returns the status dict of a job, or None if it has none."""
+    try:
+        with open(Path(dir_job) / 'status.json', 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_status(dir_job, status):
+    """Writes the status dict of a job atomically."""
+    path = Path(dir_job) / 'status.json'
+    path_tmp = path.with_suffix('.json.tmp')
+    with open(path_tmp, 'w') as f:
+        json.dump(status, f, indent=1)
+    os.replace(path_tmp, path)
+
+
+def run_job(dir_job, path_script, name_log, env=None, python=sys.executable):
+    """
+    Runs one job in a new process and records its status.
+    RH 2024
+
+    Args:
+        dir_job (str):
+            Directory of the job. Must contain params.json.
+        path_script (str):
+            Path to the Python script.
+        name_log (str):
+            File name of the log in dir_job.
+        env (dict):
+            Environment of the process. None to inherit.
+        python (str):
+            Python interpreter.
+
+    Returns:
+        (dict):
+            Status of the job. If the process could not be started (OSError),
+            its state is 'failed' and 'error' has the message.
+    """
+    status = {
+        'state': 'running',
+        'host': socket.gethostname(),
+        'slurm_job_id': os.environ.get('SLURM_JOB_ID'),
+        'path_log': str(Path(dir_job) / name_log),
+        'time_start': time.time(),
+    }
+    try:
+        write_status(dir_job, status)
+        with open(Path(dir_job) / name_log, 'w') as f_log:
+            returncode = subprocess.run(
+                [python, str(path_script), '--path_params', str(Path(dir_job) / 'params.json'), '--directory_save', str(dir_job)],
+                stdout=f_log, stderr=subprocess.STDOUT, env=env,
+            ).returncode
+        status.update({'state': 'complete' if returncode == 0 else 'failed', 'returncode': returncode})
+    except OSError as e:
+        ## e.g. the interpreter or the job directory is missing. The job fails, not the pack.
+        status.update({'state': 'failed', 'returncode': None, 'error': str(e)})
+    status['time_end'] = time.time()
+    try:
+        write_status(dir_job, status)
+    except OSError:
+        pass  ## The job directory is not writable. The status is still returned.
+    return status
+
+
+def run_pack(dirs_jobs, path_script, n_workers=1, name_log='print_log.log', verbose=1):
+    """
+    Runs a pack of jobs with n_workers concurrent processes. Jobs that are
+    already complete are skipped.
+    RH 2024
+
+    Args:
+        dirs_jobs (list of str):
+            Directories of the jobs.
+        path_script (str):
+            Path to the Python script.
+        n_workers (int):
+            Number of jobs run at once. Each job's BLAS / OpenMP threads are
+            limited to its share of the allocation's CPUs
+            (SLURM_CPUS_PER_TASK // n_workers).
+        name_log (str):
+            File name of the log in each job directory.
+        verbose (int):
+            Verbosity level.
+
+    Returns:
+        (dict):
+            Number of jobs per final state: complete, failed, skipped.
+    """
+    env = dict(os.environ)
+    n_cpus = os.environ.get('SLURM_CPUS_PER_TASK')
+    if n_cpus is not None:
+        n_threads = str(max(1, int(n_cpus) // n_workers))
+        env.update({k: n_threads for k in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS']})
+
+    counts = {'complete': 0, 'failed': 0, 'skipped': 0}
+    queue = []
+    for dir_job in dirs_jobs:
+        status = read_status(dir_job)
+        if (status is not None) and (status['state'] == 'complete'):
+            counts['skipped'] += 1
+        else:
+            queue.append(dir_job)
+    print(f"Running {len(queue)} jobs with {n_workers} workers ({counts['skipped']} already complete)") if verbose > 0 else None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as pool:  ## Each job is its own process; threads only wait on them
+        futures = {pool.submit(run_job, dir_job, path_script, name_log, env): dir_job for dir_job in queue}
+        for future in concurrent.futures.as_completed(futures):
+            status = future.result()
+            counts[status['state']] += 1
+            str_error = f", error: {status['error']}" if 'error' in status else ''
+            print(f"{status['state']}: {futures[future]} ({status['time_end'] - status['time_start']:.0f} s, returncode {status['returncode']}{str_error})") if verbose > 0 else None
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a pack of dispatcher jobs inside one Slurm allocation.')
+    parser.add_argument('--path_jobs', type=str, required=True, help='Path to jobs.txt: tab separated job directories, one line per array index.')
+    parser.add_argument('--index', type=int, default=int(os.environ.get('SLURM_ARRAY_TASK_ID', 0)), help='Line of jobs.txt to run. Default is $SLURM_ARRAY_TASK_ID.')
+    parser.add_argument('--path_script', type=str, required=True, help='Path to the Python script run by each job.')
+    parser.add_argument('--n_workers', type=int, default=1, help='Number of jobs run at once.')
+    parser.add_argument('--verbose', type=int, default=1, help='Verbosity level.')
+    args = parser.parse_args()
+
+    dirs_jobs = read_pack(args.path_jobs, args.index)
+    name_log = f"print_log_{os.environ.get('SLURM_ARRAY_JOB_ID', os.environ.get('SLURM_JOB_ID', 'local'))}_{args.index}.log"
+    counts = run_pack(dirs_jobs, args.path_script, n_workers=args.n_workers, name_log=name_log, verbose=args.verbose)
+    print(f"Done: {counts}") if args.verbose > 0 else None
+    sys.exit(1 if counts['failed'] > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,378 @@
+"""
+STATUS
+RH 2024
+
+Progress of the jobs of a dispatch (dir_save). Pure/native Python 3.
+
+Scans dir_save for job directories (those with a params.json) and reports,
+per job: state, Slurm job ID, runtime, peak memory and failure reason. The
+scan is incremental: a cache in dir_save (status_cache.json) keeps, per job
+directory, its mtime, its log files, and the parsed tail of its newest log.
+A job directory is only listed again if its mtime changed, and a log is only
+read again if its size or mtime changed. The result is joined with one
+squeue call (pending / running jobs and their reasons) and one sacct call
+(final state, elapsed time, MaxRSS).
+
+The Slurm job ID of a job is taken from the name of its newest log
+(print_log_{job id}.log or print_log_{array job id}_{index}.log), or from
+job_cache_index.json if it has no log yet or was submitted again after its
+log was last written.
+
+Usage:
+    python status.py /path/to/dir_save
+    python status.py /path/to/dir_save --state FAILED TIMEOUT OUT_OF_MEMORY
+    python status.py /path/to/dir_save --format json --no_slurm
+"""
+
+import argparse
+import getpass
+import json
+import os
+import re
+import subprocess
+import time
+from pathlib import Path
+
+import submitter
+
+
+## Lines in a log tail that explain why a job stopped: (regex, state)
+PATTERNS_FAILURE = [
+    (re.compile(r'DUE TO TIME LIMIT'), 'TIMEOUT'),
+    (re.compile(r'oom[-_]kill|Out Of Memory|OOM Killed', re.IGNORECASE), 'OUT_OF_MEMORY'),
+    (re.compile(r'DUE TO PREEMPTION'), 'PREEMPTED'),
+    (re.compile(r'\*\*\* (JOB|STEP) \S+ ON \S+ CANCELLED'), 'CANCELLED'),
+    (re.compile(r'CUDA out of memory'), 'FAILED'),
+    (re.compile(r'^\w+(Error|Exception)\b'), 'FAILED'),
+]
+## Slurm states of jobs that are done
+STATES_FINAL = {'COMPLETED', 'FAILED', 'TIMEOUT', 'OUT_OF_MEMORY', 'CANCELLED', 'PREEMPTED', 'NODE_FAIL', 'BOOT_FAIL', 'DEADLINE'}
+
+_re_log = re.compile(r'^print_log_(\d+(?:_\d+)?)\.log$')
+
+
+def parse_log_tail(path, n_bytes=8192):
+    """
+    Parses the end of a log file.
+    RH 2024
+
+    Args:
+        path (str):
+            Path to the log.
+        n_bytes (int):
+            Number of bytes read from the end of the file.
+
+    Returns:
+        (dict):
+            * state (str): State implied by the tail (see PATTERNS_FAILURE),
+              or None.\n
+            * reason (str): The line that matched, or None.\n
+            * last_line (str): Last non-empty line, to show progress.
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - n_bytes))
+        lines = [l.strip() for l in f.read().decode('utf-8', errors='replace').splitlines() if l.strip()]
+    out = {'state': None, 'reason': None, 'last_line': lines[-1][:200] if lines else None}
+    ## The last matching line is the most relevant (e.g. the exception at the end of a traceback)
+    for line in reversed(lines):
+        for pattern, state in PATTERNS_FAILURE:
+            if pattern.search(line):
+                out.update({'state': state, 'reason': line[:200]})
+                return out
+    return out
+
+
+def parse_elapsed(s):
+    """Converts a Slurm duration ('D-HH:MM:SS', 'HH:MM:SS' or 'MM:SS') to seconds."""
+    if not s or s in ['UNLIMITED', 'INVALID']:
+        return None
+    days, _, hms = s.rpartition('-')
+    parts = [float(p) for p in hms.split(':')]
+    while len(parts) < 3:
+        parts.insert(0, 0.0)
+    return int(days or 0) * 86400 + parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+
+def parse_mem(s):
+    """Converts a Slurm memory string (e.g. '1234K', '5.5G') to GB."""
+    if not s:
+        return None
+    units = {'K': 2**-20, 'M': 2**-10, 'G': 1, 'T': 2**10}
+    if s[-1] in units:
+        return float(s[:-1]) * units[s[-1]]
+    return float(s) / 2**30
+
+
+def expand_job_id(job_id):
+    """Expands an array job ID with a range, e.g. '12_[0-3%2]', to ['12_0', ..., '12_3']."""
+    if '_[' not in job_id:
+        return [job_id]
+    base, _, idx = job_id.partition('_[')
+    return [f'{base}_{i}' for i in submitter.parse_array_range(idx.rstrip(']'))]
+
+
+def snapshot_slurm(user=None, time_start=None):
+    """
+    Takes one snapshot of squeue and one of sacct.
+    RH 2024
+
+    Args:
+        user (str):
+            User name. Default is the current user.
+        time_start (float):
+            Unix time from which sacct reports jobs. Default is 30 days ago.
+
+    Returns:
+        (dict):
+            {job_id: info}, where info has: state, reason, elapsed (s),
+            max_rss_gb, exit_code. Jobs from squeue override jobs from
+            sacct. Empty if both calls failed.
+    """
+    user = getpass.getuser() if user is None else user
+    time_start = time.time() - 30 * 86400 if time_start is None else time_start
+    jobs = {}
+
+    def run(cmd):
+        try:
+            return subprocess.run(cmd, capture_output=True, text=True, timeout=120, check=True).stdout
+        except (OSError, subprocess.SubprocessError):
+            return ''
+
+    out = run([
+        'sacct', '-u', user, '--noheader', '--parsable2',
+        '-S', time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(time_start)),
+        '--format=JobID,State,Elapsed,MaxRSS,ExitCode',
+    ])
+    for line in out.splitlines():
+        fields = line.split('|')
+        if len(fields) < 5:
+            continue
+        job_id, state, elapsed, max_rss, exit_code = fields[:5]
+        job_id, _, step = job_id.partition('.')
+        for j in expand_job_id(job_id):
+            info = jobs.setdefault(j, {'state': None, 'reason': None, 'elapsed': None, 'max_rss_gb': None, 'exit_code': None})
+            if not step:  ## Allocation line: state and elapsed time
+                info.update({'state': state.split(' ')[0], 'elapsed': parse_elapsed(elapsed), 'exit_code': exit_code})
+            if max_rss:  ## Step lines (batch, extern, ...): peak memory
+                info['max_rss_gb'] = max(info['max_rss_gb'] or 0, parse_mem(max_rss))
+
+    out = run(['squeue', '-u', user, '--noheader', '--array', '--format=%i|%T|%M|%r'])
+    for line in out.splitlines():
+        fields = line.split('|')
+        if len(fields) < 4:
+            continue
+        job_id, state, elapsed, reason = fields[:4]
+        for j in expand_job_id(job_id):
+            info = jobs.setdefault(j, {'state': None, 'reason': None, 'elapsed': None, 'max_rss_gb': None, 'exit_code': None})
+            info.update({'state': state, 'reason': reason if reason not in ['None', '(null)'] else None, 'elapsed': parse_elapsed(elapsed)})
+    return jobs
+
+
+class StatusIndex:
+    """
+    Incremental index of the job directories in dir_save.
+    RH 2024
+
+    Args:
+        dir_save (str):
+            Outer directory of a dispatch.
+        verbose (int):
+            Verbosity level.
+    """
+    def __init__(self, dir_save, verbose=1):
+        self.dir_save = Path(dir_save).resolve()
+        self.path_cache = self.dir_save / 'status_cache.json'
+        self.verbose = verbose
+        self.cache = {}
+        if self.path_cache.exists():
+            try:
+                with open(self.path_cache, 'r') as f:
+                    self.cache = json.load(f)
+            except (OSError, ValueError):
+                self.cache = {}
+
+    def save(self):
+        """Writes the cache atomically."""
+        path_tmp = self.path_cache.with_suffix('.json.tmp')
+        with open(path_tmp, 'w') as f:
+            json.dump(self.cache, f)
+        os.replace(path_tmp, self.path_cache)
+
+    def _scan_job(self, path_dir, mtime_dir, entry):
+        """Updates the cache entry of one job directory. Returns the entry."""
+        if (entry is None) or (entry['mtime_dir'] != mtime_dir):
+            ## Directory changed (files added or removed): list it again
+            names = os.listdir(path_dir)
+            logs = sorted([n for n in names if _re_log.match(n)])
+            entry = {
+                'mtime_dir': mtime_dir,
+                'is_job': 'params.json' in names,
+                'logs': logs,
+                'log': (entry or {}).get('log'),
+                'status': (entry or {}).get('status'),
+            }
+        if not entry['is_job']:
+            return entry
+
+        ## Newest log: parse its tail only if it changed
+        logs = []
+        for name in entry['logs']:
+            try:
+                logs.append((os.stat(os.path.join(path_dir, name)).st_mtime_ns, name))
+            except FileNotFoundError:
+                continue
+        if logs:
+            mtime_log, name_log = max(logs)
+            size_log = os.stat(os.path.join(path_dir, name_log)).st_size
+            log = entry['log']
+            if (log is None) or (log['name'] != name_log) or (log['mtime'] != mtime_log) or (log['size'] != size_log):
+                entry['log'] = {'name': name_log, 'mtime': mtime_log, 'size': size_log, **parse_log_tail(os.path.join(path_dir, name_log))}
+        else:
+            entry['log'] = None
+
+        ## status.json, written by runner.py for packed jobs
+        path_status = os.path.join(path_dir, 'status.json')
+        try:
+            mtime_status = os.stat(path_status).st_mtime_ns
+            if (entry['status'] is None) or (entry['status']['mtime'] != mtime_status):
+                with open(path_status, 'r') as f:
+                    entry['status'] = {'mtime': mtime_status, **json.load(f)}
+        except (FileNotFoundError, ValueError):
+            entry['status'] = None
+        return entry
+
+    def scan(self):
+        """
+        Updates the cache from disk. Returns {name of job directory: entry}
+        for every job directory.
+        """
+        cache_new = {}
+        with os.scandir(self.dir_save) as it:
+            for d in it:
+                if (not d.is_dir()) or (d.name == 'arrays'):
+                    continue
+                cache_new[d.name] = self._scan_job(d.path, d.stat().st_mtime_ns, self.cache.get(d.name))
+        self.cache = cache_new
+        self.save()
+        return {name: entry for name, entry in cache_new.items() if entry['is_job']}
+
+    def _index_job_cache(self):
+        """Reads job_cache_index.json: {name of job directory: entry}."""
+        try:
+            with open(self.dir_save / 'job_cache_index.json', 'r') as f:
+                return {e['dir']: e for e in json.load(f)['jobs'].values()}
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def report(self, slurm=True, user=None, submissions={}):
+        """
+        Status of every job in dir_save.
+        RH 2024
+
+        Args:
+            slurm (bool):
+                If True, join with one squeue and one sacct snapshot.
+            user (str):
+                User name for squeue / sacct.
+            submissions (dict):
+                Submissions not recorded in job_cache_index.json (e.g. by
+                supervisor.py): {name of job directory: {'slurm_job_id':
+                str, 'time_submitted': float}}.
+
+        Returns:
+            (list of dict):
+                One dict per job, sorted by directory name: dir, state,
+                slurm_job_id, runtime (s), max_rss_gb, reason, log.
+        """
+        jobs = self.scan()
+        index = self._index_job_cache()
+        for name, submission in submissions.items():
+            if submission.get('time_submitted', 0) > index.get(name, {}).get('time_submitted', 0):
+                index[name] = {**index.get(name, {}), **submission}
+
+        ## Job ID of the newest log, unless the job was submitted again after the log was last written
+        ids = {}
+        for name, entry in jobs.items():
+            m = _re_log.match(entry['log']['name']) if entry['log'] else None
+            time_submitted = index.get(name, {}).get('time_submitted') or 0
+            if m and (entry['log']['mtime'] / 1e9 >= time_submitted):
+                ids[name] = m.group(1)
+            else:
+                ids[name] = index.get(name, {}).get('slurm_job_id') or (m.group(1) if m else None)
+        if slurm:
+            times = [e['time_submitted'] for e in index.values() if e.get('time_submitted')]
+            times += [entry['log']['mtime'] / 1e9 for entry in jobs.values() if entry['log']]
+            snapshot = snapshot_slurm(user=user, time_start=min(times) - 86400 if times else None)
+        else:
+            snapshot = {}
+
+        rows = []
+        for name in sorted(jobs):
+            entry, job_id = jobs[name], ids[name]
+            log, status = entry['log'] or {}, entry['status'] or {}
+            info = snapshot.get(job_id, {})
+            state, reason = info.get('state'), info.get('reason')
+
+            ## Packed jobs share an allocation: their own state is in status.json
+            if status.get('state') in ['complete', 'failed'] and state not in ['PENDING']:
+                state = 'COMPLETED' if status['state'] == 'complete' else 'FAILED'
+            if state is None:
+                if index.get(name, {}).get('status') == 'complete':
+                    state = 'COMPLETED'
+                elif log.get('state') is not None:
+                    state = log['state']
+                elif log:
+                    state = 'UNKNOWN'  ## Has a log but Slurm has no record of it
+                else:
+                    state = 'NOT_STARTED'
+            if (state in STATES_FINAL) and (state != 'COMPLETED') and (reason is None):
+                reason = log.get('reason') or (f"exit code {info['exit_code']}" if info.get('exit_code') else None)
+
+            runtime = info.get('elapsed')
+            if (runtime is None) and status.get('time_start'):
+                runtime = status.get('time_end', time.time()) - status['time_start']
+            rows.append({
+                'dir': name,
+                'state': state,
+                'slurm_job_id': job_id,
+                'runtime': runtime,
+                'max_rss_gb': info.get('max_rss_gb'),
+                'reason': reason,
+                'log': log.get('name'),
+                'last_line': log.get('last_line'),
+            })
+        return rows
+
+
+def format_table(rows):
+    """Formats report rows as a text table with a count per state."""
+    counts = {}
+    for row in rows:
+        counts[row['state']] = counts.get(row['state'], 0) + 1
+    lines = [f"{'dir':<40} {'state':<14} {'job id':<14} {'runtime':>9} {'peak GB':>8}  reason"]
+    for row in rows:
+        runtime = '{:.0f}:{:02.0f}:{:02.0f}'.format(row['runtime'] // 3600, row['runtime'] % 3600 // 60, row['runtime'] % 60) if row['runtime'] is not None else ''
+        max_rss = f"{row['max_rss_gb']:.1f}" if row['max_rss_gb'] is not None else ''
+        lines.append(f"{row['dir']:<40} {row['state']:<14} {str(row['slurm_job_id'] or ''):<14} {runtime:>9} {max_rss:>8}  {row['reason'] or ''}")
+    lines.append(f"{len(rows)} jobs: " + ', '.join([f'{n} {s}' for s, n in sorted(counts.items())]))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the status of the jobs of a dispatch.')
+    parser.add_argument('dir_save', type=str, help='Outer directory of the dispatch.')
+    parser.add_argument('--state', type=str, nargs='+', default=None, help='Only show jobs in these states (e.g. FAILED TIMEOUT).')
+    parser.add_argument('--format', type=str, default='table', choices=['table', 'json'], help='Output format.')
+    parser.add_argument('--no_slurm', action='store_true', help='Do not call squeue / sacct.')
+    parser.add_argument('--user', type=str, default=None, help='User name for squeue / sacct. Default is the current user.')
+    args = parser.parse_args()
+
+    rows = StatusIndex(args.dir_save).report(slurm=not args.no_slurm, user=args.user)
+    if args.state is not None:
+        rows = [row for row in rows if row['state'] in args.state]
+    print(format_table(rows) if args.format == 'table' else json.dumps(rows, indent=1))
+
+
+if __name__ == '__main__':
+    main()
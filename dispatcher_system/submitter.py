@@ -0,0 +1,318 @@
+"""
+SUBMITTER
+RH 2024
+
+Submits dispatcher jobs as Slurm job arrays. Pure/native Python 3.
+
+One sbatch script is rendered from a dict of #SBATCH directives plus setup
+lines. Jobs with the same directives (after their per-job overrides) are
+collapsed into one job array (--array=0-N%max_n_running) and submitted with
+one sbatch call. Each job's params are written to {dir_job}/params.json, and
+a jobs.txt file next to the array script maps $SLURM_ARRAY_TASK_ID to the
+job directory. Only one script is written per array, not one per job.
+
+Packing (pack_size > 1): short jobs can share one allocation. Each array
+task then gets pack_size jobs (one line of jobs.txt, tab separated), which
+runner.py runs from a local queue with n_workers concurrent processes. Set
+--time for the whole pack.
+
+Files of an array, in {dir_save}/arrays/{name_array}/:\n
+    * sbatch_array.sh: The sbatch script.\n
+    * jobs.txt: Job directory of each array index, one per line.\n
+    * A copy of the script that is run, so that a later dispatch cannot
+      change the script of pending tasks.\n
+    * slurm_{array job id}_{index}.log: Slurm output until the task's output
+      is redirected to {dir_job}/print_log_{array job id}_{index}.log.\n
+    * runner.py: If packing, a copy of the runner.\n
+    * submit.json: Directives, setup and packing of the array.\n
+
+Demo:
+    directives = {'--job-name': 'fr', '--partition': 'kempner_requeue', '--gres': 'gpu:1', '-c': 16, '--mem': '48GB', '--requeue': True}
+    setup = ['unset XDG_RUNTIME_DIR', f'source activate {name_env}']
+    jobs = [{'params': params, 'dir_job': dir_job} for ...]  ## optional 'directives' per job
+    arrays = submit_jobs(jobs, path_script, dir_save, directives, setup, max_n_running=50)
+"""
+
+import hashlib
+import json
+import shlex
+import shutil
+import subprocess
+import time
+from pathlib import Path
+
+
+def render_directives(directives):
+    """
+    Renders #SBATCH lines from a dict of directives. Long options are written
+    as '--key=value' and short options as '-k value'. A value of True writes
+    the flag alone (e.g. '--requeue'), and None or False leaves it out.
+    """
+    lines = []
+    for key, val in directives.items():
+        if (val is None) or (val is False):
+            continue
+        if val is True:
+            lines.append(f'#SBATCH {key}')
+        elif key.startswith('--'):
+            lines.append(f'#SBATCH {key}={val}')
+        else:
+            lines.append(f'#SBATCH {key} {val}')
+    return lines
+
+
+def render_script(directives, setup, path_jobs, path_script, path_runner=None, n_workers=1):
+    """
+    Renders the sbatch script of a job array.
+    RH 2024
+
+    Args:
+        directives (dict):
+            #SBATCH directives. See render_directives.
+        setup (list of str):
+            Shell lines run before the script (e.g. activating an
+            environment).
+        path_jobs (str):
+            Path to the jobs.txt file: the job directories of each array
+            index, one line per index (tab separated).
+        path_script (str):
+            Path to the Python script. It is called with --path_params and
+            --directory_save, like util.batch_run does.
+        path_runner (str):
+            Path to runner.py. If None, each array index runs one job
+            directly. If given, each array index runs its line of jobs.txt
+            with the runner.
+        n_workers (int):
+            Number of jobs the runner runs at once.
+
+    Returns:
+        (str):
+            The sbatch script.
+    """
+    if path_runner is None:
+        lines_job = [
+            '## Job directory of this array index',
+            f'DIR_JOB=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" {shlex.quote(str(path_jobs))})',
+            'exec > "$DIR_JOB/print_log_${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}.log" 2>&1',
+            '',
+            *setup,
+            '',
+            'echo "starting job in $DIR_JOB"',
+            f'python {shlex.quote(str(path_script))} --path_params "$DIR_JOB/params.json" --directory_save "$DIR_JOB"',
+        ]
+    else:
+        lines_job = [
+            *setup,
+            '',
+            '## Run the jobs of this array index. Each job prints to $DIR_JOB/print_log_${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}.log',
+            f'python {shlex.quote(str(path_runner))} --path_jobs {shlex.quote(str(path_jobs))} --index "$SLURM_ARRAY_TASK_ID" --path_script {shlex.quote(str(path_script))} --n_workers {int(n_workers)}',
+        ]
+    lines = [
+        '#!/usr/bin/bash',
+        *render_directives(directives),
+        '',
+        *lines_job,
+        '',
+    ]
+    return '\n'.join(lines)
+
+
+def parse_array_range(s):
+    """
+    Parses a Slurm array index expression, e.g. '0-9%5', '3,5-7' or '4', into
+    a list of indices. Any throttle ('%N') is ignored. Returns [] for 'N/A'.
+    """
+    s = s.split('%')[0].strip()
+    if s in ['', 'N/A']:
+        return []
+    idx = []
+    for token in s.split(','):
+        if '-' in token:
+            start, end = token.split('-')
+            step = 1
+            if ':' in end:
+                end, step = end.split(':')
+            idx.extend(range(int(start), int(end) + 1, int(step)))
+        else:
+            idx.append(int(token))
+    return idx
+
+
+def group_jobs(jobs, directives):
+    """
+    Groups jobs with the same directives (after their per-job overrides) so
+    that each group can be one job array.
+
+    Args:
+        jobs (list of dict):
+            Jobs. Each may have a 'directives' dict of overrides.
+        directives (dict):
+            Directives shared by all jobs.
+
+    Returns:
+        (list of tuple):
+            (directives, jobs) of each group, in order of first appearance.
+    """
+    groups = {}
+    for job in jobs:
+        directives_job = {**directives, **job.get('directives', {})}
+        key = json.dumps(directives_job, sort_keys=True, default=str)
+        groups.setdefault(key, (directives_job, []))[1].append(job)
+    return list(groups.values())
+
+
+def sbatch(path_sbatch):
+    """Submits an sbatch script and returns the Slurm job ID (str)."""
+    out = subprocess.run(
+        ['sbatch', '--parsable', str(path_sbatch)],
+        capture_output=True, text=True, timeout=120, check=True,
+    ).stdout
+    return out.strip().split(';')[0]  ## --parsable returns 'jobid' or 'jobid;cluster'
+
+
+def submit_jobs(
+    jobs,
+    path_script,
+    dir_save,
+    directives,
+    setup=[],
+    max_n_running=None,
+    max_array_size=1000,
+    pack_size=1,
+    n_workers=1,
+    name='array',
+    dry_run=False,
+    verbose=1,
+):
+    """
+    Submits jobs as Slurm job arrays: one array (and one sbatch call) per
+    group of jobs with the same directives.
+    RH 2024
+
+    Args:
+        jobs (list of dict):
+            Jobs to submit. Each has:\n
+                * params (dict): Params, written to {dir_job}/params.json.\n
+                * dir_job (str): Directory of the job.\n
+                * directives (dict, optional): Overrides of directives for
+                  this job.\n
+            'slurm_job_id' ('{array job id}_{index}') is set on each job
+            after it is submitted. Jobs packed together share an index.
+        path_script (str):
+            Path to the Python script to run.
+        dir_save (str):
+            Outer directory. Arrays are written to {dir_save}/arrays/.
+        directives (dict):
+            #SBATCH directives shared by all jobs. '--array' and '--output'
+            are set by this function.
+        setup (list of str):
+            Shell lines run before the script.
+        max_n_running (int):
+            Maximum number of tasks of each array running at once
+            (--array=0-N%max_n_running). None for no limit.
+        max_array_size (int):
+            Maximum number of tasks per array. Must not exceed the cluster's
+            MaxArraySize (1001 by default). Larger groups are split.
+        pack_size (int):
+            Number of jobs per array task (one allocation). If > 1, the jobs
+            of a task are run by runner.py. The jobs of a group are split
+            into packs in order.
+        n_workers (int):
+            If packing, number of jobs of a pack run at once. Jobs share the
+            allocation's CPUs, memory and GPUs, so set the directives for
+            n_workers jobs and --time for the whole pack.
+        name (str):
+            Prefix of the array directory names.
+        dry_run (bool):
+            If True, write all files but do not call sbatch.
+        verbose (int):
+            Verbosity level.
+
+    Returns:
+        (list of dict):
+            One dict per array: dir_array, path_sbatch, n_jobs, n_tasks and
+            slurm_job_id (None if dry_run).
+    """
+    dir_arrays = Path(dir_save).resolve() / 'arrays'
+    stamp = time.strftime('%Y%m%d_%H%M%S')
+    arrays = []
+    for directives_group, jobs_group in group_jobs(jobs, directives):
+        packs_group = [jobs_group[i:i + pack_size] for i in range(0, len(jobs_group), pack_size)]
+        for i_start in range(0, len(packs_group), max_array_size):
+            packs = packs_group[i_start:i_start + max_array_size]
+            jobs_array = [job for pack in packs for job in pack]
+            ## Name arrays by their jobs, so that names are unique within a dispatch
+            hash_array = hashlib.sha256('\n'.join([str(job['dir_job']) for job in jobs_array]).encode()).hexdigest()[:8]
+            dir_array = dir_arrays / f'{name}_{stamp}_{hash_array}'
+            n_exists = 0
+            while dir_array.exists():  ## Same jobs dispatched twice within a second
+                n_exists += 1
+                dir_array = dir_arrays / f'{name}_{stamp}_{hash_array}_{n_exists}'
+            dir_array.mkdir(parents=True)
+
+            path_script_array = dir_array / Path(path_script).name
+            shutil.copyfile(path_script, path_script_array)
+            path_runner_array = None
+            if pack_size > 1:
+                path_runner_array = dir_array / 'runner.py'
+                shutil.copyfile(Path(__file__).resolve().parent / 'runner.py', path_runner_array)
+            for job in jobs_array:
+                Path(job['dir_job']).mkdir(parents=True, exist_ok=True)
+                with open(Path(job['dir_job']) / 'params.json', 'w') as f:
+                    json.dump(job['params'], f)
+            path_jobs = dir_array / 'jobs.txt'
+            with open(path_jobs, 'w') as f:
+                f.write(''.join(['\t'.join([str(Path(job['dir_job']).resolve()) for job in pack]) + '\n' for pack in packs]))
+
+            throttle = f'%{max_n_running}' if max_n_running is not None else ''
+            directives_array = {
+                **directives_group,
+                '--array': f'0-{len(packs) - 1}{throttle}',
+                '--output': str(dir_array / 'slurm_%A_%a.log'),
+            }
+            path_sbatch = dir_array / 'sbatch_array.sh'
+            with open(path_sbatch, 'w') as f:
+                f.write(render_script(directives_array, setup, path_jobs, path_script_array, path_runner=path_runner_array, n_workers=n_workers))
+            ## Settings of the array, to resubmit its jobs the same way (see supervisor.py)
+            with open(dir_array / 'submit.json', 'w') as f:
+                json.dump({
+                    'directives': directives_group,
+                    'setup': setup,
+                    'path_script': str(path_script_array),
+                    'max_n_running': max_n_running,
+                    'pack_size': pack_size,
+                    'n_workers': n_workers,
+                }, f, indent=1)
+
+            slurm_job_id = None if dry_run else sbatch(path_sbatch)
+            for i_task, pack in enumerate(packs):
+                for job in pack:
+                    job['slurm_job_id'] = f'{slurm_job_id}_{i_task}' if slurm_job_id is not None else None
+            print(f"{'Wrote' if dry_run else 'Submitted'} array {slurm_job_id} with {len(jobs_array)} jobs in {len(packs)} tasks: {path_sbatch}") if verbose > 0 else None
+            arrays.append({'dir_array': str(dir_array), 'path_sbatch': str(path_sbatch), 'n_jobs': len(jobs_array), 'n_tasks': len(packs), 'slurm_job_id': slurm_job_id})
+    return arrays
+
+
+def read_arrays(dir_save):
+    """
+    Finds the latest array of each job in {dir_save}/arrays.
+
+    Returns:
+        (dict):
+            {resolved job directory: array directory}. Arrays are read in
+            order of submission (mtime of jobs.txt), so later arrays
+            override earlier ones.
+    """
+    arrays = {}
+    dir_arrays = Path(dir_save).resolve() / 'arrays'
+    if not dir_arrays.exists():
+        return arrays
+    paths_jobs = sorted([(p.stat().st_mtime_ns, p) for p in dir_arrays.glob('*/jobs.txt')])
+    for _, path_jobs in paths_jobs:
+        dir_array = path_jobs.parent
+        with open(path_jobs, 'r') as f:
+            for line in f:
+                for dir_job in line.rstrip('\n').split('\t'):
+                    if dir_job:
+                        arrays[dir_job] = str(dir_array)
+    return arrays
@@ -0,0 +1,318 @@
+"""
+SUPERVISOR
+RH 2024
+
+Requeue-and-resume for dispatcher jobs. Pure/native Python 3.
+
+Jobs on preemptible partitions (e.g. kempner_requeue) are killed and
+restarted, and a restarted face-rhythm run redoes every step in
+params['steps']. Each step saves its output in the project directory
+(analysis_files/<module>.h5, see job_cache.STEP_OUTPUTS), so a job only needs
+the steps that have no output yet. Each tick, the supervisor:\n
+    1. Takes the status of every job (status.StatusIndex: one sacct and one
+       squeue call).\n
+    2. For each unfinished job, finds the steps whose outputs exist and
+       rewrites {dir_job}/params.json with only the remaining steps (the
+       original is kept in params_original.json). A job that Slurm requeues
+       itself (--requeue) reads the trimmed params when it restarts.\n
+    3. Resubmits jobs that ended in states_resubmit (PREEMPTED, TIMEOUT,
+       NODE_FAIL, ...) and are not queued, with the settings of the array
+       they were last submitted in (arrays/*/submit.json). All resubmitted
+       jobs with the same settings share one array.\n
+State (resubmissions, preemptions, events) is kept in
+{dir_save}/supervisor_state.json.
+
+Steps that build objects in memory that later steps use are kept when a
+later step remains (STEP_REQUIRES): point_tracking uses the videos and ROIs
+loaded by load_videos and ROIs, while VQT and TCA load their inputs from
+disk.
+
+Usage:
+    python supervisor.py /path/to/dir_save --interval 600
+    python supervisor.py /path/to/dir_save --once --dry_run
+"""
+
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+import job_cache
+import status
+import submitter
+
+
+## Steps that need the in-memory results of earlier steps: {step: [steps it needs]}
+STEP_REQUIRES = {
+    'point_tracking': ['load_videos', 'ROIs'],
+}
+## States in which a job is resubmitted
+STATES_RESUBMIT = ['PREEMPTED', 'TIMEOUT', 'NODE_FAIL', 'BOOT_FAIL']
+## States in which a job is still queued or running
+STATES_ACTIVE = ['PENDING', 'CONFIGURING', 'RUNNING', 'COMPLETING', 'REQUEUED', 'RESIZING', 'SUSPENDED']
+
+
+def step_patterns(step_outputs=None):
+    """
+    Makes the output marker (glob pattern relative to the job directory) of
+    each step. Values of step_outputs that are file names are searched for in
+    any analysis_files directory; values with a '/' are used as they are.
+    """
+    step_outputs = job_cache.STEP_OUTPUTS if step_outputs is None else step_outputs
+    return {step: (out if '/' in out else f'**/analysis_files/{out}') for step, out in step_outputs.items()}
+
+
+def steps_remaining(dir_job, steps, patterns, step_requires=STEP_REQUIRES):
+    """
+    Finds the steps of a job that still need to run.
+    RH 2024
+
+    Args:
+        dir_job (str):
+            Directory of the job.
+        steps (list of str):
+            All steps of the job, in order.
+        patterns (dict):
+            Output marker of each step. See step_patterns. Steps without a
+            marker are never considered done.
+        step_requires (dict):
+            Steps that must run again with a step that remains.
+
+    Returns:
+        (list of str):
+            Remaining steps, in their original order. Empty if all are done.
+    """
+    dir_job = Path(dir_job)
+
+    def is_done(step):
+        if step not in patterns:
+            return False
+        return any(p.stat().st_size > 0 for p in dir_job.glob(patterns[step]))
+
+    ## Resume from the first step without output; later outputs may be stale
+    idx_first = next((i for i, step in enumerate(steps) if not is_done(step)), len(steps))
+    remaining = set(steps[idx_first:])
+    for step in list(remaining):
+        remaining.update(step_requires.get(step, []))
+    return [step for step in steps if step in remaining]
+
+
+def trim_params(dir_job, patterns, step_requires=STEP_REQUIRES, dry_run=False):
+    """
+    Rewrites {dir_job}/params.json with only the remaining steps. The
+    original params are kept in params_original.json and are always the
+    reference, so steps are never lost.
+
+    Returns:
+        (list of str or None):
+            Remaining steps. None if the params have no 'steps'.
+    """
+    dir_job = Path(dir_job)
+    path_params, path_original = dir_job / 'params.json', dir_job / 'params_original.json'
+    with open(path_original if path_original.exists() else path_params, 'r') as f:
+        params = json.load(f)
+    if 'steps' not in params:
+        return None
+    with open(path_params, 'r') as f:
+        steps_current = json.load(f)['steps']
+    remaining = steps_remaining(dir_job, params['steps'], patterns, step_requires)
+    if (remaining != steps_current) and (len(remaining) > 0) and (not dry_run):
+        if not path_original.exists():
+            os.replace(path_params, path_original)
+        path_tmp = dir_job / 'params.json.tmp'
+        with open(path_tmp, 'w') as f:
+            json.dump({**params, 'steps': remaining}, f)
+        os.replace(path_tmp, path_params)
+    return remaining
+
+
+class Supervisor:
+    """
+    Trims and resubmits the unfinished jobs of a dispatch.
+    RH 2024
+
+    Args:
+        dir_save (str):
+            Outer directory of the dispatch.
+        states_resubmit (list of str):
+            Slurm states in which a job is resubmitted. Add 'FAILED' or
+            'OUT_OF_MEMORY' to also retry those.
+        max_resubmits (int):
+            Maximum number of resubmissions of a job.
+        step_outputs (dict):
+            Output file (or glob pattern) of each step. Default is
+            job_cache.STEP_OUTPUTS.
+        step_requires (dict):
+            Steps that must run again with a step that remains.
+        dry_run (bool):
+            If True, report what would be done without changing anything.
+        verbose (int):
+            Verbosity level.
+    """
+    def __init__(
+        self,
+        dir_save,
+        states_resubmit=STATES_RESUBMIT,
+        max_resubmits=3,
+        step_outputs=None,
+        step_requires=STEP_REQUIRES,
+        dry_run=False,
+        verbose=1,
+    ):
+        self.dir_save = Path(dir_save).resolve()
+        self.states_resubmit = list(states_resubmit)
+        self.max_resubmits = max_resubmits
+        self.patterns = step_patterns(step_outputs)
+        self.step_requires = step_requires
+        self.dry_run = dry_run
+        self.verbose = verbose
+
+        self.status_index = status.StatusIndex(self.dir_save, verbose=verbose)
+        self.path_state = self.dir_save / 'supervisor_state.json'
+        self.state = {'jobs': {}}
+        if self.path_state.exists():
+            with open(self.path_state, 'r') as f:
+                self.state = json.load(f)
+
+    def save(self):
+        """Writes the state atomically."""
+        if self.dry_run:
+            return
+        path_tmp = self.path_state.with_suffix('.json.tmp')
+        with open(path_tmp, 'w') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(path_tmp, self.path_state)
+
+    def _record(self, name, event, **kwargs):
+        job = self.state['jobs'].setdefault(name, {'n_resubmits': 0, 'n_preemptions': 0, 'events': []})
+        job['events'].append({'time': time.time(), 'event': event, **kwargs})
+        return job
+
+    def tick(self):
+        """
+        Runs one supervision cycle.
+
+        Returns:
+            (dict):
+                Number of jobs per action: complete, active, trimmed,
+                resubmitted, given_up, other.
+        """
+        submissions = {name: job['submission'] for name, job in self.state['jobs'].items() if 'submission' in job}
+        rows = self.status_index.report(submissions=submissions)
+        arrays = submitter.read_arrays(self.dir_save)
+
+        counts = {'complete': 0, 'active': 0, 'trimmed': 0, 'resubmitted': 0, 'given_up': 0, 'other': 0}
+        to_resubmit = {}  ## {dir_array: [job, ...]}
+        for row in rows:
+            name, state = row['dir'], row['state']
+            if state == 'COMPLETED':
+                counts['complete'] += 1
+                continue
+            dir_job = self.dir_save / name
+            job = self.state['jobs'].get(name, {})
+            if (state == 'PREEMPTED') and (job.get('last_preempted') != row['slurm_job_id']):
+                job = self._record(name, 'preempted', slurm_job_id=row['slurm_job_id'])
+                job['n_preemptions'] += 1
+                job['last_preempted'] = row['slurm_job_id']
+
+            steps_before = job.get('steps_remaining')
+            remaining = trim_params(dir_job, self.patterns, self.step_requires, dry_run=self.dry_run)
+            if remaining is not None and len(remaining) == 0:
+                counts['complete'] += 1
+                continue
+            is_trimmed = (steps_before is not None) or (dir_job / 'params_original.json').exists()
+            if (remaining is not None) and (remaining != steps_before) and is_trimmed:
+                self._record(name, 'trimmed', steps=remaining)['steps_remaining'] = remaining
+                counts['trimmed'] += 1
+
+            if state in STATES_ACTIVE:
+                counts['active'] += 1
+            elif state in self.states_resubmit:
+                if job.get('n_resubmits', 0) >= self.max_resubmits:
+                    if job.get('given_up') != row['slurm_job_id']:
+                        self._record(name, 'given_up', state=state)['given_up'] = row['slurm_job_id']
+                    counts['given_up'] += 1
+                elif str(dir_job) not in arrays:
+                    print(f"No array found for {name}; cannot resubmit it.") if self.verbose > 0 else None
+                    counts['other'] += 1
+                else:
+                    with open(dir_job / 'params.json', 'r') as f:
+                        params = json.load(f)
+                    to_resubmit.setdefault(arrays[str(dir_job)], []).append({'name': name, 'params': params, 'dir_job': str(dir_job), 'state': state})
+            else:
+                counts['other'] += 1
+
+        ## One submission per array configuration
+        for dir_array, jobs in to_resubmit.items():
+            with open(Path(dir_array) / 'submit.json', 'r') as f:
+                config = json.load(f)
+            if self.dry_run:
+                print(f"Would resubmit {len(jobs)} jobs: {[job['name'] for job in jobs]}") if self.verbose > 0 else None
+                continue
+            submitter.submit_jobs(
+                jobs=jobs,
+                path_script=config['path_script'],
+                dir_save=self.dir_save,
+                directives=config['directives'],
+                setup=config['setup'],
+                max_n_running=config['max_n_running'],
+                pack_size=config['pack_size'],
+                n_workers=config['n_workers'],
+                name='resubmit',
+                verbose=self.verbose,
+            )
+            for job in jobs:
+                job_state = self._record(job['name'], 'resubmitted', state=job['state'], slurm_job_id=job['slurm_job_id'])
+                job_state['n_resubmits'] += 1
+                job_state['submission'] = {'slurm_job_id': job['slurm_job_id'], 'time_submitted': time.time()}
+            counts['resubmitted'] += len(jobs)
+
+        self.save()
+        print(f"Supervisor: {counts}") if self.verbose > 0 else None
+        return counts
+
+    def run(self, interval=600, max_ticks=None):
+        """
+        Runs ticks every interval seconds until no job is active or
+        resubmitted, or max_ticks is reached.
+        """
+        i_tick = 0
+        while True:
+            counts = self.tick()
+            i_tick += 1
+            if (counts['active'] + counts['resubmitted'] == 0) or ((max_ticks is not None) and (i_tick >= max_ticks)):
+                return counts
+            time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Resume and resubmit preempted dispatcher jobs with only their remaining steps.')
+    parser.add_argument('dir_save', type=str, help='Outer directory of the dispatch.')
+    parser.add_argument('--interval', type=float, default=600, help='Seconds between ticks.')
+    parser.add_argument('--once', action='store_true', help='Run one tick and exit.')
+    parser.add_argument('--states_resubmit', type=str, nargs='+', default=STATES_RESUBMIT, help='Slurm states in which a job is resubmitted.')
+    parser.add_argument('--max_resubmits', type=int, default=3, help='Maximum number of resubmissions of a job.')
+    parser.add_argument('--step_outputs', type=str, default=None, help='JSON dict of the output file (or glob pattern) of each step. Default is job_cache.STEP_OUTPUTS.')
+    parser.add_argument('--step_requires', type=str, default=None, help='JSON dict of the steps that must run again with a step. Default is STEP_REQUIRES.')
+    parser.add_argument('--dry_run', action='store_true', help='Report what would be done without changing anything.')
+    parser.add_argument('--verbose', type=int, default=1, help='Verbosity level.')
+    args = parser.parse_args()
+
+    supervisor = Supervisor(
+        dir_save=args.dir_save,
+        states_resubmit=args.states_resubmit,
+        max_resubmits=args.max_resubmits,
+        step_outputs=json.loads(args.step_outputs) if args.step_outputs is not None else None,
+        step_requires=json.loads(args.step_requires) if args.step_requires is not None else STEP_REQUIRES,
+        dry_run=args.dry_run,
+        verbose=args.verbose,
+    )
+    if args.once:
+        supervisor.tick()
+    else:
+        supervisor.run(interval=args.interval)
+
+
+if __name__ == '__main__':
+    main()
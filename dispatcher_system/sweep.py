@@ -0,0 +1,417 @@
+"""
+SWEEP
+RH 2024
+
+Parameter sweeps for dispatcher.py. Pure/native Python 3.
+
+A sweep is a lazy, restartable sequence of 'overrides': dicts mapping a
+nested key path (a tuple of keys, or a dotted string like
+'TCA.fit.params_method.rank') to a value. Overrides are applied to a
+params_template to make the params dict of each job. Sweeps are combined with
+product (every combination) and zip (element-wise), and can be sampled
+randomly or with a Latin hypercube. Nothing is materialized: a product of
+sweeps needs memory proportional to the sum of their lengths, not the
+product, and configs are made one at a time as they are written.
+
+Demo:
+    sweep = product(
+        grid('TCA.fit.params_method.rank', [5, 10, 20]),
+        zip_(
+            grid('PointTracker.params_optical_flow.mesh_rigidity', [0.001, 0.005, 0.01]),
+            grid('PointTracker.params_optical_flow.relaxation', [0.0005, 0.001, 0.002]),
+        ),
+    )
+    write_sweep(dir_save, params_template, sweep)  ## 9 jobs
+    for params in iter_params(params_template, sweep):
+        ...
+"""
+
+import itertools
+import json
+import math
+import random
+from pathlib import Path
+
+
+def as_key_path(key):
+    """
+    Converts a key to a tuple of nested keys. Strings are split on '.', so
+    'a.b.c' -> ('a', 'b', 'c'). Tuples and lists are returned as tuples.
+    """
+    if isinstance(key, str):
+        return tuple(key.split('.'))
+    return tuple(key)
+
+
+def deep_update_dict(dictionary, key, val, in_place=False):
+    """
+    Sets a value in a nested dictionary.\n
+    Unless in_place is True, the input is not modified: only the dicts along
+    the key path are (shallow) copied, and all other sub-dicts are shared
+    with the input. This makes a config in time and memory proportional to
+    the depth of the key, not the size of the dictionary.
+    RH 2024
+
+    Args:
+        dictionary (dict):
+            Nested dictionary.
+        key (tuple or str):
+            Path of keys to the value to set. See as_key_path.
+        val (any):
+            Value to set.
+        in_place (bool):
+            If True, modify the input dictionary.
+
+    Returns:
+        (dict):
+            Updated dictionary.
+    """
+    key = as_key_path(key)
+    d_out = dictionary if in_place else dict(dictionary)
+    d = d_out
+    for k in key[:-1]:
+        assert isinstance(d.get(k), dict), f"Key {k} of {key} is not a dict in the dictionary."
+        d[k] = d[k] if in_place else dict(d[k])
+        d = d[k]
+    d[key[-1]] = val
+    return d_out
+
+
+def deep_get(dictionary, key, default=None):
+    """Gets a value from a nested dictionary. Returns default if it is missing."""
+    d = dictionary
+    for k in as_key_path(key):
+        if not isinstance(d, dict) or k not in d:
+            return default
+        d = d[k]
+    return d
+
+
+def flatten_list(l):
+    """Flattens a list of lists by one level."""
+    return [item for sublist in l for item in sublist]
+
+
+class Sweep:
+    """
+    Lazy, restartable sequence of overrides ({key_path: value} dicts).
+    Iterating a Sweep calls its factory, so a Sweep can be iterated many
+    times and yields the same overrides each time.
+    RH 2024
+
+    Args:
+        factory (callable):
+            Function with no arguments that returns an iterator of
+            overrides.
+        length (int):
+            Number of overrides. None if unknown.
+    """
+    def __init__(self, factory, length=None):
+        self.factory = factory
+        self.length = length
+
+    def __iter__(self):
+        return iter(self.factory())
+
+    def __len__(self):
+        if self.length is None:
+            raise TypeError("Length of this sweep is unknown.")
+        return self.length
+
+    def __mul__(self, other):
+        return product(self, other)
+
+    def __add__(self, other):
+        return chain(self, other)
+
+
+def single(overrides={}):
+    """Sweep with a single point. With no overrides, it runs the template as is."""
+    overrides = {as_key_path(k): v for k, v in overrides.items()}
+    return Sweep(lambda: iter([dict(overrides)]), length=1)
+
+
+def grid(key, values):
+    """Sweep of one key over a list of values."""
+    key, values = as_key_path(key), list(values)
+    return Sweep(lambda: ({key: v} for v in values), length=len(values))
+
+
+def product(*sweeps):
+    """
+    Sweep over every combination of the points of several sweeps. The last
+    sweep varies fastest. Inner sweeps are re-iterated rather than stored.
+    """
+    if len(sweeps) == 0:
+        return single()
+    def factory(sweeps=sweeps):
+        if len(sweeps) == 1:
+            yield from sweeps[0]
+            return
+        for o in sweeps[0]:
+            for o_rest in factory(sweeps[1:]):
+                yield {**o, **o_rest}
+    lengths = [s.length for s in sweeps]
+    return Sweep(factory, length=math.prod(lengths) if None not in lengths else None)
+
+
+def zip_(*sweeps):
+    """
+    Sweep over the points of several sweeps element-wise. All sweeps must
+    have the same length.
+    """
+    lengths = [s.length for s in sweeps]
+    assert len({l for l in lengths if l is not None}) <= 1, f"Sweeps must have the same length to be zipped. Found lengths {lengths}."
+    def factory():
+        for os in zip(*sweeps, strict=True):
+            yield {k: v for o in os for k, v in o.items()}
+    return Sweep(factory, length=lengths[0] if len(sweeps) > 0 else 0)
+
+
+def chain(*sweeps):
+    """Sweep over the points of several sweeps one after the other."""
+    lengths = [s.length for s in sweeps]
+    return Sweep(lambda: itertools.chain(*sweeps), length=sum(lengths) if None not in lengths else None)
+
+
+def _sampler(spec):
+    """
+    Returns a function of a random.Random that draws one value from spec:\n
+        * list: A random element.\n
+        * tuple (low, high): Uniform float in [low, high]. Integers if both
+          are ints.\n
+        * tuple ('log', low, high): Log-uniform float in [low, high].\n
+        * callable: Called with the random.Random.
+    """
+    if callable(spec):
+        return spec
+    elif isinstance(spec, list):
+        return lambda rng: rng.choice(spec)
+    elif isinstance(spec, tuple) and len(spec) == 3 and spec[0] == 'log':
+        return lambda rng: math.exp(rng.uniform(math.log(spec[1]), math.log(spec[2])))
+    elif isinstance(spec, tuple) and len(spec) == 2:
+        if all([isinstance(v, int) for v in spec]):
+            return lambda rng: rng.randint(spec[0], spec[1])
+        return lambda rng: rng.uniform(spec[0], spec[1])
+    raise ValueError(f"Cannot sample from {spec}. Use a list, (low, high), ('log', low, high) or a callable.")
+
+
+def random_sample(specs, n, seed=0):
+    """
+    Sweep of n random points. Each key is sampled independently.
+    RH 2024
+
+    Args:
+        specs (dict):
+            {key: spec}. See _sampler for the spec formats.
+        n (int):
+            Number of points.
+        seed (int):
+            Random seed. The same seed gives the same points every time the
+            sweep is iterated.
+    """
+    samplers = {as_key_path(k): _sampler(v) for k, v in specs.items()}
+    def factory():
+        rng = random.Random(seed)
+        for _ in range(n):
+            yield {k: s(rng) for k, s in samplers.items()}
+    return Sweep(factory, length=n)
+
+
+def latin_hypercube(specs, n, seed=0):
+    """
+    Sweep of n points from a Latin hypercube: the range of each key is split
+    into n equal strata and each stratum is sampled exactly once, so the
+    points cover every key's range evenly. Memory is proportional to
+    n * number of keys.
+    RH 2024
+
+    Args:
+        specs (dict):
+            {key: spec}. spec is (low, high), ('log', low, high) or a list of
+            discrete values (strata are mapped to list elements).
+        n (int):
+            Number of points.
+        seed (int):
+            Random seed.
+    """
+    keys = [as_key_path(k) for k in specs]
+    specs = list(specs.values())
+    def to_value(spec, u):
+        if isinstance(spec, list):
+            return spec[min(int(u * len(spec)), len(spec) - 1)]
+        elif isinstance(spec, tuple) and len(spec) == 3 and spec[0] == 'log':
+            return math.exp(math.log(spec[1]) + u * (math.log(spec[2]) - math.log(spec[1])))
+        elif isinstance(spec, tuple) and len(spec) == 2:
+            v = spec[0] + u * (spec[1] - spec[0])
+            return int(round(v)) if all([isinstance(s, int) for s in spec]) else v
+        raise ValueError(f"Cannot sample from {spec}. Use a list, (low, high) or ('log', low, high).")
+    def factory():
+        rng = random.Random(seed)
+        perms = []
+        for _ in keys:
+            perm = list(range(n))
+            rng.shuffle(perm)
+            perms.append(perm)
+        for i in range(n):
+            yield {k: to_value(spec, (perm[i] + rng.random()) / n) for k, spec, perm in zip(keys, specs, perms)}
+    return Sweep(factory, length=n)
+
+
+def apply_overrides(params_template, overrides):
+    """
+    Returns params_template with the overrides applied. Sub-dicts that are
+    not overridden are shared with params_template (see deep_update_dict).
+    """
+    params = params_template
+    for key, val in overrides.items():
+        params = deep_update_dict(params, key, val)
+    return params
+
+
+def iter_params(params_template, sweep):
+    """
+    Yields the params dict of each point of a sweep, one at a time.\n
+    Params share the sub-dicts that are not overridden with params_template,
+    so they should not be modified in place (use copy.deepcopy first).
+    """
+    for overrides in sweep:
+        yield apply_overrides(params_template, overrides)
+
+
+def key_to_str(key):
+    """Converts a key path to a dotted string, e.g. ('a', 'b') -> 'a.b'."""
+    return '.'.join([str(k) for k in as_key_path(key)])
+
+
+def write_sweep(dir_save, params_template, sweep, name='parameters_batch', check=True, verbose=0):
+    """
+    Writes the params of every point of a sweep, one line at a time, and the
+    unchanging / changing params, in a single pass over the sweep.
+    RH 2024
+
+    Files written to dir_save:\n
+        * {name}.jsonl: One full params dict per line, in job order.\n
+        * {name}_changing.jsonl: One line per job with the values of every
+          key that differs from params_template in any job
+          ({dotted_key: value}), including jobs where the value equals the
+          template.\n
+        * {name}_unchanging.json: params_template without the keys that
+          change across jobs.\n
+    Only the overridden keys are compared, so the diff costs
+    O(number of swept keys) per job, and memory does not grow with the
+    number of jobs. The overrides are spooled to the changing file and
+    rewritten once the changing keys are known.
+
+    Args:
+        dir_save (str):
+            Directory in which to save the files.
+        params_template (dict):
+            Params shared by all jobs.
+        sweep (Sweep or iterable):
+            Overrides of each job.
+        name (str):
+            Prefix of the file names.
+        check (bool):
+            If True, check that the unchanging params with each line of the
+            changing file rebuild the params of that job exactly (see
+            check_sweep).
+        verbose (int):
+            Verbosity level.
+
+    Returns:
+        (dict):
+            * n_jobs (int): Number of jobs written.\n
+            * keys_changing (list): Dotted keys that change across jobs.\n
+            * paths (dict): Paths of the written files.
+    """
+    dir_save = Path(dir_save)
+    dir_save.mkdir(parents=True, exist_ok=True)
+    paths = {
+        'params': str(dir_save / f'{name}.jsonl'),
+        'changing': str(dir_save / f'{name}_changing.jsonl'),
+        'unchanging': str(dir_save / f'{name}_unchanging.json'),
+    }
+    path_spool = paths['changing'] + '.tmp'
+    keys_changing = {}  ## {key_path: None}. Ordered set.
+    n_jobs = 0
+    ## Pass over the sweep: write the params and spool the overrides of each job
+    with open(paths['params'], 'w') as f_params, open(path_spool, 'w') as f_spool:
+        for overrides in sweep:
+            overrides = {as_key_path(key): val for key, val in overrides.items()}
+            params = apply_overrides(params_template, overrides)
+            for key, val in overrides.items():
+                if deep_get(params_template, key, default=_missing) != val:
+                    keys_changing[key] = None
+            f_params.write(json.dumps(params) + '\n')
+            f_spool.write(json.dumps([[list(key), val] for key, val in overrides.items()]) + '\n')
+            n_jobs += 1
+    ## Pass over the spool: every changing key is written for every job, even where it equals the template
+    with open(path_spool, 'r') as f_spool, open(paths['changing'], 'w') as f_changing:
+        for line in f_spool:
+            overrides = {tuple(key): val for key, val in json.loads(line)}
+            changing = {}
+            for key in keys_changing:
+                val = overrides[key] if key in overrides else deep_get(params_template, key, default=_missing)
+                if val is not _missing:
+                    changing[key_to_str(key)] = val
+            f_changing.write(json.dumps(changing) + '\n')
+    Path(path_spool).unlink()
+    ## Keys that change in any job are removed from the unchanging params
+    params_unchanging = params_template
+    for key in keys_changing:
+        params_unchanging = _deep_pop(params_unchanging, key)
+    with open(paths['unchanging'], 'w') as f:
+        json.dump(params_unchanging, f, indent=4)
+    check_sweep(paths) if check else None
+    print(f"Wrote {n_jobs} job configs to {paths['params']}. Changing keys: {[key_to_str(k) for k in keys_changing]}") if verbose > 0 else None
+    return {'n_jobs': n_jobs, 'keys_changing': [key_to_str(k) for k in keys_changing], 'paths': paths}
+
+
+def check_sweep(paths):
+    """
+    Checks that the files written by write_sweep round-trip: for every job,
+    single(changing) applied to the unchanging params must rebuild that
+    job's params exactly. Reads the files one line at a time.
+    RH 2024
+
+    Args:
+        paths (dict):
+            'params', 'changing' and 'unchanging' paths, as returned by
+            write_sweep.
+    """
+    with open(paths['unchanging'], 'r') as f:
+        params_unchanging = json.load(f)
+    with open(paths['params'], 'r') as f_params, open(paths['changing'], 'r') as f_changing:
+        for idx, (line_params, line_changing) in enumerate(itertools.zip_longest(f_params, f_changing)):
+            assert (line_params is not None) and (line_changing is not None), f"{paths['params']} and {paths['changing']} have different numbers of lines"
+            params_rebuilt = next(iter_params(params_unchanging, single(json.loads(line_changing))))
+            assert params_rebuilt == json.loads(line_params), f"Job {idx}: unchanging + changing params do not rebuild the params in {paths['params']}"
+
+
+def read_params(path, idx=None):
+    """
+    Reads job params from a {name}.jsonl file written by write_sweep. If idx
+    is given, only the params of job idx are parsed and returned.
+    """
+    with open(path, 'r') as f:
+        if idx is None:
+            return [json.loads(line) for line in f]
+        return json.loads(next(itertools.islice(f, idx, None)))
+
+
+def _deep_pop(dictionary, key):
+    """Returns a copy of a nested dictionary without key (path copying)."""
+    key = as_key_path(key)
+    if deep_get(dictionary, key, default=_missing) is _missing:
+        return dictionary
+    d_out = dict(dictionary)
+    d = d_out
+    for k in key[:-1]:
+        d[k] = dict(d[k])
+        d = d[k]
+    d.pop(key[-1])
+    return d_out
+
+
+_missing = object()  ## Sentinel for missing keys
@@ -0,0 +1,525 @@
+"""
+GLOBUS TRANSFER
+RH 2024
+
+Batched Globus transfers from Python. Pure/native Python 3. Uses globus-cli
+(pip install globus-cli, then globus login).
+
+globusTransfer.sh and globus_playground.ipynb submit one 'globus transfer'
+per path. Here thousands of source -> destination pairs (e.g. the output of
+search_recursive) are packed into a few tasks with 'globus transfer
+--batch', using sync level checksum, so files already at the destination
+are skipped and a resubmitted task only moves what is missing:\n
+    * submit(): Splits the pairs into n_tasks chunks (balanced by size if
+      sizes are given) and submits one task per chunk. Failed submissions
+      are retried with exponential backoff and the same submission ID, so a
+      retry never makes a duplicate task.\n
+    * monitor(): Polls all tasks concurrently. Each task has its own polling
+      interval, which doubles while it makes no progress (up to poll_max).
+      Progress is summed over tasks. Tasks that fail are resubmitted.\n
+The tasks are saved in path_state, so monitoring can resume in a new
+session.
+
+Everything that talks to Globus goes through a GlobusBackend:
+CLIGlobusBackend runs globus-cli, and
+globus_transfer_benchmark.SimulatedGlobusBackend simulates it offline.
+
+Demo:
+    gt = GlobusTransfer(endpoint_source='hms', endpoint_destination='fas', n_tasks=4, label='HMS-RC to FAS RC Holyoke', path_state='~/globus_PS47.json')
+    gt.submit(paths_toTransfer, recursive=conn['HMS']['sftp'].isdir_remote)  ## {source: destination}
+    gt.monitor()
+
+Usage:
+    python globus_transfer.py submit --endpoint_source hms --endpoint_destination fas --path_items items.tsv --n_tasks 4 --path_state state.json
+    python globus_transfer.py monitor --path_state state.json
+"""
+
+import argparse
+import concurrent.futures
+import json
+import math
+import os
+import shlex
+import subprocess
+import time
+from pathlib import Path
+
+
+## Globus endpoint IDs by name. Same as globusTransfer.sh.
+ENDPOINTS = {
+    'hms': 'b0718922-7031-11e9-b7f8-0a37f382de32',
+    'fas': '1156ed9e-6984-11ea-af52-0201714f6eab',
+}
+## Errors that retrying will not fix
+PATTERNS_FATAL = ['ConsentRequired', 'AuthenticationFailed', 'MissingLogin', 'NoCredentials', 'ClientError.NotFound', 'PermissionDenied', 'No such option']
+STATUSES_FINAL = {'SUCCEEDED', 'FAILED'}
+
+
+class GlobusError(Exception):
+    """Error from Globus. retryable is False if retrying will not help (e.g. a missing consent)."""
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class GlobusBackend:
+    """
+    Interface between GlobusTransfer and Globus. Everything GlobusTransfer
+    needs from Globus goes through these methods, so that it can run against
+    globus-cli (CLIGlobusBackend) or against a simulated service for testing
+    offline (see globus_transfer_benchmark.SimulatedGlobusBackend).
+    RH 2024
+
+    Attributes:
+        n_calls (int):
+            Number of calls made to Globus so far.
+    """
+    n_calls = 0
+
+    def generate_submission_id(self):
+        """Returns a new submission ID. Submitting twice with one ID makes one task."""
+        raise NotImplementedError
+
+    def submit_transfer(self, endpoint_source, endpoint_destination, items, label, submission_id, sync_level='checksum', options=[]):
+        """
+        Submits one transfer task of items: dicts with 'source',
+        'destination' and 'recursive'. Returns the task ID. Raises
+        GlobusError.
+        """
+        raise NotImplementedError
+
+    def task_show(self, task_id):
+        """
+        Returns the task document: a dict with status ('ACTIVE', 'INACTIVE',
+        'SUCCEEDED', 'FAILED'), nice_status, bytes_transferred, files,
+        files_transferred, files_skipped and faults. Raises GlobusError.
+        """
+        raise NotImplementedError
+
+    def task_cancel(self, task_id):
+        """Cancels a task."""
+        raise NotImplementedError
+
+
+class CLIGlobusBackend(GlobusBackend):
+    """
+    GlobusBackend that runs globus-cli.
+    RH 2024
+
+    Args:
+        executable (str):
+            The globus command.
+        timeout (float):
+            Seconds after which a command is killed.
+    """
+    def __init__(self, executable='globus', timeout=120):
+        self.executable = executable
+        self.timeout = timeout
+        self.n_calls = 0
+
+    def _run(self, args, stdin=None):
+        self.n_calls += 1
+        try:
+            proc = subprocess.run([self.executable, *args, '--format', 'json'], input=stdin, capture_output=True, text=True, timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            raise GlobusError(f"globus {args[0]} timed out after {self.timeout} s")
+        except OSError as e:
+            raise GlobusError(f"Could not run {self.executable}: {e}", retryable=False)
+        if proc.returncode != 0:
+            message = (proc.stderr or proc.stdout).strip()
+            raise GlobusError(message, retryable=not any(p in message for p in PATTERNS_FATAL))
+        return json.loads(proc.stdout)
+
+    def generate_submission_id(self):
+        return self._run(['task', 'generate-submission-id'])['value']
+
+    def submit_transfer(self, endpoint_source, endpoint_destination, items, label, submission_id, sync_level='checksum', options=[]):
+        ## One line per item: SOURCE_PATH DEST_PATH [--recursive]
+        lines = ''.join(
+            f"{shlex.quote(item['source'])} {shlex.quote(item['destination'])}{' --recursive' if item['recursive'] else ''}\n" for item in items
+        )
+        out = self._run(
+            ['transfer', endpoint_source, endpoint_destination, '--batch', '-', '--sync-level', sync_level, '--label', label, '--submission-id', submission_id, *options],
+            stdin=lines,
+        )
+        return out['task_id']
+
+    def task_show(self, task_id):
+        return self._run(['task', 'show', task_id])
+
+    def task_cancel(self, task_id):
+        return self._run(['task', 'cancel', task_id])
+
+
+def as_items(pairs, recursive=None):
+    """
+    Makes items (dicts with source, destination, recursive, and size if
+    given) from:\n
+        * A dict {source: destination}.\n
+        * A list of (source, destination) tuples.\n
+        * A list of dicts with 'source' and 'destination' (and optionally
+          'recursive' and 'size').\n
+
+    Args:
+        recursive (bool, callable or None):
+            Whether sources are directories. A callable is called with each
+            source (e.g. sftp.isdir_remote). None: sources ending with '/'.
+    """
+    pairs = pairs.items() if isinstance(pairs, dict) else pairs
+    items = []
+    for pair in pairs:
+        item = dict(pair) if isinstance(pair, dict) else {'source': pair[0], 'destination': pair[1]}
+        if 'recursive' not in item:
+            item['recursive'] = recursive(item['source']) if callable(recursive) else (str(item['source']).endswith('/') if recursive is None else bool(recursive))
+        items.append(item)
+    return items
+
+
+def chunk_items(items, n_chunks):
+    """
+    Splits items into n_chunks chunks. If every item has a 'size', chunks are
+    balanced by total size (largest first into the smallest chunk). Else,
+    items are split into contiguous runs of about equal length, which keeps
+    directories together. Items keep their order within a chunk.
+
+    Returns:
+        (list of list):
+            Non-empty chunks.
+    """
+    n_chunks = max(1, min(n_chunks, len(items)))
+    if all(item.get('size') is not None for item in items):
+        bins, totals = [[] for _ in range(n_chunks)], [0] * n_chunks
+        for i in sorted(range(len(items)), key=lambda i: -items[i]['size']):
+            i_bin = totals.index(min(totals))
+            bins[i_bin].append(i)
+            totals[i_bin] += items[i]['size']
+        return [[items[i] for i in sorted(b)] for b in bins if len(b) > 0]
+    bounds = [round(i * len(items) / n_chunks) for i in range(n_chunks + 1)]
+    return [items[bounds[i]:bounds[i + 1]] for i in range(n_chunks) if bounds[i + 1] > bounds[i]]
+
+
+class GlobusTransfer:
+    """
+    Submits many source -> destination pairs as a few batched Globus tasks
+    and monitors them.
+    RH 2024
+
+    Args:
+        endpoint_source (str):
+            Source endpoint: ID or name in ENDPOINTS.
+        endpoint_destination (str):
+            Destination endpoint: ID or name in ENDPOINTS.
+        backend (GlobusBackend):
+            Backend. None for CLIGlobusBackend().
+        n_tasks (int):
+            Number of tasks to split the items into.
+        max_items_per_task (int):
+            More tasks are used if a task would have more items than this.
+        sync_level (str):
+            'exists', 'size', 'mtime' or 'checksum'. Files at the
+            destination that already match are skipped.
+        label (str):
+            Label of the tasks. Their index is appended.
+        options (list of str):
+            Extra options of 'globus transfer' (e.g. ['--preserve-mtime']).
+        max_retries (int):
+            Retries of a failed submission or status call.
+        backoff (float):
+            Seconds before the first retry of a submission. Doubles each
+            retry.
+        max_resubmits (int):
+            Times a task that FAILED is submitted again.
+        poll_min (float):
+            Seconds between polls of a task that is making progress.
+        poll_max (float):
+            Longest interval between polls of a task.
+        n_workers (int):
+            Number of concurrent status calls.
+        path_state (str):
+            JSON file where the tasks are saved. If it exists, its tasks are
+            loaded. None to not save.
+        verbose (int):
+            Verbosity level.
+    """
+    def __init__(
+        self,
+        endpoint_source=None,
+        endpoint_destination=None,
+        backend=None,
+        n_tasks=4,
+        max_items_per_task=10000,
+        sync_level='checksum',
+        label='batch',
+        options=[],
+        max_retries=5,
+        backoff=5,
+        max_resubmits=2,
+        poll_min=15,
+        poll_max=300,
+        n_workers=8,
+        path_state=None,
+        verbose=1,
+    ):
+        self.endpoint_source = ENDPOINTS.get(endpoint_source, endpoint_source)
+        self.endpoint_destination = ENDPOINTS.get(endpoint_destination, endpoint_destination)
+        self.backend = CLIGlobusBackend() if backend is None else backend
+        self.n_tasks = n_tasks
+        self.max_items_per_task = max_items_per_task
+        self.sync_level = sync_level
+        self.label = label
+        self.options = list(options)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_resubmits = max_resubmits
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.n_workers = n_workers
+        self.path_state = Path(path_state).expanduser() if path_state is not None else None
+        self.verbose = verbose
+
+        self.tasks = []
+        self.time_start = None
+        if (self.path_state is not None) and self.path_state.exists():
+            self.load()
+
+    def save(self):
+        """Writes the tasks to path_state atomically."""
+        if self.path_state is None:
+            return
+        path_tmp = self.path_state.with_suffix('.json.tmp')
+        with open(path_tmp, 'w') as f:
+            json.dump({
+                'endpoint_source': self.endpoint_source,
+                'endpoint_destination': self.endpoint_destination,
+                'time_start': self.time_start,
+                'tasks': self.tasks,
+            }, f, indent=1)
+        os.replace(path_tmp, self.path_state)
+
+    def load(self):
+        """Reads the tasks from path_state."""
+        with open(self.path_state, 'r') as f:
+            state = json.load(f)
+        self.endpoint_source = self.endpoint_source or state['endpoint_source']
+        self.endpoint_destination = self.endpoint_destination or state['endpoint_destination']
+        self.time_start = state['time_start']
+        self.tasks = state['tasks']
+        print(f"Loaded {len(self.tasks)} tasks from {self.path_state}") if self.verbose > 0 else None
+
+    def _retry(self, fn, *args):
+        """Calls fn(*args), retrying retryable GlobusErrors with exponential backoff."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                return fn(*args)
+            except GlobusError as e:
+                if (not e.retryable) or (attempt == self.max_retries):
+                    raise
+                print(f"Globus error (retrying in {self.backoff * 2**attempt:.0f} s): {e}") if self.verbose > 0 else None
+                time.sleep(self.backoff * 2**attempt)
+
+    def _submit_task(self, task):
+        """Submits a task (new or failed) with a new submission ID, reused across retries."""
+        task['submission_id'] = self._retry(self.backend.generate_submission_id)
+        task['task_id'] = self._retry(
+            self.backend.submit_transfer,
+            self.endpoint_source, self.endpoint_destination, task['items'], f"{self.label}_{task['index']}",
+            task['submission_id'], self.sync_level, self.options,
+        )
+        task.update({'status': 'ACTIVE', 'time_submit': time.time(), 'next_poll': time.time() + self.poll_min, 'interval': self.poll_min})
+        print(f"Submitted task {task['index']}: {task['task_id']} ({len(task['items'])} items)") if self.verbose > 0 else None
+
+    def submit(self, pairs, recursive=None):
+        """
+        Packs pairs into tasks and submits them.
+        RH 2024
+
+        Args:
+            pairs (dict or list):
+                Source -> destination pairs. See as_items.
+            recursive (bool, callable or None):
+                Whether sources are directories. See as_items.
+
+        Returns:
+            (list of str):
+                Task IDs.
+        """
+        assert (self.endpoint_source is not None) and (self.endpoint_destination is not None), "endpoint_source and endpoint_destination are required to submit"
+        items = as_items(pairs, recursive=recursive)
+        chunks = chunk_items(items, max(self.n_tasks, math.ceil(len(items) / self.max_items_per_task)))
+        print(f"Submitting {len(items)} items as {len(chunks)} tasks") if self.verbose > 0 else None
+        self.time_start = time.time() if self.time_start is None else self.time_start
+        for chunk in chunks:
+            task = {'index': len(self.tasks), 'items': chunk, 'task_id': None, 'status': None, 'n_resubmits': 0}
+            self._submit_task(task)
+            self.tasks.append(task)  ## Only submitted tasks are polled
+            self.save()
+        return [task['task_id'] for task in self.tasks[-len(chunks):]]
+
+    def _show(self, task):
+        try:
+            return self.backend.task_show(task['task_id'])
+        except GlobusError as e:
+            return e
+
+    def poll(self, force=False):
+        """
+        Polls, concurrently, the tasks that are due (all if force), updates
+        them, and resubmits tasks that failed. A task that cannot be
+        resubmitted stays FAILED, with the GlobusError in 'error'.
+
+        Returns:
+            (dict):
+                Progress. See progress.
+        """
+        now = time.time()
+        due = [t for t in self.tasks if t['status'] not in STATUSES_FINAL and (force or t['next_poll'] <= now)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.n_workers) as pool:
+            docs = list(pool.map(self._show, due))
+        for task, doc in zip(due, docs):
+            if isinstance(doc, GlobusError):
+                print(f"Could not get the status of task {task['index']}: {doc}") if self.verbose > 0 else None
+                task['interval'] = min(task['interval'] * 2, self.poll_max)
+                task['next_poll'] = time.time() + task['interval']
+                continue
+            progressed = doc.get('bytes_transferred', 0) != task.get('bytes_transferred') or doc.get('files_transferred', 0) != task.get('files_transferred')
+            if (doc['status'] == 'INACTIVE') and (task['status'] != 'INACTIVE') and self.verbose > 0:
+                print(f"Task {task['index']} ({task['task_id']}) is INACTIVE: {doc.get('nice_status')}. It may need 'globus session consent'.")
+            task.update({k: doc.get(k) for k in ['status', 'nice_status', 'bytes_transferred', 'files', 'files_transferred', 'files_skipped', 'faults']})
+            task['interval'] = self.poll_min if progressed else min(task['interval'] * 2, self.poll_max)
+            task['next_poll'] = time.time() + task['interval']
+            if (task['status'] == 'FAILED') and (task['n_resubmits'] < self.max_resubmits):
+                print(f"Task {task['index']} FAILED ({task.get('nice_status')}). Resubmitting.") if self.verbose > 0 else None
+                task['n_resubmits'] += 1
+                ## Progress of the failed attempt is kept, and the counters restart for the new task
+                task['bytes_transferred_before'] = task.get('bytes_transferred_before', 0) + (task.get('bytes_transferred') or 0)
+                task['files_transferred_before'] = task.get('files_transferred_before', 0) + (task.get('files_transferred') or 0)
+                task['bytes_transferred'], task['files_transferred'], task['files_skipped'] = 0, 0, 0
+                try:
+                    self._submit_task(task)
+                except GlobusError as e:
+                    print(f"Could not resubmit task {task['index']}: {e}") if self.verbose > 0 else None
+                    task.update({'status': 'FAILED', 'error': str(e)})
+        self.save()
+        return self.progress()
+
+    def progress(self):
+        """
+        Progress summed over tasks.
+
+        Returns:
+            (dict):
+                statuses (dict): Number of tasks per status.\n
+                files, files_transferred, files_skipped (int): Summed over
+                tasks. files_transferred includes files moved by failed
+                attempts (which the resubmitted task reports as skipped).
+                files_skipped is of the current attempts only.\n
+                bytes (int): Bytes transferred, including by failed attempts.\n
+                gb_per_s (float): bytes / seconds since the first submission.\n
+                faults (int): Summed over tasks.\n
+        """
+        statuses = {}
+        for task in self.tasks:
+            statuses[task['status']] = statuses.get(task['status'], 0) + 1
+        total = lambda key: sum(task.get(key) or 0 for task in self.tasks)
+        n_bytes = total('bytes_transferred') + total('bytes_transferred_before')
+        seconds = time.time() - self.time_start if self.time_start is not None else 0
+        return {
+            'statuses': statuses,
+            'files': total('files'),
+            'files_transferred': total('files_transferred') + total('files_transferred_before'),
+            'files_skipped': total('files_skipped'),
+            'bytes': n_bytes,
+            'gb_per_s': n_bytes / 1e9 / max(seconds, 1e-9),
+            'faults': total('faults'),
+        }
+
+    def monitor(self, timeout=None):
+        """
+        Polls the tasks until they all SUCCEEDED or FAILED (after their
+        resubmits), printing progress when it changes.
+        RH 2024
+
+        Args:
+            timeout (float):
+                Seconds after which monitoring stops. None for no limit.
+
+        Returns:
+            (dict):
+                Final progress. See progress.
+        """
+        tic = time.time()
+        line_last = None
+        while True:
+            progress = self.poll()
+            line = (
+                f"Tasks: {progress['statuses']} | files {progress['files_transferred']} transferred, {progress['files_skipped']} skipped, of {progress['files']}"
+                f" | {progress['bytes'] / 1e9:.2f} GB, {progress['gb_per_s']:.3f} GB/s | faults {progress['faults']}"
+            )
+            if (line != line_last) and self.verbose > 0:
+                print(line)
+                line_last = line
+            pending = [t['next_poll'] for t in self.tasks if t['status'] not in STATUSES_FINAL]
+            if len(pending) == 0:
+                return progress
+            if (timeout is not None) and (time.time() - tic > timeout):
+                print(f"Stopped monitoring after {timeout} s. Tasks are still running.") if self.verbose > 0 else None
+                return progress
+            time.sleep(max(0, min(pending) - time.time()))
+
+    def cancel(self):
+        """Cancels the tasks that are not finished."""
+        for task in self.tasks:
+            if task['status'] not in STATUSES_FINAL:
+                self._retry(self.backend.task_cancel, task['task_id'])
+        self.poll(force=True)
+
+
+def read_items(path_items):
+    """
+    Reads items from a file: a JSON list of {'source', 'destination'} dicts
+    (optionally with 'recursive' and 'size'), or lines of
+    'source<TAB>destination'.
+    """
+    with open(path_items, 'r') as f:
+        text = f.read()
+    if str(path_items).endswith('.json'):
+        return json.loads(text)
+    return [tuple(line.split('\t')[:2]) for line in text.splitlines() if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batched Globus transfers with task monitoring.')
+    parser.add_argument('command', type=str, choices=['submit', 'monitor', 'cancel'])
+    parser.add_argument('--endpoint_source', type=str, default=None, help=f'Source endpoint: ID or one of {list(ENDPOINTS)}.')
+    parser.add_argument('--endpoint_destination', type=str, default=None, help=f'Destination endpoint: ID or one of {list(ENDPOINTS)}.')
+    parser.add_argument('--path_items', type=str, default=None, help='Items: .json list of {source, destination}, or source<TAB>destination lines.')
+    parser.add_argument('--path_state', type=str, required=True, help='JSON file of the tasks.')
+    parser.add_argument('--n_tasks', type=int, default=4, help='Number of tasks.')
+    parser.add_argument('--sync_level', type=str, default='checksum', choices=['exists', 'size', 'mtime', 'checksum'])
+    parser.add_argument('--label', type=str, default='batch', help='Label of the tasks.')
+    parser.add_argument('--poll_min', type=float, default=15, help='Seconds between polls of a task making progress.')
+    parser.add_argument('--poll_max', type=float, default=300, help='Longest interval between polls of a task.')
+    parser.add_argument('--no_monitor', action='store_true', help='Submit without monitoring.')
+    args = parser.parse_args()
+
+    gt = GlobusTransfer(
+        endpoint_source=args.endpoint_source,
+        endpoint_destination=args.endpoint_destination,
+        n_tasks=args.n_tasks,
+        sync_level=args.sync_level,
+        label=args.label,
+        poll_min=args.poll_min,
+        poll_max=args.poll_max,
+        path_state=args.path_state,
+    )
+    if args.command == 'submit':
+        gt.submit(read_items(args.path_items))
+        gt.monitor() if not args.no_monitor else None
+    elif args.command == 'monitor':
+        gt.monitor()
+    elif args.command == 'cancel':
+        gt.cancel()
+
+
+if __name__ == '__main__':
+    main()
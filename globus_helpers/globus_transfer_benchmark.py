@@ -0,0 +1,227 @@
+"""
+GLOBUS TRANSFER BENCHMARKS
+RH 2024
+
+Offline tests of globus_transfer.py against SimulatedGlobusBackend, an
+in-process simulation of the Globus transfer service. Pure/native Python 3,
+like globus_transfer.py itself.
+
+Demo:
+python globus_transfer_benchmark.py chunking --n_items 5000 --n_tasks 4 --latency 0.2
+python globus_transfer_benchmark.py retry --n_items 2000 --p_submit_error 0.3 --p_lost_response 0.2 --p_task_fail 0.5
+python globus_transfer_benchmark.py polling --n_items 2000 --n_tasks 8
+"""
+
+import argparse
+import random
+import threading
+import time
+import uuid
+
+import globus_transfer
+
+
+class SimulatedGlobusBackend(globus_transfer.GlobusBackend):
+    """
+    In-process simulated Globus transfer service implementing
+    globus_transfer.GlobusBackend.\n
+    A task moves its files one after another at rate_bytes_per_s (in real
+    time) and then SUCCEEDS, unless it was drawn to fail, in which case it
+    FAILS after moving part of its files. Files that reached the destination
+    are remembered, so with sync level checksum a resubmitted task skips
+    them. Submissions fail with probability p_submit_error (nothing is
+    submitted) or p_lost_response (the task is made, but the response is
+    lost). Submitting twice with one submission ID returns the first task,
+    like Globus.
+    RH 2024
+
+    Args:
+        size_file (int):
+            Bytes of each file. Directories (recursive items) have
+            files_per_dir files.
+        files_per_dir (int):
+            Files in each recursive item.
+        rate_bytes_per_s (float):
+            Throughput of each task.
+        p_submit_error (float):
+            Probability that a submission fails before making a task.
+        p_lost_response (float):
+            Probability that a submission makes a task but raises.
+        p_task_fail (float):
+            Probability that a task FAILS partway.
+        latency (float):
+            Seconds each call takes.
+        seed (int):
+            Random seed.
+    """
+    def __init__(
+        self,
+        size_file=2**20,
+        files_per_dir=10,
+        rate_bytes_per_s=2**30,
+        p_submit_error=0.0,
+        p_lost_response=0.0,
+        p_task_fail=0.0,
+        latency=0.0,
+        seed=0,
+    ):
+        self.size_file = size_file
+        self.files_per_dir = files_per_dir
+        self.rate_bytes_per_s = rate_bytes_per_s
+        self.p_submit_error = p_submit_error
+        self.p_lost_response = p_lost_response
+        self.p_task_fail = p_task_fail
+        self.latency = latency
+        self.rng = random.Random(seed)
+
+        self.n_calls = 0
+        self.n_calls_by = {}
+        self.tasks = {}  ## {task_id: task}
+        self.by_submission_id = {}  ## {submission_id: task_id}
+        self.destination = {}  ## {path: number of times it was written}
+        self._lock = threading.Lock()
+
+    def _call(self, name):
+        time.sleep(self.latency)
+        with self._lock:
+            self.n_calls += 1
+            self.n_calls_by[name] = self.n_calls_by.get(name, 0) + 1
+
+    def generate_submission_id(self):
+        self._call('generate_submission_id')
+        return str(uuid.UUID(int=self.rng.getrandbits(128)))
+
+    def submit_transfer(self, endpoint_source, endpoint_destination, items, label, submission_id, sync_level='checksum', options=[]):
+        self._call('submit_transfer')
+        with self._lock:
+            if submission_id in self.by_submission_id:
+                return self.by_submission_id[submission_id]
+            if self.rng.random() < self.p_submit_error:
+                raise globus_transfer.GlobusError("GlobusAPIError: (503, 'ServiceUnavailable')")
+            files = [
+                f"{item['destination']}/file_{i:03d}" if item['recursive'] else item['destination']
+                for item in items for i in range(self.files_per_dir if item['recursive'] else 1)
+            ]
+            task_id = str(uuid.UUID(int=self.rng.getrandbits(128)))
+            self.tasks[task_id] = {
+                'files': files,
+                'skip': [(sync_level is not None) and (f in self.destination) for f in files],
+                'time_start': time.time(),
+                'fail_at': self.rng.randrange(len(files)) if self.rng.random() < self.p_task_fail else None,
+                'n_written': 0,
+                'label': label,
+            }
+            self.by_submission_id[submission_id] = task_id
+            if self.rng.random() < self.p_lost_response:
+                raise globus_transfer.GlobusError("ConnectionError: response lost")
+            return task_id
+
+    def task_show(self, task_id):
+        self._call('task_show')
+        with self._lock:
+            task = self.tasks[task_id]
+            files_todo = [f for f, skip in zip(task['files'], task['skip']) if not skip]
+            n_done = min(len(files_todo), int((time.time() - task['time_start']) * self.rate_bytes_per_s / self.size_file))
+            if task.get('cancelled'):
+                n_done = min(n_done, task['n_written'])
+            failed = (task['fail_at'] is not None) and (n_done > task['fail_at'])
+            n_done = min(n_done, task['fail_at']) if failed else n_done
+            for f in files_todo[task['n_written']:n_done]:
+                self.destination[f] = self.destination.get(f, 0) + 1
+            task['n_written'] = max(task['n_written'], n_done)
+            status = 'FAILED' if (failed or task.get('cancelled')) else ('SUCCEEDED' if n_done == len(files_todo) else 'ACTIVE')
+            return {
+                'task_id': task_id,
+                'status': status,
+                'nice_status': {'FAILED': 'PERMISSION_DENIED', 'SUCCEEDED': None, 'ACTIVE': 'OK'}[status],
+                'bytes_transferred': task['n_written'] * self.size_file,
+                'files': len(task['files']),
+                'files_transferred': task['n_written'],
+                'files_skipped': sum(task['skip']),
+                'faults': 0,
+                'label': task['label'],
+            }
+
+    def task_cancel(self, task_id):
+        self._call('task_cancel')
+        with self._lock:
+            self.tasks[task_id]['cancelled'] = True
+
+
+def make_pairs(n_items=5000, frac_dirs=0.1, seed=0):
+    """Source -> destination pairs, like search_recursive output: mostly files, some directories."""
+    rng = random.Random(seed)
+    pairs = {}
+    for i in range(n_items):
+        is_dir = rng.random() < frac_dirs
+        source = f'/n/files/Neurobio/MICROSCOPE/camera/PS{i % 50:02d}/session_{i:05d}' + ('/' if is_dir else '/video1.avi')
+        pairs[source] = source.replace('/n/files/Neurobio/MICROSCOPE', '/n/netscratch/bsabatini_lab/Lab').rstrip('/')
+    return pairs
+
+
+def benchmark_chunking(n_items=5000, n_tasks=4, latency=0.2):
+    """Calls and wall time to submit n_items pairs as n_tasks batched tasks vs one task per pair."""
+    backend = SimulatedGlobusBackend(latency=latency)
+    gt = globus_transfer.GlobusTransfer('hms', 'fas', backend=backend, n_tasks=n_tasks, poll_min=0.05, poll_max=0.5, verbose=0)
+    tic = time.time()
+    gt.submit(make_pairs(n_items))
+    toc = time.time() - tic
+    sizes = [len(t['items']) for t in gt.tasks]
+    print(f"Batched: {n_items} items -> {len(gt.tasks)} tasks of {sizes} items, {backend.n_calls} calls, {toc:.2f} s")
+    print(f"One task per pair (as in the notebook): {n_items} tasks, {n_items} calls, ~{n_items * latency:.0f} s at {latency} s per call")
+    progress = gt.monitor(timeout=60)
+    n_written = len(backend.destination)
+    print(f"Done: {progress['statuses']}, {progress['files_transferred']} files transferred, {n_written} distinct files at the destination")
+
+
+def benchmark_retry(n_items=2000, n_tasks=8, p_submit_error=0.3, p_lost_response=0.2, p_task_fail=0.5, seed=0):
+    """Transient submission errors, lost responses and failing tasks: every file must arrive, none twice, no duplicate tasks."""
+    backend = SimulatedGlobusBackend(p_submit_error=p_submit_error, p_lost_response=p_lost_response, p_task_fail=p_task_fail, rate_bytes_per_s=2**32, seed=seed)
+    gt = globus_transfer.GlobusTransfer('hms', 'fas', backend=backend, n_tasks=n_tasks, backoff=0.01, max_retries=10, max_resubmits=10, poll_min=0.02, poll_max=0.2, verbose=0)
+    gt.submit(make_pairs(n_items))
+    progress = gt.monitor(timeout=60)
+    expected = {f for t in backend.tasks.values() for f in t['files']}
+    n_resubmits = sum(t['n_resubmits'] for t in gt.tasks)
+    print(f"Calls: {backend.n_calls_by}")
+    print(f"Tasks in the service: {len(backend.tasks)} = {len(gt.tasks)} chunks + {n_resubmits} resubmits (no duplicates: {len(backend.tasks) == len(gt.tasks) + n_resubmits})")
+    print(f"Final: {progress['statuses']}. Files at the destination: {len(backend.destination)} of {len(expected)}, written more than once: {sum(n > 1 for n in backend.destination.values())}")
+
+
+def benchmark_polling(n_items=2000, n_tasks=8, poll_min=0.05, poll_max=1.0, seed=0):
+    """Status calls with adaptive, concurrent polling of tasks of very different lengths."""
+    backend = SimulatedGlobusBackend(rate_bytes_per_s=2**26, latency=0.02, seed=seed)
+    gt = globus_transfer.GlobusTransfer('hms', 'fas', backend=backend, n_tasks=n_tasks, poll_min=poll_min, poll_max=poll_max, verbose=1)
+    pairs = make_pairs(n_items)
+    items = [{'source': s, 'destination': d, 'size': (50 if i % n_tasks == 0 else 1)} for i, (s, d) in enumerate(pairs.items())]
+    gt.submit(items)
+    tic = time.time()
+    progress = gt.monitor(timeout=120)
+    toc = time.time() - tic
+    n_files = sum(len(t['files']) for t in backend.tasks.values())
+    assert progress['files_transferred'] == n_files, f"Progress counts {progress['files_transferred']} files transferred, the service {n_files}"
+    assert progress['bytes'] == n_files * backend.size_file, f"Progress counts {progress['bytes']} bytes, the service {n_files * backend.size_file}"
+    print(f"Monitored {len(gt.tasks)} tasks for {toc:.1f} s with {backend.n_calls_by.get('task_show', 0)} status calls ({toc / poll_min * len(gt.tasks):.0f} at a fixed {poll_min} s interval). Progress matches the service: {progress['files_transferred']} files, {progress['bytes'] / 1e9:.2f} GB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of globus_transfer.py.')
+    parser.add_argument('benchmark', type=str, choices=['chunking', 'retry', 'polling'])
+    parser.add_argument('--n_items', type=int, default=5000)
+    parser.add_argument('--n_tasks', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--p_submit_error', type=float, default=0.3)
+    parser.add_argument('--p_lost_response', type=float, default=0.2)
+    parser.add_argument('--p_task_fail', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.benchmark == 'chunking':
+        benchmark_chunking(n_items=args.n_items, n_tasks=args.n_tasks, latency=args.latency)
+    elif args.benchmark == 'retry':
+        benchmark_retry(n_items=args.n_items, n_tasks=args.n_tasks, p_submit_error=args.p_submit_error, p_lost_response=args.p_lost_response, p_task_fail=args.p_task_fail, seed=args.seed)
+    elif args.benchmark == 'polling':
+        benchmark_polling(n_items=args.n_items, n_tasks=args.n_tasks, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
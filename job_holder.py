@@ -4,8 +4,8 @@ RH 2024
 
 This script is used to constrain the number of jobs that a user can have running
 at one time. It is a daemon that is intended to run persistently on a small node.
-It is written in pure/native Python 3 and uses the subprocess module to interact
-with the SLURM.
+It is written in pure/native Python 3 and uses the subprocess and asyncio modules
+to interact with the SLURM.
 
 Written to be used on Harvard's 02 and FASRC clusters.\n
 
@@ -13,26 +13,51 @@ Script proceeds as follows:
 1. Runs squeue to get information about all jobs
 2. Parses information about each job
 3. Determines which jobs must be set to HOLD
-4. Runs scontrol hold <job_id> to hold jobs
-5. Runs scontrol release <job_id> to release jobs
-6. Repeats every 5 seconds.
+4. Runs scontrol hold <job_id> to hold jobs (or scontrol hold <job_id>,<job_id>,... with --batch)
+5. Runs scontrol release <job_id> to release jobs (or batched, as above)
+6. Repeats every 5 seconds, backing off to every 60 seconds while the queue is stable.
 
 Demo:
 python job_holder.py --value_max 36 --constraint nodes --order_by job_id --order_ascending True --interval 30 --verbose 2
+python job_holder.py --config config.json --batch  ## see load_config for the config file format
+python job_holder.py --value_max 36 --journal ~/.job_holder.sqlite  ## remembers which jobs it held across restarts
+python job_holder.py --value_max 36 --metrics_port 9100  ## curl localhost:9100/metrics ; kill -USR1 <pid> to profile a tick
 """
 
 import argparse
+import asyncio
+import random
 import subprocess
 import time
 import datetime
+import functools
 import re
 import itertools
 import threading
 import sys
+import os
+import signal
+import builtins
+import array
+import json
+import operator
+import bisect
+import contextlib
+import http.server
+import logging.handlers
+import cProfile
+import pstats
+import sqlite3
+
+## Optional: numpy is used to vectorize JobTable operations if it is installed
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 ## Print to terminal
 def print(*args, **kwargs):
-    return __builtins__.print(*args, **kwargs, file=sys.stderr)
+    return builtins.print(*args, **kwargs, file=sys.stderr)
 
 ## Properties to get from squeue
 properties = {
@@ -47,9 +72,34 @@ properties = {
     'time_left': 'TimeLeft',
     'priority': 'Priority',
     'node_reason': 'ReasonList',
+    'user': 'UserName',
+    'account': 'Account',
+    'gpus': 'tres-per-node',
     'name': 'Name',
 }
 
+## squeue --format (-o) field specifiers for each property. Used by the
+## delimited parser. 'name' is last so that a '|' in a job name cannot shift
+## the other fields. '%Q' is the integer priority.
+properties_format = {
+    'job_id': '%i',
+    'state': '%T',
+    'submit_time': '%V',
+    'partition': '%P',
+    'time_limit': '%l',
+    'nodes': '%D',
+    'cpus': '%C',
+    'memory': '%m',
+    'time_left': '%L',
+    'priority': '%Q',
+    'node_reason': '%R',
+    'user': '%u',
+    'account': '%a',
+    'gpus': '%b',
+    'name': '%j',
+}
+_delimiter = '|'
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Manage job holding and releasing based on custom rules.")
     ## value_max, float, default=12
@@ -64,9 +114,30 @@ def parse_args():
         "-c",
         "--constraint",
         type=str, 
-        choices=['nodes', 'cpus', 'memory', 'time_left', 'jobs', 'fairshare',],
+        choices=['nodes', 'cpus', 'memory', 'gpus', 'time_left', 'jobs', 'fairshare',],
         default='nodes',
-        help="Constraint to manage jobs by. Default: 'nodes'.",
+        help="Constraint to manage jobs by. Units: memory in GB, time_left in seconds. Default: 'nodes'.",
+    )
+    parser.add_argument(
+        "-l",
+        "--limits",
+        type=str,
+        nargs='+',
+        default=None,
+        help="Enforce several constraints at once, as constraint=value_max pairs. Jobs are held if any limit is reached. Overrides --constraint and --value_max. Example: --limits nodes=36 memory=2048 gpus=8",
+    )
+    parser.add_argument(
+        "--release_policy",
+        type=str,
+        choices=['prefix', 'greedy'],
+        default='prefix',
+        help="How pending jobs are released into free capacity. 'prefix': release jobs in order until one does not fit. 'greedy': release every job that fits, skipping jobs that do not. Default: 'prefix'.",
+    )
+    parser.add_argument(
+        "--horizon",
+        type=float,
+        default=0.0,
+        help="Look-ahead in seconds. Capacity of RUNNING jobs whose time left is within the horizon is treated as already free, so PENDING jobs are released early and are through the slurm scheduler by the time the capacity frees. The constraint may be exceeded by up to the projected capacity for up to 'horizon' seconds. Default: 0 (no look-ahead).",
     )
     parser.add_argument(
         "-o",
@@ -88,9 +159,27 @@ def parse_args():
         "--interval", 
         type=float, 
         default=5.0,
-        help="Interval in seconds for checking and managing jobs. Default: 5.",
+        help="Interval in seconds for checking and managing jobs. This is the minimum interval; it grows while the queue is stable. Default: 5.",
+    )
+    parser.add_argument(
+        "--interval_max",
+        type=float,
+        default=60.0,
+        help="Maximum interval in seconds between checks while the queue is stable. Set equal to --interval for a fixed interval. Default: 60.",
+    )
+    parser.add_argument(
+        "--backoff",
+        type=float,
+        default=2.0,
+        help="Factor by which the interval grows after each check in which no jobs started, finished, were submitted, or were held/released. Default: 2.",
     )
     ## Optional args
+    parser.add_argument(
+        "--config",
+        type=str,
+        default=None,
+        help="Path to a JSON config file listing many users and/or accounts to manage, each with its own constraint, value_max and ordering. One squeue snapshot is shared by all entries each tick. Command line values are used as defaults. See load_config.",
+    )
     parser.add_argument(
         "--username", 
         type=str,
@@ -120,6 +209,78 @@ def parse_args():
         action='store_true',
         help="Run once and exit.",
     )
+    parser.add_argument(
+        "--parser",
+        type=str,
+        choices=['delimited', 'fixed'],
+        default='delimited',
+        help="squeue output format to parse. 'delimited': '|' separated fields from 'squeue -o' (robust to long names/reasons). 'fixed': fixed width columns from 'squeue --Format'. Default: 'delimited'.",
+    )
+    parser.add_argument(
+        "--fairshare_ttl",
+        type=float,
+        default=300.0,
+        help="Time in seconds for which fairshare values from sshare are cached. Stale values are refreshed in the background. Default: 300.",
+    )
+    parser.add_argument(
+        "--command_timeout",
+        type=float,
+        default=30.0,
+        help="Timeout in seconds for each slurm command (squeue, sshare, scontrol). Default: 30.",
+    )
+    parser.add_argument(
+        "--command_retries",
+        type=int,
+        default=3,
+        help="Number of retries, with exponential backoff and jitter, for slurm commands that fail with a transient error (e.g. 'Socket timed out'). Default: 3.",
+    )
+    parser.add_argument(
+        "--max_concurrency",
+        type=int,
+        default=8,
+        help="Maximum number of slurm commands (e.g. scontrol hold/release batches) running at the same time. Default: 8.",
+    )
+    parser.add_argument(
+        "--batch", 
+        action='store_true',
+        help="Hold and release jobs in batches: pass comma-separated lists of job IDs to scontrol instead of calling it once per job.",
+    )
+    parser.add_argument(
+        "--max_command_length",
+        type=int,
+        default=4000,
+        help="Maximum number of characters in each comma-separated list of job IDs when using --batch. Default: 4000.",
+    )
+    parser.add_argument(
+        "--journal",
+        type=str,
+        default=None,
+        help="Path to a SQLite file journaling hold/release decisions and observed job states. Survives restarts: only jobs held by job_holder are released, and jobs held manually (including jobs submitted with 'sbatch --hold') are left alone. Default: None (no journal; any held job may be released).",
+    )
+    parser.add_argument(
+        "--journal_max_age",
+        type=float,
+        default=7.0,
+        help="Journal events older than this many days are deleted on startup. Default: 7.",
+    )
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        default=None,
+        help="If set, serve metrics (per-phase latency histograms, queue sizes, holds/releases, constrained values) in the Prometheus text format on http://127.0.0.1:<metrics_port>/metrics. Default: None.",
+    )
+    parser.add_argument(
+        "--metrics_file",
+        type=str,
+        default=None,
+        help="If set, write metrics in the Prometheus text format to this file after every tick, and append one JSON line per tick to <metrics_file>.log (rotated at 10 MB). Default: None.",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        type=str,
+        default='.',
+        help="Directory for cProfile outputs. Send SIGUSR1 to the daemon (kill -USR1 <pid>) to profile the next tick. Default: '.'.",
+    )
     
     return parser.parse_args()
 
@@ -162,65 +323,553 @@ def _parse_slurm_duration(t):
     return datetime.timedelta(days=days, hours=hours, minutes=minutes, seconds=seconds)
 def _parse_slurm_submit_time(t):
     return datetime.datetime.strptime(t, "%Y-%m-%dT%H:%M:%S")  ## Parse datetime string. Expected format: "2024-01-01T00:00:00"
+_re_memory = re.compile(r'([-+]?\d+(?:\.\d+)?)\s*([KMGTP]?)', re.I)
+_memory_units_GB = {'K': 1/1024**2, 'M': 1/1024, 'G': 1, 'T': 1024, 'P': 1024**2}
 def _parse_memory_string(m):
-    ## Get first number in string before any other characters. Allow for +/- sign and decimal point.
-    match = re.search(r'[-+]?\d+(\.\d+)?', m, re.I).group()
+    """
+    Parses a slurm memory string (e.g. '4000M', '48G', '2T') into gigabytes.
+    Numbers without a unit are assumed to be megabytes, as in slurm.
+    """
+    ## Get first number in string and its unit suffix. Allow for +/- sign and decimal point.
+    match = _re_memory.search(m)
     if match:
-        return float(match)  ## Return as float
+        return float(match.group(1)) * _memory_units_GB[match.group(2).upper() or 'M']  ## Return as float, in GB
     else:
         return None
-def get_jobs_info(username):
+_re_gpus = re.compile(r'gpu(?::[^:,\s()]+)*?(?::(\d+))?(?=[,\s(]|$)', re.I)
+def _parse_gpus_string(g):
+    """
+    Parses the number of GPUs per node from a slurm gres / tres-per-node
+    string (e.g. 'gres:gpu:2', 'gres/gpu:a100:1', 'gpu', 'N/A').
+    """
+    return float(sum([int(n) if n else 1 for n in _re_gpus.findall(g)]))
+## Cached converters. Many jobs share the same TimeLimit, TimeLeft, SubmitTime
+## and memory strings, so each distinct string is only parsed once.
+@functools.lru_cache(maxsize=2**16)
+def _parse_slurm_duration_seconds(t):
+    return _parse_slurm_duration(t).total_seconds()
+@functools.lru_cache(maxsize=2**16)
+def _parse_slurm_submit_timestamp(t):
+    try:
+        return datetime.datetime.fromisoformat(t).timestamp()
+    except ValueError:
+        return float('nan')  ## e.g. 'N/A'
+@functools.lru_cache(maxsize=2**10)
+def _parse_memory_string_cached(m):
+    return _parse_memory_string(m)
+@functools.lru_cache(maxsize=2**10)
+def _parse_gpus_string_cached(g):
+    return _parse_gpus_string(g)
+## Converters from squeue strings to values stored in JobTable for each property
+_converters = {
+    'time_limit': _parse_slurm_duration_seconds,
+    'time_left': _parse_slurm_duration_seconds,
+    'submit_time': _parse_slurm_submit_timestamp,
+    'memory': _parse_memory_string_cached,
+    'gpus': _parse_gpus_string_cached,
+    'nodes': int,
+    'cpus': int,
+    'priority': float,
+}
+## Converters in the order of 'properties'. Strings are passed through.
+_converters_row = tuple(_converters.get(key, str) for key in properties)
+def get_jobs_info(username, cache=None, parser='delimited', accounts=None, backend=None, metrics=None):
     """
     Returns detailed information about each job, including submission time,
     partition, duration, requested resources, and priority.
 
     Args:
-        username (str):
-            The username for which to get job information.
+        username (str or list):
+            The username (or list of usernames) for which to get job
+            information. All users are fetched with a single squeue call.
+            Can be None if accounts is given.
+        cache (SqueueCache):
+            Optional cache of parsed squeue rows. If provided, only rows that
+            changed since the previous call are parsed.
+        parser (str):
+            squeue output format to request and parse.\n
+                * 'delimited': '|' delimited fields from 'squeue -h -o'.
+                  Robust to fields that fill their column width.\n
+                * 'fixed': Fixed width columns from 'squeue --Format'.\n
+        accounts (list):
+            Optional list of accounts. If given, only jobs in these accounts
+            are returned.
+        backend (SlurmBackend):
+            Backend that runs squeue. If None, default_backend is used.
+        metrics (Metrics):
+            Optional. Records the time taken by the 'squeue' and 'parse'
+            phases.
 
     Returns:
-        (dict): 
-            A dictionary containing the following:\n
+        (JobTable): 
+            Columnar table of jobs. Columns can be accessed like a dictionary:\n
                 * job_id (list): List of job IDs.\n
                 * state (list): List of job states.\n
-                * submit_time (list): List of job submission times.\n
+                * submit_time (array): Job submission times (POSIX timestamp).\n
                 * partition (list): List of partitions.\n
-                * time_limit (list): List of job time limits.\n
-                * nodes (list): List of nodes.\n
-                * cpus (list): List of CPUs.\n
-                * memory (list): List of memory.\n
-                * priority (list): List of job priorities.
+                * time_limit (array): Job time limits (seconds).\n
+                * nodes (array): Number of nodes.\n
+                * cpus (array): Number of CPUs.\n
+                * memory (array): Memory (GB).\n
+                * time_left (array): Time left (seconds).\n
+                * priority (array): Job priorities.\n
+                * node_reason (list): List of node lists / pending reasons.\n
+                * user (list): List of usernames.\n
+                * account (list): List of accounts.\n
+                * gpus (array): Total number of GPUs.\n
+                * name (list): List of job names.\n
+                * jobs (array): 1 for each job.\n
+                * array_job_id (list): Job ID of the parent of each job
+                  array task (the job ID itself for other jobs).\n
+            Compressed PENDING job array rows (e.g. '123_[5-900%10]') are
+            expanded into one row per task ('123_5', ...).
     """
+    if parser not in ['delimited', 'fixed']:
+        raise ValueError(f"parser must be 'delimited' or 'fixed'. Found {parser}.")
     ## Get job information
-    ### squeue -u <username> --Format=(properties.values())
-    squeue_table = subprocess.check_output(["squeue", "-u", username, "--Format", ",".join(properties.values())]).decode().strip().split('\n')
+    backend = default_backend if backend is None else backend
+    timer = _timer(metrics)
+    usernames = [username] if isinstance(username, str) else username
+    with timer('squeue'):
+        output = backend.squeue(usernames=usernames, accounts=accounts, parser=parser)
+    with timer('parse'):
+        if parser == 'delimited':
+            return parse_squeue_delimited(output, cache=cache)
+        elif parser == 'fixed':
+            return parse_squeue_table(output, cache=cache)
+
+
+def parse_squeue_delimited(squeue_lines, cache=None):
+    """
+    Parses the lines of 'squeue -h -o <properties_format>' output, with fields
+    separated by '|', into a JobTable. Each line is split and converted in a
+    single pass with precompiled converters. See get_jobs_info for the output
+    format.
+    RH 2024
+
+    Args:
+        squeue_lines (list):
+            Lines of squeue output. No header line.
+        cache (SqueueCache):
+            Optional cache of parsed squeue rows. See parse_squeue_table.
+
+    Returns:
+        (JobTable):
+            Columnar table with one column per key in 'properties'.
+    """
+    squeue_lines = [line for line in squeue_lines if line]  ## squeue prints nothing if there are no jobs
+    n_split = len(_converters_row) - 1
+    split_line = lambda line: line.split(_delimiter, n_split)
+    get_job_id = lambda line: line[:line.find(_delimiter)]
+    rows = _parse_lines(squeue_lines, split_line=split_line, get_job_id=get_job_id, header=_delimiter.join(properties_format.values()), cache=cache)
+    return cache.table if cache is not None else JobTable.from_rows(_expand_array_rows(rows))
+
+
+def parse_squeue_table(squeue_table, cache=None):
+    """
+    Parses the lines of a fixed width squeue table (header line first) into a
+    JobTable. See get_jobs_info for the output format.
+    RH 2024
+
+    Args:
+        squeue_table (list):
+            Lines of squeue output. First line is the header.
+        cache (SqueueCache):
+            Optional cache of parsed squeue rows. If provided, rows whose raw
+            line is unchanged since the previous call are not parsed again, and
+            jobs that have left the queue are evicted from the cache. The
+            cache's JobTable is updated in place and returned.
+
+    Returns:
+        (JobTable):
+            Columnar table with one column per key in 'properties'.
+    """
     jobs_info = squeue_table[1:]  ## Skip header line
     header = squeue_table[0]  ## Get header line
 
     ## Handle case where no jobs are running
     if len(jobs_info) == 0:
-        return {key: [] for key in properties}
+        cache.update(header=header, rows={}) if cache is not None else None
+        return cache.table if cache is not None else JobTable.from_rows([])
     
-    starts = [v.start() for v in re.finditer('\S+', header.strip())]
+    starts = [v.start() for v in re.finditer(r'\S+', header.strip())]
     bounds = [slice(v1, v2) for v1, v2 in zip(starts, starts[1:] + [None,])]
-    ji_dict = {key: [line[bounds[i_key]].strip() for line in jobs_info] for i_key, key in enumerate(properties.keys())}
 
-    ## Convert time limit and submit time to datetime objects
-    ji_dict['time_limit'] = [_parse_slurm_duration(t) for t in ji_dict['time_limit']]
-    ji_dict['time_left']  = [_parse_slurm_duration(t) for t in ji_dict['time_left']]
-    ji_dict['submit_time'] = [_parse_slurm_submit_time(t) for t in ji_dict['submit_time']]
-    
-    ## Get numeric values from memory string using regex
-    ji_dict['memory'] = [_parse_memory_string(m) for m in ji_dict['memory']]
-    
-    ## Convert nodes and cpus to integers
-    ji_dict['nodes'] = [int(n) for n in ji_dict['nodes']]
-    ji_dict['cpus'] = [int(c) for c in ji_dict['cpus']]
+    split_line = lambda line: [line[bound].strip() for bound in bounds]
+    get_job_id = lambda line: line[bounds[0]].strip()
+    rows = _parse_lines(jobs_info, split_line=split_line, get_job_id=get_job_id, header=header, cache=cache)
+    return cache.table if cache is not None else JobTable.from_rows(_expand_array_rows(rows))
 
-    ## Convert priority to floats
-    ji_dict['priority'] = [float(p) for p in ji_dict['priority']]
-    
-    return ji_dict
+
+def _parse_lines(lines, split_line, get_job_id, header, cache=None):
+    """
+    Parses squeue lines into row tuples. If a cache is provided, lines that
+    are unchanged since the previous call are not parsed again, only the
+    changed rows of cache.table are updated, and None is returned. Cached
+    rows are discarded if the header (column layout) changes.
+    """
+    if cache is None:
+        return _convert_rows([split_line(line) for line in lines])
+    rows_cached = cache.rows if cache.header == header else {}
+    rows_new = {}
+    lines_changed = []
+    for line in lines:
+        job_id = get_job_id(line)
+        row = rows_cached.get(job_id)
+        if (row is None) or (row[0] != line):
+            lines_changed.append((job_id, line))
+        rows_new[job_id] = row
+    rows_changed = _convert_rows([split_line(line) for _, line in lines_changed])
+    for (job_id, line), row in zip(lines_changed, rows_changed):
+        rows_new[job_id] = (line, row)
+    cache.update(header=header, rows=rows_new, n_parsed=len(lines_changed), changed=[job_id for job_id, _ in lines_changed])
+
+
+def _convert_rows(rows_fields):
+    """
+    Converts rows of squeue field strings, ordered as the keys in
+    'properties', into rows of values. Conversion is done column by column so
+    that each precompiled converter is mapped over a whole column at once.
+    """
+    if len(rows_fields) == 0:
+        return []
+    cols = [col if convert is str else list(map(convert, col)) for convert, col in zip(_converters_row, zip(*rows_fields))]
+    return list(zip(*cols))
+
+
+def _expand_array_rows(rows):
+    """
+    Expands rows of job arrays whose PENDING tasks squeue shows compressed
+    into one row (e.g. '123_[5-900%10]') into one row per task ('123_5',
+    '123_6', ...), so that resources are counted per task and tasks can be
+    held / released individually or as ranges.
+    """
+    if not any(['[' in row[0] for row in rows]):
+        return rows
+    rows_expanded = []
+    for row in rows:
+        if '[' in row[0]:
+            rest = row[1:]
+            rows_expanded.extend([(job_id,) + rest for job_id in _array_task_ids(row[0])])
+        else:
+            rows_expanded.append(row)
+    return rows_expanded
+
+
+@functools.lru_cache(maxsize=4096)
+def _array_task_ids(job_id):
+    """
+    Returns the job IDs of the tasks in a compressed job array ID, as a tuple.
+    Handles ranges, steps, lists and throttles, e.g. '123_[1-3,7,10-20:5%4]'
+    -> ('123_1', '123_2', '123_3', '123_7', '123_10', '123_15', '123_20').
+    Job IDs without a '[' are returned as is.
+    """
+    parent, sep, spec = job_id.partition('_[')
+    if not sep:
+        return (job_id,)
+    spec = spec.rstrip(']').split('%')[0]  ## Remove the throttle ('%N')
+    indices = []
+    for part in spec.split(','):
+        part, _, step = part.partition(':')
+        start, _, stop = part.partition('-')
+        indices.extend(range(int(start), int(stop or start) + 1, int(step or 1)))
+    return tuple([f"{parent}_{i}" for i in indices])
+
+
+def _compress_array_job_ids(job_ids):
+    """
+    Compresses job array task IDs into range expressions that scontrol
+    accepts, e.g. ['123_5', '123_6', '123_7', '123_9'] -> ['123_[5-7]',
+    '123_9'], so that a whole range of tasks is held or released with one job
+    ID. Ranges are contiguous and contain no commas, so the expressions can be
+    joined into comma-separated lists. Other job IDs are returned as is.
+
+    Returns:
+        (tuple):
+            tokens (list):
+                Job IDs and array range expressions.
+            members (dict):
+                {token: list of the job IDs in the token}.
+    """
+    indices_array = {}  ## {array_job_id: [task indices]}
+    keys = []  ## Job IDs and array job IDs, in order of first appearance
+    for job_id in job_ids:
+        parent, sep, index = job_id.partition('_')
+        if sep and index.isdigit():
+            if parent not in indices_array:
+                indices_array[parent] = []
+                keys.append(parent)
+            indices_array[parent].append(int(index))
+        else:
+            keys.append(job_id)
+    tokens, members = [], {}
+    for key in keys:
+        if key not in indices_array:
+            tokens.append(key)
+            members[key] = [key]
+            continue
+        indices = sorted(set(indices_array[key]))
+        for _, run in itertools.groupby(enumerate(indices), key=lambda x: x[1] - x[0]):
+            run = [i for _, i in run]
+            token = f"{key}_[{run[0]}-{run[-1]}]" if len(run) > 1 else f"{key}_{run[0]}"
+            tokens.append(token)
+            members[token] = [f"{key}_{i}" for i in run]
+    return tokens, members
+
+
+class JobTable:
+    """
+    Compact columnar table of jobs.\n
+    Numeric properties are stored in array.array columns, job states are
+    stored as interned integer codes, and the remaining properties are stored
+    as lists of strings. Sorting, filtering by state and cumulative sums are
+    done in single passes over the columns (vectorized with numpy if it is
+    installed). Columns can be accessed like a dictionary: jobs['nodes'].
+    RH 2024
+
+    Args:
+        columns (dict):
+            {key: column}. Must contain every key in 'properties'. The
+            'state' column must be an array of state codes.
+    """
+    keys_numeric = ('submit_time', 'time_limit', 'nodes', 'cpus', 'memory', 'time_left', 'priority', 'gpus', 'jobs')
+    states = ['PENDING', 'RUNNING']  ## Interned job states. Index is the state code. New states are appended.
+    _state_codes = {state: code for code, state in enumerate(states)}
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Makes a JobTable from a list of row tuples, ordered as the keys in
+        'properties'.
+        """
+        keys = list(properties.keys())
+        cols = list(zip(*rows)) if len(rows) > 0 else [()] * len(keys)
+        columns = {}
+        for key, col in zip(keys, cols):
+            if key == 'state':
+                columns[key] = array.array('b', [cls.state_code(v) for v in col])
+            elif key in cls.keys_numeric:
+                columns[key] = array.array('d', [float('nan') if v is None else v for v in col])
+            else:
+                columns[key] = list(col)
+        columns['gpus'] = array.array('d', map(operator.mul, columns['gpus'], columns['nodes']))  ## GPUs per node -> total GPUs
+        columns['jobs'] = array.array('d', [1.0]) * len(columns['job_id'])
+        columns['array_job_id'] = [job_id.partition('_')[0] for job_id in columns['job_id']]  ## Parent job ID of array tasks
+        return cls(columns)
+
+    def extend(self, other):
+        """Appends the rows of another JobTable, in place."""
+        for key, col in self.columns.items():
+            col.extend(other.columns[key])
+
+    def assign(self, idx, other):
+        """Overwrites the rows at indices idx with the rows of another JobTable (in order), in place."""
+        for key, col in self.columns.items():
+            for i, value in zip(idx, other.columns[key]):
+                col[i] = value
+
+    def keep(self, ranges):
+        """
+        Keeps only the rows in ranges, a sorted list of non-overlapping
+        (start, stop) index ranges, in place. Each range of each column is
+        copied with one slice.
+        """
+        for key, col in self.columns.items():
+            col_kept = col[:0]
+            for start, stop in ranges:
+                col_kept += col[start:stop]
+            self.columns[key] = col_kept
+
+    @classmethod
+    def state_code(cls, state):
+        """Returns the interned integer code for a job state string."""
+        code = cls._state_codes.get(state)
+        if code is None:
+            code = cls._state_codes[state] = len(cls.states)
+            cls.states.append(state)
+        return code
+
+    def __len__(self):
+        return len(self.columns['job_id'])
+
+    def __getitem__(self, key):
+        if key == 'state':
+            return [self.states[code] for code in self.columns['state']]
+        return self.columns[key]
+
+    def keys(self):
+        return self.columns.keys()
+
+    def _as_numpy(self, key):
+        return np.frombuffer(self.columns[key], dtype=np.int8 if key == 'state' else np.float64)
+
+    def argsort(self, key, ascending=True):
+        """
+        Returns the indices that would sort the table by 'key'. Descending
+        order is the reverse of the (stable) ascending order.
+        """
+        if (np is not None) and (key in self.keys_numeric) and (len(self) > 0):
+            idx = np.argsort(self._as_numpy(key), kind='stable').tolist()
+        else:
+            idx = native_argsort(self[key])
+        return idx if ascending else idx[::-1]
+
+    def where_state(self, state, idx=None):
+        """
+        Returns the indices of jobs with the given state. If idx is provided,
+        only those indices are considered and their order is preserved.
+        """
+        code = self.state_code(state)
+        idx = range(len(self)) if idx is None else idx
+        if (np is not None) and (len(idx) > 0):
+            idx = np.asarray(idx)
+            return idx[self._as_numpy('state')[idx] == code].tolist()
+        codes = self.columns['state']
+        return [i for i in idx if codes[i] == code]
+
+    def where(self, key, value, idx=None):
+        """
+        Returns the indices of jobs where string column 'key' equals value. If
+        idx is provided, only those indices are considered and their order is
+        preserved.
+        """
+        col = self.columns[key]
+        idx = range(len(self)) if idx is None else idx
+        return [i for i in idx if col[i] == value]
+
+    def subset(self, idx):
+        """Returns a new JobTable containing only the jobs at indices idx."""
+        return JobTable({
+            key: array.array(col.typecode, [col[i] for i in idx]) if isinstance(col, array.array) else [col[i] for i in idx]
+            for key, col in self.columns.items()
+        })
+
+    def take(self, key, idx):
+        """Returns the values of column 'key' at indices idx as a list."""
+        col = self.columns[key] if key != 'state' else self['state']
+        return [col[i] for i in idx]
+
+    def sum(self, key, idx=None):
+        """Returns the sum of numeric column 'key' over indices idx."""
+        if idx is None:
+            return sum(self.columns[key])
+        if (np is not None) and (len(idx) > 0):
+            return float(self._as_numpy(key)[np.asarray(idx)].sum())
+        col = self.columns[key]
+        return sum([col[i] for i in idx])
+
+    def cumsum(self, key, idx=None):
+        """Returns the cumulative sum of numeric column 'key' over indices idx as a list."""
+        idx = range(len(self)) if idx is None else idx
+        if (np is not None) and (len(idx) > 0):
+            return np.cumsum(self._as_numpy(key)[np.asarray(idx)]).tolist()
+        col = self.columns[key]
+        return list(itertools.accumulate(col[i] for i in idx))
+
+
+class SqueueCache:
+    """
+    Persistent table of parsed squeue rows, keyed by job ID.\n
+    Holds the raw line and parsed values for each job so that unchanged rows
+    are not parsed again on the next tick, and a JobTable of the current jobs
+    that is updated in place: changed rows are overwritten, new rows are
+    appended and the rows of jobs that left the queue are cut out with one
+    slice per kept range. Rows are in order of first appearance, not in
+    squeue order. A table returned by one update changes with the next.
+    RH 2024
+
+    Attributes:
+        header (str):
+            Header line of the last parsed squeue table.
+        rows (dict):
+            {job_id: (raw_line, parsed_row)}.
+        table (JobTable):
+            Jobs of the last update. Compressed job array rows are expanded
+            into one row per task.
+        n_parsed (int):
+            Number of rows parsed during the last update.
+        n_evicted (int):
+            Number of jobs evicted during the last update.
+    """
+    def __init__(self):
+        self.header = None
+        self.rows = {}
+        self.table = JobTable.from_rows([])
+        self.n_parsed = 0
+        self.n_evicted = 0
+        self._keys = []  ## squeue job ID of each row of table. A compressed array row spans several rows.
+        self._last = {}  ## {squeue job ID: index of its last row in table}
+        self._count = {}  ## {squeue job ID: number of rows in table}
+
+    def update(self, header, rows, n_parsed=0, changed=None):
+        """
+        Replaces the cached rows and updates the table.\n
+        'changed' lists the job IDs whose lines were parsed in this update
+        (new or changed jobs). Only their rows and the rows of jobs that are
+        gone are touched. If changed is None or the header changed, the table
+        is rebuilt from all rows.
+        """
+        removed = [job_id for job_id in self.rows if job_id not in rows]
+        if (changed is None) or (header != self.header):
+            self._rebuild(rows)
+        else:
+            self._apply(rows, list(dict.fromkeys(changed)), removed)
+        self.n_evicted = len(removed)
+        self.header = header
+        self.rows = rows
+        self.n_parsed = n_parsed
+
+    def _rebuild(self, rows):
+        self.table, self._keys, self._last, self._count = JobTable.from_rows([]), [], {}, {}
+        self._append([(job_id, row) for job_id, (_, row) in rows.items()])
+
+    def _append(self, items):
+        """Appends [(squeue job ID, row), ...] to the table, expanding compressed job array rows."""
+        keys, rows_expanded = [], []
+        for job_id, row in items:
+            rows_job = _expand_array_rows([row]) if '[' in job_id else [row]
+            keys.extend([job_id] * len(rows_job))
+            rows_expanded.extend(rows_job)
+            self._count[job_id] = len(rows_job)
+        n_before = len(self._keys)
+        self.table.extend(JobTable.from_rows(rows_expanded))
+        self._keys.extend(keys)
+        self._last.update(zip(keys, range(n_before, n_before + len(keys))))
+
+    def _apply(self, rows, changed, removed):
+        ## Single rows that changed are overwritten. Array rows may change size, so they are cut out and appended again.
+        idx_assign, rows_assign, items_append, drop = [], [], [], list(removed)
+        for job_id in changed:
+            row = rows[job_id][1]
+            if (self._count.get(job_id) == 1) and ('[' not in job_id):
+                idx_assign.append(self._last[job_id])
+                rows_assign.append(row)
+            else:
+                drop.append(job_id) if job_id in self._count else None
+                items_append.append((job_id, row))
+        if len(idx_assign) > 0:
+            self.table.assign(idx_assign, JobTable.from_rows(rows_assign))
+        if len(drop) > 0:
+            idx_drop = sorted([i for job_id in drop for i in range(self._last[job_id] - self._count.pop(job_id) + 1, self._last[job_id] + 1)])
+            ranges, start = [], 0
+            for i in idx_drop:
+                ranges.append((start, i)) if i > start else None
+                start = i + 1
+            ranges.append((start, len(self._keys))) if start < len(self._keys) else None
+            self.table.keep(ranges)
+            keys_kept = []
+            for start, stop in ranges:
+                keys_kept += self._keys[start:stop]
+            self._keys = keys_kept
+            self._last = dict(zip(self._keys, range(len(self._keys))))
+        if len(items_append) > 0:
+            self._append(items_append)
+
+    def __len__(self):
+        return len(self.rows)
 
 
 def manage_jobs(
@@ -231,7 +880,18 @@ def manage_jobs(
     order_ascending: bool = False,
     verbose: int = 0,
     dry_run: bool = False,
-) -> None:
+    max_command_length: int = None,
+    cache: 'SqueueCache' = None,
+    parser: str = 'delimited',
+    jobs: 'JobTable' = None,
+    limits: dict = None,
+    release_policy: str = 'prefix',
+    fairshare_cache: 'FairshareCache' = None,
+    backend: 'SlurmBackend' = None,
+    metrics: 'Metrics' = None,
+    journal: 'DecisionJournal' = None,
+    horizon: float = 0,
+) -> dict:
     """
     Manages jobs based on the specified constraints.
     RH 2024
@@ -246,8 +906,9 @@ def manage_jobs(
             Options:\n
                 * 'nodes': Number of nodes.\n
                 * 'cpus': Number of CPUs.\n
-                * 'memory': Total memory.\n
-                * 'time_left': Total time left.\n
+                * 'memory': Total memory (GB).\n
+                * 'gpus': Total number of GPUs.\n
+                * 'time_left': Total time left (seconds).\n
                 * 'jobs': Total number of running jobs.\n
                 * 'fairshare': Fairshare score for user.\n
         value_max (int):
@@ -266,88 +927,804 @@ def manage_jobs(
         dry_run (bool):
             If True, do not actually hold or release jobs.\n
             Should be used with verbose>1 to see what would be done.
+        max_command_length (int):
+            If not None, hold and release jobs in batches by passing
+            comma-separated lists of job IDs to scontrol. Each call is limited
+            to this many characters. If None, scontrol is called once per job.
+        cache (SqueueCache):
+            Optional cache of parsed squeue rows that persists across calls.
+            If provided, only changed squeue rows are parsed on each call.
+        parser (str):
+            squeue output format to request and parse. 'delimited' or 'fixed'.
+            See get_jobs_info.
+        jobs (JobTable):
+            Optional table of jobs to manage, e.g. a subset of a snapshot
+            shared between users (see manage_jobs_multi). If None, squeue is
+            called for 'username'.
+        limits (dict):
+            Optional {constraint: value_max} to enforce several constraints at
+            once, e.g. {'nodes': 36, 'memory': 2048, 'gpus': 8}. Jobs are held
+            if any limit is reached. If None, {constraint: value_max} is used.
+        release_policy (str):
+            How PENDING jobs are packed into the free capacity. 'prefix' or
+            'greedy'. See decide_jobs.
+        fairshare_cache (FairshareCache):
+            Optional cache of sshare results that persists across calls. If
+            the 'fairshare' constraint is used, the user's fairshare is
+            looked up from the cache instead of calling sshare every tick.
+            Otherwise the cache is not queried, and only a value already in
+            it is reported in the summary.
+        backend (SlurmBackend):
+            Backend for squeue, sshare and scontrol, e.g. a
+            SubprocessSlurmBackend (real slurm commands) or a simulated
+            cluster. If None, default_backend is used.
+        metrics (Metrics):
+            Optional. Records the time taken by each phase of the tick
+            ('squeue', 'parse', 'sort', 'journal', 'fairshare', 'decide',
+            'scontrol').
+        journal (DecisionJournal):
+            Optional persistent journal of the jobs held by job_holder. If
+            provided, only jobs held by job_holder are released, and jobs
+            held by someone else are ignored (they neither use capacity nor
+            get released). If None, every PENDING job can be released.
+        horizon (float):
+            Look-ahead in seconds. See decide_jobs. Default: 0 (no
+            look-ahead).
+
+    Returns:
+        (dict):
+            Summary of the tick:\n
+                * n_jobs (int): Number of jobs found.\n
+                * n_running (int): Number of RUNNING jobs.\n
+                * n_pending (int): Number of PENDING jobs.\n
+                * n_held (int): Number of PENDING jobs held by the user.\n
+                * job_ids_running (frozenset): IDs of RUNNING jobs.\n
+                * time_left_min (float): Smallest time left (seconds) of the
+                  RUNNING jobs. None if there are no RUNNING jobs.\n
+                * time_to_horizon (float): Time (seconds) until the next
+                  RUNNING job comes within the look-ahead horizon. None if
+                  there is no such job.\n
+                * fairshare (float): Cached fairshare of the user. None if no
+                  fairshare_cache is used.\n
+                * values_constrained (dict): Value of each constraint.\n
+                * limits (dict): value_max of each constraint.\n
+                * n_hold (int): Number of jobs held.\n
+                * n_release (int): Number of jobs released.\n
+                * n_forks (int): Number of scontrol calls.\n
+                * failures (list): Job IDs for which scontrol failed.\n
+                * time_tick (float): Wall time of the tick in seconds.
     """
+    tic = time.perf_counter()
     verbose = int(verbose)  ## Ensure verbosity is an integer
     time_now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    timer = _timer(metrics)
 
     ## Get jobs information
-    jobs = get_jobs_info(username)
-    print(f"Fetched jobs. Found {len(jobs['job_id'])} jobs.") if verbose > 2 else None
+    jobs_fetched = jobs is None
+    if jobs_fetched:
+        jobs = get_jobs_info(username, cache=cache, parser=parser, backend=backend, metrics=metrics)
+        print(f"squeue cache: parsed {cache.n_parsed} rows, evicted {cache.n_evicted} jobs.") if (verbose > 2) and (cache is not None) else None
+    print(f"Fetched jobs. Found {len(jobs)} jobs.") if verbose > 2 else None
     print(f"squeue keys found: {jobs.keys()}") if verbose > 2 else None
-    ## Assert all values are the same length
-    assert all([len(val) == len(jobs['job_id']) for val in jobs.values()]), "Length mismatch in jobs dict."
-
-    ## Append another key to jobs dict for 'job' which is the number of running jobs
-    jobs['jobs'] = [1 for _ in jobs['job_id']]
 
     ## Handle case where no jobs are running
-    if len(jobs['job_id']) == 0:
+    if len(jobs) == 0:
         print("No jobs found. No action taken.") if verbose > 1 else None
-        return None
+        journal.prune([]) if (journal is not None) and jobs_fetched else None
+        return _tick_summary(jobs=jobs, time_tick=time.perf_counter() - tic)
     
-    ##  Sort jobs based on the order_by preference
-    idx_ordered = native_argsort(jobs[order_jobs_by])[::-1]  ## Order is descending by default
-    if bool(order_ascending):
-        idx_ordered = idx_ordered[::-1]  ## Reverse the order if order_ascending is True
-    jobs_sorted = {key: [val[idx] for idx in idx_ordered] for key, val in jobs.items()}  ## Dict with each list sorted by 'order_by' from highest to lowest
-    jobs_sorted_running, jobs_sorted_pending = (
-        {
-            key: [
-                jobs[key][idx] for idx in idx_ordered if jobs['state'][idx] == state
-            ] for key in jobs_sorted.keys()
-        } for state in ['RUNNING', 'PENDING']
-    )  ## Split jobs_sorted into RUNNING and PENDING jobs
+    ##  Sort jobs based on the order_by preference. Order is descending by default.
+    with timer('sort'):
+        idx_ordered = jobs.argsort(order_jobs_by, ascending=bool(order_ascending))
+        ## Split sorted job indices into RUNNING and PENDING jobs
+        idx_running = jobs.where_state('RUNNING', idx_ordered)
+        idx_pending = jobs.where_state('PENDING', idx_ordered)
     print(f"Jobs sorted by {order_jobs_by}.") if verbose > 2 else None
+
+    ## Journal observed job states and ignore jobs held by someone else
+    if journal is not None:
+        with timer('journal'):
+            journal.observe(jobs)
+            journal.prune(jobs['job_id']) if jobs_fetched else None
+            job_id, node_reason = jobs['job_id'], jobs['node_reason']
+            idx_pending = [i for i in idx_pending if (not _is_held(node_reason[i])) or journal.is_ours(job_id[i])]
     
-    ## Get constrained resource value
-    if constraint == 'fairshare':
-        ## Get fairshare for user
-        fairshare = float(subprocess.check_output(["sshare", "-u", username, "-U"]).decode().strip().split('\n')[-1].split()[-1])
-        value_constrained = fairshare
-    else:
-        value_constrained = sum(jobs_sorted_running[constraint])
-    print(f"Value constrained calculated: {value_constrained}") if verbose > 2 else None
-    
-    if value_constrained >= value_max:
-        print(f"Time: {time_now}. Found {len(jobs['job_id'])} jobs. value_constrained ({value_constrained}) >= value_max ({value_max}). Executing scontrol hold on {len(jobs_sorted_pending['job_id'])} jobs.") if verbose > 1 else None
-        # Hold any pending jobs
-        for i_job, job_id in enumerate(jobs_sorted_pending['job_id']):
-            if 'JobHeldUser'.lower() not in jobs_sorted_pending['node_reason'][i_job].lower():
-                try:
-                    subprocess.run(["scontrol", "hold", job_id]) if not dry_run else None
-                except subprocess.CalledProcessError as e:
-                    print(f"Error holding job {job_id}.") if verbose > 0 else None
-                print(f"Holding job {job_id}.") if verbose > 2 else None
-            else:
-                print(f"Job {job_id} already held.") if verbose > 2 else None
-    else:
-        print(f"Value constrained < value_max. Entering release mode.") if verbose > 2 else None
-        ## Calculate number of jobs to release
-        ### Get cumulative sum of the constraint for each pending job
-        cumsum = list(itertools.accumulate(jobs_sorted_pending[constraint]))
-        print(f"cumsum of constraint: {cumsum}") if verbose > 2 else None
-        ### Get number of jobs to release
-        n_jobs_to_release = sum([1 for c in cumsum if c + value_constrained <= value_max])
-        print(f"Time: {time_now}. Found {len(jobs['job_id'])} jobs. value_constrained ({value_constrained}) < value_max ({value_max}). Executing scontrol release on {n_jobs_to_release} jobs.") if verbose > 1 else None
-        ### Release jobs
-        for i_job, job_id in enumerate(jobs_sorted_pending['job_id']):
-            if i_job < n_jobs_to_release:
-                try:
-                    subprocess.run(["scontrol", "release", job_id]) if not dry_run else None
-                except subprocess.CalledProcessError as e:
-                    print(f"Error releasing job {job_id}.") if verbose > 0 else None
-                print(f"Releasing job {job_id}.") if verbose > 2 else None
-            else:
-                print(f"Job {job_id} not released.") if verbose > 2 else None
-                break
+    ## Get values of constraints that are not properties of jobs
+    limits = {constraint: value_max} if limits is None else limits
+    values_external = {}
+    if 'fairshare' in limits:
+        ## Get fairshare for user (cached, refreshed in the background)
+        fairshare_cache = FairshareCache(backend=backend, verbose=verbose) if fairshare_cache is None else fairshare_cache
+        with timer('fairshare'):
+            values_external['fairshare'] = fairshare_cache.get(username)
+        if values_external['fairshare'] is None:
+            print(f"Fairshare for user {username} is not available. No action taken.") if verbose > 0 else None
+            return _tick_summary(jobs=jobs, idx_running=idx_running, idx_pending=idx_pending, limits=limits, time_tick=time.perf_counter() - tic, horizon=horizon)
+
+    ## Decide which jobs to hold / release
+    with timer('decide'):
+        decision = decide_jobs(
+            jobs=jobs,
+            limits=limits,
+            idx_running=idx_running,
+            idx_pending=idx_pending,
+            release_policy=release_policy,
+            values_external=values_external,
+            horizon=horizon,
+            verbose=verbose,
+        )
+    values_constrained, job_ids_hold, job_ids_release = decision['values_constrained'], decision['job_ids_hold'], decision['job_ids_release']
+    if journal is not None:
+        ## Jobs that are not held by job_holder do not need to be released
+        job_ids_release = [job_id for job_id in job_ids_release if journal.is_ours(job_id)]
+    str_values = ", ".join([f"{key}: {values_constrained[key]} / {limits[key]}" for key in limits])
+    str_values += f". Projected within {horizon} s: " + ", ".join([f"{key}: {decision['values_projected'][key]}" for key in limits]) if horizon > 0 else ""
+
+    str_limit = "Limit reached" if decision['hold'] else "Below limits"
+    print(f"Time: {time_now}. Found {len(jobs)} jobs. {str_limit} (value_constrained / value_max: {str_values}). Executing scontrol hold on {len(job_ids_hold)} jobs and scontrol release on {len(job_ids_release)} jobs.") if verbose > 1 else None
+    n_forks, failures = 0, []
+    with timer('scontrol'):
+        for action, job_ids_action in [('hold', job_ids_hold), ('release', job_ids_release)]:
+            if len(job_ids_action) == 0:
+                continue
+            journal.record('hold', job_ids_action) if (journal is not None) and (action == 'hold') and (not dry_run) else None  ## Write-ahead
+            n_forks_action, failures_action = scontrol_jobs(
+                action=action,
+                job_ids=job_ids_action,
+                max_command_length=max_command_length,
+                dry_run=dry_run,
+                verbose=verbose,
+                backend=backend,
+            )
+            if (journal is not None) and (not dry_run):
+                failures_set = set(failures_action)
+                if action == 'hold':
+                    journal.discard(failures_action, reason='scontrol hold failed')
+                else:
+                    journal.record('release', [job_id for job_id in job_ids_action if job_id not in failures_set])
+            n_forks, failures = n_forks + n_forks_action, failures + failures_action
+
+    print(f"Tick finished. scontrol calls: {n_forks}, failures: {len(failures)}, wall time: {time.perf_counter() - tic:.3f} s.") if verbose > 1 else None
+
+    return _tick_summary(
+        jobs=jobs,
+        idx_running=idx_running,
+        idx_pending=idx_pending,
+        fairshare=fairshare_cache.get(username, refresh=False) if fairshare_cache is not None else None,
+        values_constrained=values_constrained,
+        limits=limits,
+        n_hold=len(job_ids_hold),
+        n_release=len(job_ids_release),
+        n_forks=n_forks,
+        failures=failures,
+        time_tick=time.perf_counter() - tic,
+        horizon=horizon,
+    )
+
+
+def decide_jobs(
+    jobs: 'JobTable',
+    limits: dict,
+    idx_running: list,
+    idx_pending: list,
+    release_policy: str = 'prefix',
+    values_external: dict = {},
+    horizon: float = 0,
+    verbose: int = 0,
+) -> dict:
+    """
+    Decides which PENDING jobs to hold or release given several limits on
+    the RUNNING jobs. Does not call any slurm commands.\n
+    Each tick, the PENDING jobs are fit in order into the room left under
+    every limit by the RUNNING jobs. Held jobs that fit are released and
+    unheld jobs that do not fit are held, so a saturated limit only holds
+    the jobs that need more of it. If a limit that PENDING jobs do not add
+    to (e.g. fairshare) is reached, no job fits.\n
+    With a look-ahead horizon, RUNNING jobs whose time left is within the
+    horizon are counted as already finished. Their capacity is released to
+    PENDING jobs early, so that released jobs have been through the slurm
+    scheduler queue by the time the capacity frees up.
+    RH 2024
+
+    Args:
+        jobs (JobTable):
+            Table of jobs.
+        limits (dict):
+            {key: value_max}. key is a numeric column of 'jobs' (e.g. 'nodes',
+            'memory', 'gpus') or a key of values_external (e.g. 'fairshare').
+        idx_running (list):
+            Indices of RUNNING jobs.
+        idx_pending (list):
+            Indices of PENDING jobs, in the order in which they should be
+            released.
+        release_policy (str):
+            How PENDING jobs are packed into the free capacity.\n
+                * 'prefix': The longest prefix of the ordered PENDING jobs
+                  that fits. Stops at the first job that does not fit.\n
+                * 'greedy': First-fit. Walk the ordered PENDING jobs and fit
+                  every job whose needs are within the remaining room for
+                  every limit, skipping jobs that do not fit.\n
+        values_external (dict):
+            {key: value}. Values of limits that are not job properties (e.g.
+            the user's fairshare). PENDING jobs do not add to these values.
+        horizon (float):
+            Look-ahead in seconds. 0 for no look-ahead. Since time left is
+            measured to the time limit, which jobs usually finish before,
+            the projection is conservative.
+        verbose (int):
+            Verbosity level.
+
+    Returns:
+        (dict):
+            * hold (bool): True if a limit is reached by the RUNNING jobs
+              (projected over the horizon).\n
+            * values_constrained (dict): {key: value} for each limit.\n
+            * values_projected (dict): {key: value} for each limit, without
+              the RUNNING jobs that end within the horizon.\n
+            * job_ids_hold (list): IDs of unheld jobs that do not fit.\n
+            * job_ids_release (list): IDs of held jobs that fit.
+    """
+    assert release_policy in ['prefix', 'greedy'], f"release_policy must be 'prefix' or 'greedy'. Found {release_policy}."
+    keys_jobs = [key for key in limits if key not in values_external]
+    values_constrained = {key: jobs.sum(key, idx_running) for key in keys_jobs}
+    values_constrained.update({key: values_external[key] for key in limits if key in values_external})
+    print(f"Values constrained calculated: {values_constrained}") if verbose > 2 else None
+
+    ## Project the values once the RUNNING jobs ending within the horizon have finished
+    values_projected = dict(values_constrained)
+    if horizon > 0:
+        time_left = jobs['time_left']
+        idx_ending = [i for i in idx_running if time_left[i] <= horizon]
+        values_projected.update({key: values_constrained[key] - jobs.sum(key, idx_ending) for key in keys_jobs})
+        print(f"{len(idx_ending)} RUNNING jobs end within {horizon} s. Values projected: {values_projected}") if verbose > 2 else None
+
+    hold = any([values_projected[key] >= limits[key] for key in limits])
+    if any([values_external[key] >= limits[key] for key in limits if key in values_external]):
+        ## A limit that PENDING jobs do not add to is reached: no job fits
+        print("External limit reached. No PENDING job fits.") if verbose > 2 else None
+        idx_fit = []
+    elif release_policy == 'prefix':
+        ## Number of jobs that fit is the shortest prefix over all limits
+        ### Get cumulative sum of each constraint for each pending job
+        room = {key: limits[key] - values_projected[key] for key in keys_jobs}
+        n_jobs_fit = len(idx_pending)
+        for key in keys_jobs:
+            cumsum = jobs.cumsum(key, idx_pending)
+            print(f"cumsum of {key}: {cumsum}") if verbose > 2 else None
+            n_jobs_fit = min(n_jobs_fit, sum([1 for c in cumsum if c <= room[key]]))
+        idx_fit = idx_pending[:n_jobs_fit]
+    elif release_policy == 'greedy':
+        ## First-fit against the room left by the RUNNING jobs and the jobs that fit so far
+        idx_fit = []
+        cols = [jobs[key] for key in keys_jobs]
+        room = [limits[key] - values_projected[key] for key in keys_jobs]
+        for i in idx_pending:
+            need = [col[i] for col in cols]
+            if not any([n > r for n, r in zip(need, room)]):
+                idx_fit.append(i)
+                room = [r - n for n, r in zip(need, room)]
+
+    ## Release the held jobs that fit and hold the unheld jobs that do not
+    set_fit = set(idx_fit)
+    node_reason = jobs['node_reason']
+    job_ids_release = jobs.take('job_id', [i for i in idx_fit if _is_held(node_reason[i])])
+    job_ids_hold = jobs.take('job_id', [i for i in idx_pending if (i not in set_fit) and (not _is_held(node_reason[i]))])
+    print(f"{len(idx_fit)} of {len(idx_pending)} PENDING jobs fit within the limits.") if verbose > 2 else None
+    [print(f"Releasing job {job_id}.") for job_id in job_ids_release] if verbose > 2 else None
+    [print(f"Holding job {job_id}.") for job_id in job_ids_hold] if verbose > 2 else None
+
+    return {
+        'hold': hold,
+        'values_constrained': values_constrained,
+        'values_projected': values_projected,
+        'job_ids_hold': job_ids_hold,
+        'job_ids_release': job_ids_release,
+    }
+
+
+def _tick_summary(jobs, idx_running=[], idx_pending=[], fairshare=None, values_constrained={}, limits={}, n_hold=0, n_release=0, n_forks=0, failures=[], time_tick=0, horizon=0):
+    """
+    Makes the summary dict returned by manage_jobs.
+    """
+    time_left_running = jobs.take('time_left', idx_running)
+    time_to_horizon = [t - horizon for t in time_left_running if t > horizon]
+    return {
+        'n_jobs': len(jobs),
+        'n_running': len(idx_running),
+        'n_pending': len(idx_pending),
+        'n_held': sum([_is_held(r) for r in jobs.take('node_reason', idx_pending)]),
+        'job_ids_running': frozenset(jobs.take('job_id', idx_running)),
+        'time_left_min': min(time_left_running) if len(time_left_running) > 0 else None,
+        'time_to_horizon': min(time_to_horizon) if len(time_to_horizon) > 0 else None,
+        'fairshare': fairshare,
+        'values_constrained': values_constrained,
+        'limits': limits,
+        'n_hold': n_hold,
+        'n_release': n_release,
+        'n_forks': n_forks,
+        'failures': failures,
+        'time_tick': time_tick,
+    }
+
+
+def manage_jobs_multi(
+    entries: list,
+    verbose: int = 0,
+    dry_run: bool = False,
+    max_command_length: int = None,
+    caches: dict = None,
+    parser: str = 'delimited',
+    fairshare_cache: 'FairshareCache' = None,
+    backend: 'SlurmBackend' = None,
+    metrics: 'Metrics' = None,
+    journal: 'DecisionJournal' = None,
+) -> dict:
+    """
+    Manages jobs for many users and/or accounts from a single squeue snapshot
+    per tick. At most two squeue calls are made per tick (one for all users
+    and one for all accounts), no matter how many entries there are.
+    RH 2024
+
+    Args:
+        entries (list):
+            List of dicts, one per managed user or account (see load_config).
+            Each dict has the keys: 'user', 'account', 'constraint',
+            'value_max', 'order_by', 'order_ascending', 'limits',
+            'release_policy', 'horizon'. Entries with a 'user'
+            manage that user's jobs (optionally only those in 'account').
+            Entries without a 'user' manage all jobs in 'account'. Entries
+            should not overlap.
+        verbose (int):
+            Verbosity level.
+        dry_run (bool):
+            If True, do not actually hold or release jobs.
+        max_command_length (int):
+            See manage_jobs.
+        caches (dict):
+            Optional {'user': SqueueCache, 'account': SqueueCache} that
+            persists across calls.
+        parser (str):
+            squeue output format to request and parse. See get_jobs_info.
+        fairshare_cache (FairshareCache):
+            Optional cache of sshare results shared by the entries with a
+            'fairshare' limit. Their users are refreshed with a single sshare
+            call. Other entries do not use it.
+        backend (SlurmBackend):
+            Backend for squeue, sshare and scontrol. If None, default_backend
+            is used.
+        metrics (Metrics):
+            Optional. Records the time taken by each phase of the tick. See
+            manage_jobs.
+        journal (DecisionJournal):
+            Optional persistent journal of the jobs held by job_holder, shared
+            by all entries. See manage_jobs.
+
+    Returns:
+        (dict):
+            Combined summary of all entries (see manage_jobs). The summary of
+            each entry is in 'entries', with the entry's 'user' and
+            'account'.
+    """
+    caches = {} if caches is None else caches
+    users = sorted({e['user'] for e in entries if e.get('user')})
+    accounts = sorted({e['account'] for e in entries if not e.get('user')})
+
+    ## Get one snapshot for all users and one for all accounts
+    tables = {}
+    if len(users) > 0:
+        tables['user'] = get_jobs_info(users, cache=caches.get('user'), parser=parser, backend=backend, metrics=metrics)
+    if len(accounts) > 0:
+        tables['account'] = get_jobs_info(None, cache=caches.get('account'), parser=parser, accounts=accounts, backend=backend, metrics=metrics)
+    print(f"Fetched jobs for {len(users)} users and {len(accounts)} accounts. Found {sum([len(t) for t in tables.values()])} jobs.") if verbose > 2 else None
+    journal.prune(itertools.chain(*[t['job_id'] for t in tables.values()])) if journal is not None else None
+
+    ## Fetch fairshare with one sshare call for all users of entries with a 'fairshare' limit
+    uses_fairshare = [bool(e.get('user')) and ('fairshare' in (e['limits'] if e['limits'] is not None else {e['constraint']: e['value_max']})) for e in entries]
+    fairshare_cache.add_users([e['user'] for e, u in zip(entries, uses_fairshare) if u]) if fairshare_cache is not None else None
+
+    summaries = []
+    for entry, use_fairshare in zip(entries, uses_fairshare):
+        if entry.get('user'):
+            table = tables['user']
+            idx = table.where('user', entry['user'])
+            idx = table.where('account', entry['account'], idx) if entry.get('account') else idx
+        else:
+            table = tables['account']
+            idx = table.where('account', entry['account'])
+        print(f"Managing jobs for user: {entry.get('user')}, account: {entry.get('account')}.") if verbose > 1 else None
+        summaries.append(manage_jobs(
+            username=entry.get('user'),
+            constraint=entry['constraint'],
+            value_max=entry['value_max'],
+            order_jobs_by=entry['order_by'],
+            order_ascending=entry['order_ascending'],
+            verbose=verbose,
+            dry_run=dry_run,
+            max_command_length=max_command_length,
+            jobs=table.subset(idx),
+            limits=entry['limits'],
+            release_policy=entry['release_policy'],
+            horizon=entry['horizon'],
+            fairshare_cache=fairshare_cache if use_fairshare else None,
+            backend=backend,
+            metrics=metrics,
+            journal=journal,
+        ))
+        summaries[-1].update({'user': entry.get('user'), 'account': entry.get('account')})
+    return _combine_summaries(summaries)
+
+
+def load_config(path, defaults={}):
+    """
+    Loads a JSON config file listing users and/or accounts to manage.
+    RH 2024
+
+    The file looks like:\n
+    {
+        "defaults": {"constraint": "nodes", "value_max": 12},
+        "entries": [
+            {"user": "ab123", "value_max": 36, "order_by": "priority"},
+            {"user": "cd456", "constraint": "cpus", "value_max": 200},
+            {"user": "ef789", "limits": {"nodes": 36, "memory": 2048, "gpus": 8}, "release_policy": "greedy", "horizon": 600},
+            {"account": "kempner_lab", "constraint": "jobs", "value_max": 50}
+        ]
+    }
+
+    Args:
+        path (str):
+            Path to the JSON config file.
+        defaults (dict):
+            Default values for keys that are missing from both the entry and
+            the "defaults" section of the file (e.g. from the command line).
+
+    Returns:
+        (list):
+            List of entry dicts. See manage_jobs_multi.
+    """
+    with open(path, 'r') as f:
+        config = json.load(f)
+    defaults = {
+        'user': None,
+        'account': None,
+        'constraint': 'nodes',
+        'value_max': 12,
+        'order_by': 'job_id',
+        'order_ascending': False,
+        'limits': None,
+        'release_policy': 'prefix',
+        'horizon': 0,
+        **defaults,
+        **config.get('defaults', {}),
+    }
+    entries = [{**defaults, **entry} for entry in config['entries']]
+    for entry in entries:
+        assert entry['user'] or entry['account'], f"Each entry must have a 'user' or an 'account'. Found {entry}."
+        assert entry['order_by'] in properties, f"order_by must be one of {list(properties.keys())}. Found {entry['order_by']}."
+        limits = entry['limits'] if entry['limits'] is not None else {entry['constraint']: entry['value_max']}
+        assert not (('fairshare' in limits) and (not entry['user'])), f"The 'fairshare' constraint requires a 'user'. Found {entry}."
+    return entries
+
 
-    return None
+def _combine_summaries(summaries):
+    """
+    Combines the summaries of several manage_jobs calls into one summary.
+    """
+    summary = {key: sum([s[key] for s in summaries]) for key in ['n_jobs', 'n_running', 'n_pending', 'n_held', 'n_hold', 'n_release', 'n_forks', 'time_tick']}
+    time_left_min = [s['time_left_min'] for s in summaries if s['time_left_min'] is not None]
+    time_to_horizon = [s['time_to_horizon'] for s in summaries if s['time_to_horizon'] is not None]
+    summary.update({
+        'job_ids_running': frozenset().union(*[s['job_ids_running'] for s in summaries]),
+        'time_left_min': min(time_left_min) if len(time_left_min) > 0 else None,
+        'time_to_horizon': min(time_to_horizon) if len(time_to_horizon) > 0 else None,
+        'values_constrained': {},
+        'limits': {},
+        'failures': [f for s in summaries for f in s['failures']],
+        'entries': summaries,
+    })
+    return summary
 
 
 #################
 #### HELPERS ####
 #################
 
+class SlurmCommandRunner:
+    """
+    Runs slurm commands (squeue, sshare, scontrol, ...) with asyncio.\n
+    Every call has a timeout, so a hung slurmctld cannot freeze the daemon.
+    Commands that fail with a transient error (e.g. 'Socket timed out') are
+    retried with exponential backoff and random jitter. Many commands can be
+    run concurrently (e.g. scontrol hold/release fan-out) with a bounded
+    number of processes at a time.\n
+    The worst case latency of a single command is:
+    (retries + 1) * timeout + backoff * (2**retries - 1) * 1.5 seconds.
+    RH 2024
+
+    Args:
+        timeout (float):
+            Timeout in seconds for each command.
+        max_concurrency (int):
+            Maximum number of commands running at the same time.
+        retries (int):
+            Maximum number of retries after a transient error.
+        backoff (float):
+            Base delay in seconds between retries. Doubles after each retry
+            and is multiplied by a random jitter in [0.5, 1.5].
+        verbose (int):
+            Verbosity level.
+    """
+    transient_errors = (
+        'socket timed out',
+        'unable to contact slurm controller',
+        'resource temporarily unavailable',
+        'slurm_receive_msg',
+    )
+
+    def __init__(self, timeout=30.0, max_concurrency=8, retries=3, backoff=1.0, verbose=0):
+        self.timeout = float(timeout)
+        self.max_concurrency = int(max_concurrency)
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self.verbose = int(verbose)
+
+        self.n_processes = 0  ## Total number of processes started, including retries
+
+    def run(self, cmd):
+        """
+        Runs a single command.
+
+        Returns:
+            (subprocess.CompletedProcess):
+                Result with stdout and stderr as bytes. Raises
+                subprocess.TimeoutExpired if the command timed out.
+        """
+        result = self.run_many([cmd])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def check_output(self, cmd):
+        """
+        Runs a single command and returns its stdout as bytes. Raises
+        subprocess.CalledProcessError if the command fails and
+        subprocess.TimeoutExpired if it times out.
+        """
+        result = self.run(cmd)
+        result.check_returncode()
+        return result.stdout
+
+    def run_many(self, cmds):
+        """
+        Runs several commands concurrently, at most max_concurrency at a time.
+
+        Returns:
+            (list):
+                One subprocess.CompletedProcess per command, in order. Commands
+                that timed out or could not be started are returned as the
+                exception (subprocess.TimeoutExpired or OSError) instead.
+        """
+        if len(cmds) == 0:
+            return []
+        return asyncio.run(self._run_many_async(cmds))
+
+    async def _run_many_async(self, cmds):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        return await asyncio.gather(*[self._run_async(cmd, semaphore) for cmd in cmds], return_exceptions=True)
+
+    async def _run_async(self, cmd, semaphore):
+        for attempt in range(self.retries + 1):
+            async with semaphore:
+                self.n_processes += 1
+                proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True)
+                try:
+                    stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=self.timeout)
+                except asyncio.TimeoutError:
+                    _kill_process_group(proc.pid)  ## Also kills children (e.g. wrapper scripts) holding the pipes open
+                    await proc.wait()
+                    print(f"Command timed out after {self.timeout} seconds: {' '.join(cmd)}") if self.verbose > 0 else None
+                    raise subprocess.TimeoutExpired(cmd, self.timeout)
+            result = subprocess.CompletedProcess(cmd, proc.returncode, stdout=stdout, stderr=stderr)
+            if (result.returncode == 0) or (not self._is_transient(result)) or (attempt == self.retries):
+                return result
+            delay = self.backoff * 2**attempt * random.uniform(0.5, 1.5)
+            print(f"Transient error from '{cmd[0]}': {stderr.decode().strip()}. Retrying in {delay:.1f} seconds.") if self.verbose > 0 else None
+            await asyncio.sleep(delay)
+
+    def _is_transient(self, result):
+        output = (result.stdout + result.stderr).decode(errors='replace').lower()
+        return any([e in output for e in self.transient_errors])
+
+
+def _kill_process_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class SlurmBackend:
+    """
+    Interface between job_holder and a slurm cluster. Everything job_holder
+    needs from slurm goes through these methods, so that the holder can run
+    against real slurm commands (SubprocessSlurmBackend) or against a
+    simulated cluster for testing and benchmarking off-cluster (see
+    job_holder_benchmark.SimulatedSlurmBackend).
+    RH 2024
+
+    Attributes:
+        n_calls (int):
+            Number of slurm calls made so far (e.g. processes started).
+    """
+    n_calls = 0
+
+    def squeue(self, usernames=None, accounts=None, parser='delimited'):
+        """
+        Returns a snapshot of the queue as lines of squeue output: 'squeue -h
+        -o <properties_format>' (no header) for parser='delimited', or
+        'squeue --Format <properties>' (header first) for parser='fixed'.
+        """
+        raise NotImplementedError
+
+    def sshare(self, users):
+        """Returns the output of 'sshare --parsable2 -U -u <users> -o Account,User,FairShare'."""
+        raise NotImplementedError
+
+    def scontrol(self, action, job_id_lists):
+        """
+        Runs 'scontrol <action> <job_id_list>' for each comma-separated job ID
+        list. Returns one subprocess.CompletedProcess (or exception) per list.
+        """
+        raise NotImplementedError
+
+    def whoami(self):
+        """Returns the current username."""
+        raise NotImplementedError
+
+
+class SubprocessSlurmBackend(SlurmBackend):
+    """
+    SlurmBackend that runs the real slurm commands through a
+    SlurmCommandRunner (timeouts, retries and bounded concurrency).
+    RH 2024
+
+    Args:
+        runner (SlurmCommandRunner):
+            Runner for the commands. If None, a runner with default settings
+            is made.
+    """
+    def __init__(self, runner=None):
+        self.runner = SlurmCommandRunner() if runner is None else runner
+
+    @property
+    def n_calls(self):
+        return self.runner.n_processes
+
+    def squeue(self, usernames=None, accounts=None, parser='delimited'):
+        filters = (["-u", ",".join(usernames)] if usernames else []) + (["-A", ",".join(accounts)] if accounts else [])
+        if parser == 'delimited':
+            ### squeue -h -u <user1,user2,...> -o '%i|%T|...'
+            cmd = ["squeue", "-h", *filters, "-o", _delimiter.join(properties_format.values())]
+        else:
+            ### squeue -u <user1,user2,...> --Format=(properties.values())
+            cmd = ["squeue", *filters, "--Format", ",".join(properties.values())]
+        return self.runner.check_output(cmd).decode().strip().split('\n')
+
+    def sshare(self, users):
+        return self.runner.check_output(["sshare", "--parsable2", "-U", "-u", ",".join(users), "-o", "Account,User,FairShare"]).decode()
+
+    def scontrol(self, action, job_id_lists):
+        return self.runner.run_many([["scontrol", action, job_id_list] for job_id_list in job_id_lists])
+
+    def whoami(self):
+        return self.runner.check_output(["whoami"]).decode().strip()
+
+
+## Backend used when no backend is passed to functions that call slurm
+default_backend = SubprocessSlurmBackend()
+
+
+def scontrol_jobs(
+    action: str,
+    job_ids: list,
+    max_command_length: int = None,
+    dry_run: bool = False,
+    verbose: int = 0,
+    backend: 'SlurmBackend' = None,
+):
+    """
+    Runs 'scontrol <action>' on a list of jobs.\n
+    Job array tasks are compressed into range expressions (e.g. '123_[5-900]')
+    so that whole ranges of tasks are handled by a single job ID.
+    If max_command_length is not None, job IDs are passed to scontrol as
+    comma-separated lists so that many jobs are handled by a single call.
+    The scontrol calls are run concurrently by the backend.
+    RH 2024
+
+    Args:
+        action (str):
+            scontrol action. Either 'hold' or 'release'.
+        job_ids (list):
+            List of job IDs (str).
+        max_command_length (int):
+            Maximum number of characters in each comma-separated list of job
+            IDs. If None, scontrol is called once per job.
+        dry_run (bool):
+            If True, do not actually call scontrol.
+        verbose (int):
+            Verbosity level.
+        backend (SlurmBackend):
+            Backend that runs scontrol. If None, default_backend is used.
+
+    Returns:
+        (tuple): 
+            n_forks (int):
+                Number of scontrol processes started, including retries.
+            failures (list):
+                List of job IDs for which scontrol reported an error. Array
+                ranges are expanded into the IDs of their tasks.
+    """
+    assert action in ['hold', 'release'], f"action must be 'hold' or 'release'. Found {action}."
+    backend = default_backend if backend is None else backend
+    tokens, members = _compress_array_job_ids(job_ids)
+    chunks = _chunk_job_ids(tokens, max_command_length=max_command_length)
+    [print(f"scontrol {action} {','.join(chunk)}") for chunk in chunks] if verbose > 2 else None
+    if dry_run:
+        return 0, []
+    n_calls = backend.n_calls
+    results = backend.scontrol(action, [",".join(chunk) for chunk in chunks])
+    failures = []
+    for chunk, result in zip(chunks, results):
+        if isinstance(result, Exception):
+            failures_chunk, output = list(chunk), repr(result)
+        else:
+            output = (result.stdout + result.stderr).decode(errors='replace')
+            failures_chunk = _parse_scontrol_failures(output, job_ids=chunk + [job_id for token in chunk for job_id in members[token] if job_id != token], returncode=result.returncode)
+        failures_chunk = list(dict.fromkeys([job_id for token in failures_chunk for job_id in members.get(token, [token])]))  ## Expand array ranges
+        if len(failures_chunk) > 0:
+            print(f"Error running scontrol {action} on jobs: {failures_chunk}. Output: {output.strip()}") if verbose > 0 else None
+        failures.extend(failures_chunk)
+    return backend.n_calls - n_calls, failures
+
+
+def _chunk_job_ids(job_ids, max_command_length=None):
+    """
+    Splits a list of job IDs into chunks whose comma-separated string is no
+    longer than max_command_length. If max_command_length is None, each chunk
+    contains a single job ID.
+    """
+    if max_command_length is None:
+        return [[job_id] for job_id in job_ids]
+    chunks, chunk, n_chars = [], [], 0
+    for job_id in job_ids:
+        n_chars_new = n_chars + len(job_id) + (1 if len(chunk) > 0 else 0)
+        if len(chunk) > 0 and n_chars_new > max_command_length:
+            chunks.append(chunk)
+            chunk, n_chars_new = [], len(job_id)
+        chunk.append(job_id)
+        n_chars = n_chars_new
+    chunks.append(chunk) if len(chunk) > 0 else None
+    return chunks
+
+
+def _parse_scontrol_failures(output, job_ids, returncode=0):
+    """
+    Finds which job IDs failed in the output of a batched scontrol call.\n
+    scontrol reports one error line per failed job (e.g. "scontrol: error:
+    Invalid job id specified for job 1234"). If the call failed but no job IDs
+    can be found in the output, all jobs in the call are considered failed.
+    """
+    set_ids = set(job_ids)
+    failures = []
+    for line in output.split('\n'):
+        if 'error' not in line.lower():
+            continue
+        failures.extend([t for t in re.findall(r'[\w\[\]\-%]+', line) if t in set_ids])
+    failures = list(dict.fromkeys(failures))  ## Remove duplicates, keep order
+    if (returncode != 0) and (len(failures) == 0):
+        failures = list(job_ids)
+    return failures
+
+
 def native_argsort(l):
     """
     Native Python argsort. Returns the indices that would sort a list.
@@ -364,11 +1741,552 @@ def native_argsort(l):
     return sorted(range(len(l)), key=lambda k: l[k])
                 
 
-class _RepeatTimer(threading.Timer):
-    def run(self):
-        while not self.finished.wait(self.interval):
-            self.function(*self.args, **self.kwargs)
+class FairshareCache:
+    """
+    Cache of fairshare values from sshare, with a time-to-live and background
+    refresh.\n
+    Slurm only recomputes fairshare every few minutes, so sshare is called at
+    most once per 'ttl' seconds, for all users at once. When a value is
+    stale, the stale value is returned immediately and a refresh is started
+    in a background thread. If sshare is slow or fails, the last known value
+    keeps being used and sshare is not tried again for retry_after seconds.
+    Users that sshare does not return are cached as None, so an unknown user
+    does not cost a blocking sshare call on every get().
+    RH 2024
+
+    Args:
+        ttl (float):
+            Time in seconds after which a value is refreshed.
+        backend (SlurmBackend):
+            Backend that runs sshare. The timeout and retries of a
+            SubprocessSlurmBackend apply. If None, default_backend is used.
+        background (bool):
+            If True, stale values are refreshed in a background thread. If
+            False, they are refreshed before get() returns.
+        retry_after (float):
+            Time in seconds after a failed sshare call before the next one.
+        verbose (int):
+            Verbosity level.
+    """
+    def __init__(self, ttl=300.0, backend=None, background=True, retry_after=60.0, verbose=0):
+        self.ttl = float(ttl)
+        self.backend = default_backend if backend is None else backend
+        self.background = bool(background)
+        self.retry_after = float(retry_after)
+        self.verbose = int(verbose)
+
+        self.values = {}  ## {user: fairshare}. None for users looked up without a value.
+        self.time_refreshed = None
+        self.time_failed = None
+        self.users = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def get(self, user, refresh=True):
+        """
+        Returns the cached fairshare of 'user'. Refreshes the cache if it is
+        stale. Returns None if no value is available.
+        """
+        if refresh:
+            self.add_users([user])
+            now = time.monotonic()
+            stale = (self.time_refreshed is None) or (now - self.time_refreshed > self.ttl)
+            stale = stale and ((self.time_failed is None) or (now - self.time_failed > self.retry_after))
+            if (user not in self.values) and (not self._refreshing()):
+                self.refresh()  ## No value yet: wait for one
+            elif stale:
+                self.refresh_background() if self.background else self.refresh()
+        return self.values.get(user)
+
+    def add_users(self, users):
+        """Adds users to the set of users refreshed by each sshare call."""
+        with self._lock:
+            self.users.update(users)
+
+    def _refreshing(self):
+        return (self._thread is not None) and self._thread.is_alive()
+
+    def refresh_background(self):
+        """Starts a refresh in a background thread if one is not running."""
+        if not self._refreshing():
+            self._thread = threading.Thread(target=self.refresh, daemon=True)
+            self._thread.start()
+
+    def refresh(self):
+        """Calls sshare once for all known users and updates the cache."""
+        users = sorted(self.users)
+        try:
+            output = self.backend.sshare(users)
+        except (subprocess.TimeoutExpired, subprocess.CalledProcessError, OSError) as e:
+            print(f"sshare failed or timed out. Using cached fairshare values. Retrying in {self.retry_after} s. Error: {repr(e)}") if self.verbose > 0 else None
+            with self._lock:
+                self.time_failed = time.monotonic()
+                [self.values.setdefault(user, None) for user in users]  ## Do not block on sshare again for these users
+            return
+        values = parse_sshare_parsable(output, users=users)
+        with self._lock:
+            self.values.update(values)
+            [self.values.setdefault(user, None) for user in users]  ## Not in the output: cached as no value
+            self.time_refreshed = time.monotonic()
+            self.time_failed = None
+        print(f"Refreshed fairshare: {values}") if self.verbose > 2 else None
+
+
+def parse_sshare_parsable(output, users):
+    """
+    Parses the output of 'sshare --parsable2 -o Account,User,FairShare' into
+    {user: fairshare}. Rows are selected by the 'User' column, not by
+    position. If a user has several associations (accounts), the first row
+    with a valid FairShare value is used.
+    RH 2024
+
+    Args:
+        output (str):
+            Output of sshare. First line is the header.
+        users (list):
+            Users to get fairshare values for.
+
+    Returns:
+        (dict):
+            {user: fairshare} for each user found in the output.
+    """
+    lines = [line for line in output.strip().split('\n') if line]
+    if len(lines) == 0:
+        return {}
+    header = [h.strip() for h in lines[0].split('|')]
+    i_user, i_fairshare = header.index('User'), header.index('FairShare')
+    values = {}
+    for line in lines[1:]:
+        fields = line.split('|')
+        user = fields[i_user].strip()
+        if (user in users) and (user not in values):
+            try:
+                values[user] = float(fields[i_fairshare])
+            except ValueError:
+                continue
+    return values
+
+
+class DecisionJournal:
+    """
+    Crash-safe, persistent journal of the hold / release decisions of
+    job_holder and of the observed states of jobs, stored in SQLite.\n
+    The journal remembers which jobs were held by job_holder itself, so that
+    after a restart:\n
+        * Only jobs held by job_holder are released. Jobs held by someone else
+          (e.g. manually by the user with scontrol hold) are left alone.\n
+        * No scontrol calls are repeated for jobs that are already in the
+          right state.\n
+    Holds are journaled before scontrol hold is run (write-ahead), and
+    releases after scontrol release succeeds, so a crash at any point cannot
+    leave a job held by job_holder that the journal does not know about.
+    Stale entries (e.g. a job released by the user) are reconciled against
+    squeue on every tick.\n
+    Tables:\n
+        * events: Append-only log of (time, job_id, event, detail). Events
+          are 'hold', 'release', 'unheld' (hold dropped outside of
+          job_holder) and 'state' (observed state change).\n
+        * held: Jobs currently held by job_holder.\n
+        * job_states: Last observed (state, held) of each job in the queue.\n
+    RH 2024
+
+    Args:
+        path (str):
+            Path to the SQLite database file. Created if it does not exist.
+        verbose (int):
+            Verbosity level.
+    """
+    def __init__(self, path, verbose=0):
+        self.path = path
+        self.verbose = int(verbose)
+
+        tic = time.perf_counter()
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS events (time REAL, job_id TEXT, event TEXT, detail TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS held (job_id TEXT PRIMARY KEY, time REAL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS job_states (job_id TEXT PRIMARY KEY, state TEXT, held INTEGER)")
+        ## Load the current state into memory
+        self.held = {job_id for (job_id,) in self.conn.execute("SELECT job_id FROM held")}
+        self.job_states = {job_id: (state, bool(held)) for job_id, state, held in self.conn.execute("SELECT job_id, state, held FROM job_states")}
+        self.time_load = time.perf_counter() - tic
+        print(f"Loaded decision journal {path}: {len(self.held)} jobs held by job_holder, {len(self.job_states)} job states, in {self.time_load*1000:.1f} ms.") if self.verbose > 1 else None
+
+    def is_ours(self, job_id):
+        """Returns True if the job was held by job_holder."""
+        return job_id in self.held
+
+    def record(self, action, job_ids):
+        """
+        Journals a hold (call before scontrol hold) or a release (call after
+        scontrol release) of job_ids.
+        """
+        assert action in ['hold', 'release'], f"action must be 'hold' or 'release'. Found {action}."
+        if len(job_ids) == 0:
+            return
+        t = time.time()
+        with self.conn:
+            self.conn.executemany("INSERT INTO events VALUES (?, ?, ?, NULL)", [(t, job_id, action) for job_id in job_ids])
+            if action == 'hold':
+                self.conn.executemany("INSERT OR REPLACE INTO held VALUES (?, ?)", [(job_id, t) for job_id in job_ids])
+                self.held.update(job_ids)
+            else:
+                self.conn.executemany("DELETE FROM held WHERE job_id = ?", [(job_id,) for job_id in job_ids])
+                self.held.difference_update(job_ids)
+
+    def discard(self, job_ids, reason='unheld'):
+        """
+        Removes jobs from the set of jobs held by job_holder without releasing
+        them (e.g. scontrol hold failed, or the hold was dropped elsewhere).
+        """
+        job_ids = [job_id for job_id in job_ids if job_id in self.held]
+        if len(job_ids) == 0:
+            return
+        t = time.time()
+        with self.conn:
+            self.conn.executemany("INSERT INTO events VALUES (?, ?, 'unheld', ?)", [(t, job_id, reason) for job_id in job_ids])
+            self.conn.executemany("DELETE FROM held WHERE job_id = ?", [(job_id,) for job_id in job_ids])
+        self.held.difference_update(job_ids)
+
+    def observe(self, jobs):
+        """
+        Journals state changes of the jobs in a JobTable and reconciles the
+        set of jobs held by job_holder with squeue: jobs that are no longer
+        PENDING and held are not held by job_holder anymore.
+        """
+        t = time.time()
+        changes = []
+        for job_id, state, reason in zip(jobs['job_id'], jobs['state'], jobs['node_reason']):
+            state_new = (state, _is_held(reason))
+            if self.job_states.get(job_id) != state_new:
+                self.job_states[job_id] = state_new
+                changes.append((job_id, *state_new))
+        if len(changes) > 0:
+            with self.conn:
+                self.conn.executemany("INSERT INTO events VALUES (?, ?, 'state', ?)", [(t, job_id, state) for job_id, state, _ in changes])
+                self.conn.executemany("INSERT OR REPLACE INTO job_states VALUES (?, ?, ?)", [(job_id, state, int(held)) for job_id, state, held in changes])
+        self.discard([job_id for job_id, state, held in changes if (job_id in self.held) and not (state == 'PENDING' and held)], reason='not held in squeue')
+        print(f"Journal: {len(changes)} job state changes, {len(self.held)} jobs held by job_holder.") if self.verbose > 2 else None
+
+    def prune(self, job_ids_present):
+        """
+        Forgets jobs that are no longer in the queue. job_ids_present must
+        contain every job in the queue that is managed with this journal.
+        """
+        job_ids_present = set(job_ids_present)
+        job_ids_gone = [job_id for job_id in self.job_states if job_id not in job_ids_present]
+        self.discard(job_ids_gone, reason='left queue')
+        if len(job_ids_gone) > 0:
+            with self.conn:
+                self.conn.executemany("DELETE FROM job_states WHERE job_id = ?", [(job_id,) for job_id in job_ids_gone])
+            [self.job_states.pop(job_id) for job_id in job_ids_gone]
+
+    def compact(self, max_age=7*24*60*60):
+        """
+        Deletes events older than max_age seconds and reclaims the space.
+        """
+        with self.conn:
+            n = self.conn.execute("DELETE FROM events WHERE time < ?", (time.time() - max_age,)).rowcount
+        self.conn.execute("VACUUM") if n > 0 else None
+        print(f"Journal: compacted, deleted {n} events older than {max_age / 86400:.1f} days.") if self.verbose > 1 else None
+
+    def close(self):
+        self.conn.close()
+
 
+def _is_held(node_reason):
+    """Returns True if a PENDING job's squeue reason says it is held by the user."""
+    return 'JobHeldUser'.lower() in node_reason.lower()
+
+
+class AdaptiveScheduler:
+    """
+    Runs a function repeatedly with an adaptive interval. Ticks never overlap:
+    each wait starts after the previous tick has finished.\n
+    The interval grows by 'backoff' after every tick in which nothing
+    changed, up to interval_max. It is reset to interval_min when RUNNING jobs
+    start or finish, or when the number of PENDING or held jobs changes. It is
+    also shortened so that the next tick happens when the RUNNING job with
+    the least time left is about to end (or, with a look-ahead horizon, is
+    about to come within the horizon).
+    RH 2024
+
+    Args:
+        function (callable):
+            Function to run. Should return the summary dict from manage_jobs
+            (or None).
+        interval_min (float):
+            Minimum interval in seconds.
+        interval_max (float):
+            Maximum interval in seconds.
+        backoff (float):
+            Factor by which the interval grows after a tick without changes.
+        verbose (int):
+            Verbosity level.
+    """
+    def __init__(self, function, interval_min=5.0, interval_max=60.0, backoff=2.0, verbose=0):
+        self.function = function
+        self.interval_min = float(interval_min)
+        self.interval_max = max(float(interval_max), self.interval_min)
+        self.backoff = float(backoff)
+        self.verbose = int(verbose)
+
+        self.interval = self.interval_min
+        self.summary_last = None
+        self.finished = threading.Event()
+
+    def next_interval(self, summary):
+        """
+        Returns the interval to wait before the next tick, given the summary of
+        the last tick.
+        """
+        if summary is None:
+            interval = min(self.interval * self.backoff, self.interval_max)
+        elif (self.summary_last is None) or self._changed(self.summary_last, summary):
+            interval = self.interval_min
+        else:
+            interval = min(self.interval * self.backoff, self.interval_max)
+
+        ## Wake up when the next RUNNING job is about to end (or comes within the look-ahead horizon)
+        if (summary is not None) and (summary['time_to_horizon'] is not None):
+            interval = min(interval, max(self.interval_min, summary['time_to_horizon']))
+
+        self.summary_last = summary if summary is not None else self.summary_last
+        self.interval = interval
+        return interval
+
+    @staticmethod
+    def _changed(summary_old, summary_new):
+        return (
+            (summary_old['job_ids_running'] != summary_new['job_ids_running']) or
+            (summary_old['n_pending'] != summary_new['n_pending']) or
+            (summary_old['n_held'] != summary_new['n_held'])
+        )
+
+    def run(self, duration=float('inf')):
+        """
+        Runs ticks until 'duration' seconds have passed or cancel() is called.
+        """
+        time_end = time.monotonic() + duration
+        while not self.finished.is_set():
+            try:
+                summary = self.function()
+            except Exception as e:
+                print(f"Error during tick: {repr(e)}") if self.verbose > 0 else None
+                summary = None
+            interval = self.next_interval(summary)
+            interval = min(interval, max(time_end - time.monotonic(), 0))
+            print(f"Next tick in {interval:.1f} seconds.") if self.verbose > 2 else None
+            if (interval <= 0) or self.finished.wait(interval):
+                break
+
+    def cancel(self):
+        self.finished.set()
+
+
+class Metrics:
+    """
+    Instrumentation for job_holder. Records per-phase latency histograms,
+    queue sizes, the number of holds / releases issued, and each constrained
+    value against its value_max.\n
+    Metrics are rendered in the Prometheus text exposition format. They can be
+    served over HTTP (serve) and/or written to a file after every tick
+    (path_file). One JSON line per tick is also appended to
+    path_file + '.log', which is rotated, so the constrained values can be
+    followed over time without a Prometheus server.\n
+    A single tick can be profiled with cProfile on demand (request_profile,
+    which is safe to call from a signal handler, e.g. SIGUSR1).
+    RH 2024
+
+    Args:
+        buckets (tuple):
+            Upper bounds (seconds) of the latency histogram buckets.
+        path_file (str):
+            Optional. Path of the metrics file, replaced atomically after
+            every tick.
+        max_bytes (int):
+            Size in bytes at which path_file + '.log' is rotated.
+        backup_count (int):
+            Number of rotated log files to keep.
+        dir_profile (str):
+            Directory in which cProfile output (.prof) files are saved.
+        verbose (int):
+            Verbosity level.
+    """
+    buckets_default = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+
+    def __init__(self, buckets=buckets_default, path_file=None, max_bytes=10_000_000, backup_count=3, dir_profile='.', verbose=0):
+        self.buckets = tuple(sorted(buckets))
+        self.path_file = path_file
+        self.dir_profile = dir_profile
+        self.verbose = int(verbose)
+
+        self.histograms = {}  ## {phase: [counts per bucket (last is +Inf), sum, count]}
+        self.counters = {}  ## {(name, labels): value}
+        self.gauges = {}  ## {(name, labels): value}
+        self._lock = threading.Lock()
+        self._profile_requested = threading.Event()
+
+        self._logger = None
+        if path_file is not None:
+            self._logger = logging.getLogger(f"job_holder.metrics.{os.path.abspath(path_file)}")
+            self._logger.propagate = False
+            self._logger.setLevel(logging.INFO)
+            handler = logging.handlers.RotatingFileHandler(path_file + '.log', maxBytes=max_bytes, backupCount=backup_count)
+            self._logger.addHandler(handler)
+
+    def observe(self, phase, seconds):
+        """Adds the duration of one phase to its histogram."""
+        with self._lock:
+            hist = self.histograms.setdefault(phase, [[0] * (len(self.buckets) + 1), 0.0, 0])
+            hist[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            hist[1] += seconds
+            hist[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        """Context manager that records the wall time of the block as 'phase'."""
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - tic)
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            key = (name, tuple(sorted(labels.items())))
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe_tick(self, summary, backend=None):
+        """
+        Records the queue sizes, holds / releases and constrained values from
+        the summary returned by manage_jobs or manage_jobs_multi.
+        """
+        self.inc('job_holder_ticks_total')
+        for s in summary.get('entries', [summary]):
+            labels = {'user': s.get('user') or '', 'account': s.get('account') or ''}
+            for state in ['running', 'pending', 'held']:
+                self.set('job_holder_jobs', s[f'n_{state}'], state=state, **labels)
+            self.inc('job_holder_holds_total', s['n_hold'], **labels)
+            self.inc('job_holder_releases_total', s['n_release'], **labels)
+            self.inc('job_holder_scontrol_calls_total', s['n_forks'], **labels)
+            self.inc('job_holder_scontrol_failures_total', len(s['failures']), **labels)
+            for key, value in s['values_constrained'].items():
+                self.set('job_holder_value_constrained', value, constraint=key, **labels)
+                self.set('job_holder_value_max', s['limits'][key], constraint=key, **labels)
+            self.set('job_holder_fairshare', s['fairshare'], **labels) if s.get('fairshare') is not None else None
+        self.set('job_holder_slurm_calls', backend.n_calls) if backend is not None else None
+        self._logger.info(json.dumps(self._log_record(summary))) if self._logger is not None else None
+
+    @staticmethod
+    def _log_record(summary):
+        record = {
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            **{key: summary[key] for key in ['n_jobs', 'n_running', 'n_pending', 'n_held', 'n_hold', 'n_release', 'n_forks']},
+            'n_failures': len(summary['failures']),
+            'time_tick': round(summary['time_tick'], 6),
+        }
+        record['entries'] = [{
+            'user': s.get('user'),
+            'account': s.get('account'),
+            'values_constrained': s['values_constrained'],
+            'limits': s['limits'],
+        } for s in summary.get('entries', [summary])]
+        return record
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        def fmt_labels(labels):
+            return '{' + ','.join([f'{k}="{v}"' for k, v in labels]) + '}' if len(labels) > 0 else ''
+        lines = []
+        with self._lock:
+            lines += [
+                '# HELP job_holder_phase_seconds Wall time of each phase of a tick.',
+                '# TYPE job_holder_phase_seconds histogram',
+            ]
+            for phase, (counts, total, n) in sorted(self.histograms.items()):
+                for le, c in zip([str(b) for b in self.buckets] + ['+Inf'], itertools.accumulate(counts)):
+                    lines.append(f'job_holder_phase_seconds_bucket{fmt_labels([("phase", phase), ("le", le)])} {c}')
+                lines.append(f'job_holder_phase_seconds_sum{fmt_labels([("phase", phase)])} {total}')
+                lines.append(f'job_holder_phase_seconds_count{fmt_labels([("phase", phase)])} {n}')
+            for kind, values in [('counter', self.counters), ('gauge', self.gauges)]:
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f'# TYPE {name} {kind}')
+                    lines += [f'{name}{fmt_labels(labels)} {value}' for (n, labels), value in sorted(values.items()) if n == name]
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """Writes the metrics to path_file. The file is replaced atomically."""
+        path_tmp = self.path_file + '.tmp'
+        with open(path_tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(path_tmp, self.path_file)
+
+    def serve(self, port=9100, host='127.0.0.1'):
+        """
+        Serves the metrics over HTTP from a daemon thread. Returns the server.
+        """
+        metrics = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics") if self.verbose > 0 else None
+        return server
+
+    def request_profile(self, *args):
+        """Profiles the next tick with cProfile. Accepts signal handler args."""
+        self._profile_requested.set()
+
+    def run_tick(self, function, backend=None):
+        """
+        Runs one tick (function, e.g. manage_jobs) and records its metrics.
+        The tick is profiled if request_profile was called. Returns the
+        summary from function.
+        """
+        profiler = None
+        if self._profile_requested.is_set():
+            self._profile_requested.clear()
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            with self.timer('tick'):
+                summary = function()
+        except Exception:
+            self.inc('job_holder_ticks_failed_total')
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self._save_profile(profiler)
+        self.observe_tick(summary, backend=backend) if summary is not None else None
+        self.write() if self.path_file is not None else None
+        return summary
+
+    def _save_profile(self, profiler):
+        path = os.path.join(self.dir_profile, f"job_holder_tick_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.prof")
+        profiler.dump_stats(path)
+        print(f"Saved cProfile of tick to {path}") if self.verbose > 0 else None
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(20) if self.verbose > 2 else None
+
+
+def _timer(metrics):
+    """Returns metrics.timer, or a timer that does nothing if metrics is None."""
+    return metrics.timer if metrics is not None else (lambda phase: contextlib.nullcontext())
 
 
 if __name__ == "__main__":
@@ -376,26 +2294,80 @@ if __name__ == "__main__":
     value_max, constraint, order_by, interval, duration, username, verbose, dry_run, no_daemon, order_ascending = (
         args.value_max, args.constraint, args.order_by, args.interval, args.duration, args.username, args.verbose, args.dry_run, args.no_daemon, args.order_ascending
     )
-    username = subprocess.check_output(["whoami"]).decode().strip() if username is None else username
-
-    if verbose > 0:
-        print(f"STARTING JOB HOLDER")
-        print(f"Managing jobs for user: {username}, Constraint: {constraint}, Max value: {value_max}, Order by: {order_by}, Interval: {interval} seconds")
-
-    fn_manage_jobs = lambda: manage_jobs(
-        username=username, 
-        constraint=constraint, 
-        value_max=value_max, 
-        order_jobs_by=order_by,
-        order_ascending=order_ascending,
-        verbose=verbose,
-        dry_run=dry_run,
-    )
+    max_command_length = args.max_command_length if args.batch else None
+    cache = SqueueCache()
+    limits = {k: float(v) for k, v in [l.split('=') for l in args.limits]} if args.limits is not None else None
+    backend = SubprocessSlurmBackend(runner=SlurmCommandRunner(timeout=args.command_timeout, max_concurrency=args.max_concurrency, retries=args.command_retries, verbose=verbose))
+    fairshare_cache = FairshareCache(ttl=args.fairshare_ttl, backend=backend, verbose=verbose)
+    metrics = Metrics(path_file=args.metrics_file, dir_profile=args.profile_dir, verbose=verbose)
+    metrics.serve(port=args.metrics_port) if args.metrics_port is not None else None
+    signal.signal(signal.SIGUSR1, metrics.request_profile) if hasattr(signal, 'SIGUSR1') else None
+    journal = DecisionJournal(path=args.journal, verbose=verbose) if args.journal is not None else None
+    journal.compact(max_age=args.journal_max_age * 24*60*60) if journal is not None else None
 
-    fn_manage_jobs()
-    if not no_daemon:
-        timer = _RepeatTimer(interval, fn_manage_jobs)
-        timer.start()
-        time.sleep(duration)
-        timer.cancel()
+    if args.config is not None:
+        ## Manage many users / accounts from one shared squeue snapshot per tick
+        entries = load_config(args.config, defaults={
+            'constraint': constraint,
+            'value_max': value_max,
+            'order_by': order_by,
+            'order_ascending': order_ascending,
+            'limits': limits,
+            'release_policy': args.release_policy,
+            'horizon': args.horizon,
+        })
+        if verbose > 0:
+            print("STARTING JOB HOLDER")
+            [print(f"Managing jobs for user: {e['user']}, Account: {e['account']}, Limits: {e['limits'] or {e['constraint']: e['value_max']}}, Order by: {e['order_by']}") for e in entries]
+        caches = {'user': SqueueCache(), 'account': SqueueCache()}
+        fn_manage_jobs = lambda: manage_jobs_multi(
+            entries=entries,
+            verbose=verbose,
+            dry_run=dry_run,
+            max_command_length=max_command_length,
+            caches=caches,
+            parser=args.parser,
+            fairshare_cache=fairshare_cache,
+            backend=backend,
+            metrics=metrics,
+            journal=journal,
+        )
+    else:
+        username = backend.whoami() if username is None else username
+        if verbose > 0:
+            print("STARTING JOB HOLDER")
+            print(f"Managing jobs for user: {username}, Limits: {limits or {constraint: value_max}}, Order by: {order_by}, Interval: {interval} seconds")
+        fn_manage_jobs = lambda: manage_jobs(
+            username=username, 
+            constraint=constraint, 
+            value_max=value_max, 
+            order_jobs_by=order_by,
+            order_ascending=order_ascending,
+            verbose=verbose,
+            dry_run=dry_run,
+            max_command_length=max_command_length,
+            cache=cache,
+            parser=args.parser,
+            limits=limits,
+            release_policy=args.release_policy,
+            horizon=args.horizon,
+            fairshare_cache=fairshare_cache if 'fairshare' in (limits or {constraint: value_max}) else None,
+            backend=backend,
+            metrics=metrics,
+            journal=journal,
+        )
+
+    fn_tick = lambda: metrics.run_tick(fn_manage_jobs, backend=backend)
+
+    if no_daemon:
+        fn_tick()
+    else:
+        scheduler = AdaptiveScheduler(
+            function=fn_tick,
+            interval_min=interval,
+            interval_max=args.interval_max,
+            backoff=args.backoff,
+            verbose=verbose,
+        )
+        scheduler.run(duration=duration)
         print("Exiting job holder.") if verbose > 0 else None
@@ -0,0 +1,732 @@
+"""
+JOB HOLDER BENCHMARKS
+RH 2024
+
+Benchmarks for job_holder.py that run off-cluster on synthetic squeue output
+and on SimulatedSlurmBackend, an in-process simulated slurm cluster.
+Pure/native Python 3, like job_holder.py itself.
+
+Demo:
+python job_holder_benchmark.py squeue_cache --n_jobs 50000 --frac_changed 0.01
+python job_holder_benchmark.py parsers --n_jobs 100000
+python job_holder_benchmark.py release_policy --n_jobs 500 --limits nodes=36 memory=2048 gpus=8
+python job_holder_benchmark.py simulation --n_jobs 2000 --arrival_rate 100
+python job_holder_benchmark.py journal --n_jobs 20000
+python job_holder_benchmark.py arrays --n_jobs 10000 --array_size 1000
+python job_holder_benchmark.py horizon --n_jobs 1000 --limits nodes=64 --start_delay 300
+"""
+
+import argparse
+import itertools
+import random
+import time
+import datetime
+import subprocess
+import os
+import tempfile
+
+import job_holder
+
+
+def make_synthetic_squeue_lines(n_jobs=50000, frac_running=0.1, seed=0, fmt='fixed'):
+    """
+    Makes synthetic squeue output that mimics either
+    'squeue -u <username> --Format <properties>' (fmt='fixed') or
+    'squeue -h -u <username> -o <properties_format>' (fmt='delimited').
+    RH 2024
+
+    Args:
+        n_jobs (int):
+            Number of job rows.
+        frac_running (float):
+            Fraction of jobs that are RUNNING. The rest are PENDING.
+        seed (int):
+            Random seed.
+        fmt (str):
+            'fixed' or 'delimited'.
+
+    Returns:
+        (list):
+            Lines of squeue output. For fmt='fixed', the first line is the
+            header.
+    """
+    rng = random.Random(seed)
+    width = 20
+    if fmt == 'fixed':
+        fmt_line = lambda fields: "".join([str(f).ljust(width) for f in fields])
+        lines = [fmt_line([v.upper() for v in job_holder.properties.values()])]
+    elif fmt == 'delimited':
+        fmt_line = lambda fields: job_holder._delimiter.join([str(f) for f in fields])
+        lines = []
+    else:
+        raise ValueError(f"fmt must be 'fixed' or 'delimited'. Found {fmt}.")
+    time_submit = datetime.datetime(2024, 1, 1)
+    for i_job in range(n_jobs):
+        running = rng.random() < frac_running
+        lines.append(fmt_line([
+            str(10_000_000 + i_job),
+            'RUNNING' if running else 'PENDING',
+            (time_submit + datetime.timedelta(seconds=i_job)).strftime("%Y-%m-%dT%H:%M:%S"),
+            rng.choice(['short', 'medium', 'gpu_requeue']),
+            '1-00:00:00',
+            rng.randint(1, 4),
+            rng.choice([1, 4, 16]),
+            rng.choice(['4G', '16G', '48G']),
+            f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}" if running else '1-00:00:00',
+            rng.randint(1, 10000),
+            'node1' if running else '(Priority)',
+            'user',
+            'lab',
+            rng.choice(['N/A', 'N/A', 'gres:gpu:1', 'gres:gpu:4']),
+            f"job_{i_job}",
+        ]))
+    return lines
+
+
+def _mutate_squeue_lines(lines, frac_changed=0.01, seed=1):
+    """
+    Returns a copy of a synthetic squeue table in which a fraction of the rows
+    have a new TimeLeft value, as happens to RUNNING jobs between ticks.
+    """
+    rng = random.Random(seed)
+    lines = list(lines)
+    header = lines[0]
+    i_col = list(job_holder.properties.keys()).index('time_left')
+    start = [i for i, c in enumerate(header) if c != ' ' and (i == 0 or header[i-1] == ' ')][i_col]
+    n_changed = int((len(lines) - 1) * frac_changed)
+    for i_line in rng.sample(range(1, len(lines)), n_changed):
+        line = lines[i_line]
+        lines[i_line] = line[:start] + f"{rng.randint(0, 23):02d}:00:00".ljust(20) + line[start+20:]
+    return lines
+
+
+def benchmark_squeue_cache(n_jobs=50000, frac_changed=0.01, n_ticks=5):
+    """
+    Compares full parsing of a squeue table on every tick against incremental
+    parsing with job_holder.SqueueCache.
+    RH 2024
+    """
+    lines = make_synthetic_squeue_lines(n_jobs=n_jobs)
+    ticks = [lines] + [_mutate_squeue_lines(lines, frac_changed=frac_changed, seed=i_tick) for i_tick in range(1, n_ticks)]
+
+    tic = time.perf_counter()
+    for t in ticks:
+        job_holder.parse_squeue_table(t)
+    time_full = (time.perf_counter() - tic) / n_ticks
+
+    cache = job_holder.SqueueCache()
+    job_holder.parse_squeue_table(ticks[0], cache=cache)  ## Warm up the cache
+    tic = time.perf_counter()
+    n_parsed = 0
+    for t in ticks[1:]:
+        job_holder.parse_squeue_table(t, cache=cache)
+        n_parsed += cache.n_parsed
+    time_cached = (time.perf_counter() - tic) / (n_ticks - 1)
+
+    print(f"squeue parsing, {n_jobs} jobs, {frac_changed*100:.1f}% changed rows per tick:")
+    print(f"    full parse:   {time_full*1000:9.1f} ms / tick")
+    print(f"    cached parse: {time_cached*1000:9.1f} ms / tick ({n_parsed / (n_ticks - 1):.0f} rows parsed / tick)")
+    print(f"    speedup:      {time_full / time_cached:9.1f}x")
+
+
+def benchmark_parsers(n_jobs=100000, n_repeats=3):
+    """
+    Compares the fixed width squeue parser (job_holder.parse_squeue_table)
+    against the '|' delimited parser (job_holder.parse_squeue_delimited), both
+    without a cache.
+    RH 2024
+    """
+    lines_fixed = make_synthetic_squeue_lines(n_jobs=n_jobs, fmt='fixed')
+    lines_delimited = make_synthetic_squeue_lines(n_jobs=n_jobs, fmt='delimited')
+
+    results = {}
+    for name, fn, lines in [
+        ('fixed', job_holder.parse_squeue_table, lines_fixed),
+        ('delimited', job_holder.parse_squeue_delimited, lines_delimited),
+    ]:
+        times = []
+        for _ in range(n_repeats):
+            job_holder._parse_slurm_duration_seconds.cache_clear()
+            job_holder._parse_slurm_submit_timestamp.cache_clear()
+            tic = time.perf_counter()
+            jobs = fn(lines)
+            times.append(time.perf_counter() - tic)
+        assert len(jobs) == n_jobs
+        results[name] = min(times)
+
+    print(f"squeue parsing, {n_jobs} rows (best of {n_repeats}):")
+    print(f"    fixed width: {results['fixed']*1000:9.1f} ms")
+    print(f"    delimited:   {results['delimited']*1000:9.1f} ms")
+    print(f"    speedup:     {results['fixed'] / results['delimited']:9.1f}x")
+
+
+class SimulatedSlurmBackend(job_holder.SlurmBackend):
+    """
+    In-process simulated slurm cluster implementing job_holder.SlurmBackend.
+    Used to load-test job_holder off-cluster.\n
+    Jobs arrive over time (or all at time 0), optionally held. PENDING jobs
+    that are not held become eligible to start 'start_delay' seconds after
+    they are released (or submitted), which models the slurm scheduler
+    latency. Eligible jobs start if there is free capacity on the cluster.
+    RUNNING jobs finish after their runtime (or hit their time limit) and can
+    be preempted, in which case they are requeued as PENDING and start over.
+    Time only advances when step() is called.\n
+    Jobs can be submitted as job arrays. Like squeue, PENDING tasks of an
+    array with the same reason are shown as one compressed row (e.g.
+    '1000000_[0-9,12-999]'), and scontrol accepts array range expressions.
+    RH 2024
+
+    Args:
+        n_jobs (int):
+            Total number of jobs to submit.
+        arrival_rate (float):
+            Job arrivals per hour (Poisson process). If None, all jobs are
+            submitted at time 0.
+        submit_held (bool):
+            If True, jobs are submitted held (sbatch --hold).
+        runtime_range (tuple):
+            (min, max) job runtime in seconds, drawn uniformly.
+        preemption_rate (float):
+            Probability per hour that a RUNNING job is preempted.
+        start_delay (float):
+            Seconds between a job becoming eligible (released) and starting.
+        capacity_nodes (int):
+            Total number of nodes on the cluster. If None, unlimited.
+        users (list):
+            Usernames. Jobs are assigned to users round-robin.
+        account (str):
+            Account of all jobs.
+        array_size (int):
+            If not None, jobs are submitted as job arrays of this many tasks.
+            Tasks of an array are submitted together and request the same
+            resources.
+        seed (int):
+            Random seed.
+    """
+    def __init__(
+        self,
+        n_jobs=1000,
+        arrival_rate=None,
+        submit_held=True,
+        runtime_range=(10*60, 120*60),
+        preemption_rate=0.0,
+        start_delay=0.0,
+        capacity_nodes=None,
+        users=('user',),
+        account='lab',
+        array_size=None,
+        seed=0,
+    ):
+        self.rng = random.Random(seed)
+        self.submit_held = bool(submit_held)
+        self.preemption_rate = float(preemption_rate)
+        self.start_delay = float(start_delay)
+        self.capacity_nodes = capacity_nodes
+        self.users = list(users)
+        self.account = account
+        self.array_size = array_size
+
+        self.time = 0.0
+        self.n_calls = 0
+        self.n_squeue_lines = 0
+        self.stats = {'n_submitted': 0, 'n_started': 0, 'n_finished': 0, 'n_preempted': 0}
+        self.starts = []  ## (seconds from submission to start, job) for each start
+        self.jobs = {}  ## Jobs in the queue (PENDING or RUNNING)
+
+        ## Make all jobs up front, sorted by arrival time
+        time_arrival = 0.0
+        self._arrivals = []
+        for i_job in range(n_jobs):
+            i_array, i_task = divmod(i_job, array_size) if array_size else (i_job, 0)
+            runtime = self.rng.uniform(*runtime_range)
+            if i_task == 0:
+                ## New job, or new job array
+                time_arrival += self.rng.expovariate(arrival_rate / 3600) if arrival_rate else 0.0
+                nodes = self.rng.choice([1, 1, 1, 2, 4])
+                resources = {
+                    'nodes': nodes,
+                    'cpus': 16 * nodes,
+                    'memory': self.rng.choice([16, 64, 64, 256, 512]),
+                    'gpus': self.rng.choice([0, 0, 1, 1, 2]) * nodes,
+                    'time_limit': runtime * 1.5 if not array_size else runtime_range[1] * 1.5,
+                    'user': self.users[i_array % len(self.users)],
+                }
+            job_id = f"{1_000_000 + i_array}_{i_task}" if array_size else str(1_000_000 + i_job)
+            self._arrivals.append((time_arrival, job_id, {
+                **resources,
+                'state': 'PENDING',
+                'held': self.submit_held,
+                'runtime': runtime,
+                'time_submit': time_arrival,
+                'time_start': None,
+                'time_eligible': None if self.submit_held else time_arrival + self.start_delay,
+            }))
+        self._arrivals.reverse()  ## Pop from the end
+        self._submit_arrivals()
+
+    @property
+    def done(self):
+        """True if all jobs have been submitted and have finished."""
+        return (len(self.jobs) == 0) and (len(self._arrivals) == 0)
+
+    def _submit_arrivals(self):
+        while (len(self._arrivals) > 0) and (self._arrivals[-1][0] <= self.time):
+            _, job_id, job = self._arrivals.pop()
+            self.jobs[job_id] = job
+            self.stats['n_submitted'] += 1
+
+    def step(self, dt):
+        """Advances time by dt seconds: submits, finishes, preempts and starts jobs."""
+        self.time += dt
+        self._submit_arrivals()
+        p_preempt = 1 - (1 - self.preemption_rate) ** (dt / 3600)
+        for job_id in list(self.jobs.keys()):
+            job = self.jobs[job_id]
+            if job['state'] != 'RUNNING':
+                continue
+            if self.time - job['time_start'] >= min(job['runtime'], job['time_limit']):
+                del self.jobs[job_id]
+                self.stats['n_finished'] += 1
+            elif self.rng.random() < p_preempt:
+                job['state'], job['time_start'], job['time_eligible'] = 'PENDING', None, self.time + self.start_delay
+                self.stats['n_preempted'] += 1
+        nodes_free = (self.capacity_nodes - self.usage(['nodes'])['nodes']) if self.capacity_nodes is not None else float('inf')
+        for job in self.jobs.values():
+            if (job['state'] == 'PENDING') and (not job['held']) and (job['time_eligible'] <= self.time) and (job['nodes'] <= nodes_free):
+                job['state'], job['time_start'] = 'RUNNING', self.time
+                nodes_free -= job['nodes']
+                self.stats['n_started'] += 1
+                self.starts.append((self.time - job['time_submit'], job))
+
+    @property
+    def n_pending(self):
+        """Number of PENDING jobs in the queue."""
+        return sum([job['state'] == 'PENDING' for job in self.jobs.values()])
+
+    def usage(self, keys):
+        """Returns {key: sum over RUNNING jobs}."""
+        running = [job for job in self.jobs.values() if job['state'] == 'RUNNING']
+        return {key: sum([job[key] for job in running]) for key in keys}
+
+    def _reason(self, job):
+        if job['state'] == 'RUNNING':
+            return 'node1'
+        elif job['held']:
+            return '(JobHeldUser)'
+        elif job['time_eligible'] > self.time:
+            return '(BeginTime)'
+        else:
+            return '(Resources)'
+
+    def _squeue_line(self, job_id, job, reason):
+        running = job['state'] == 'RUNNING'
+        time_left = int(job['time_limit'] - (self.time - job['time_start'])) if running else int(job['time_limit'])
+        return job_holder._delimiter.join([
+            job_id,
+            job['state'],
+            (datetime.datetime(2024, 1, 1) + datetime.timedelta(seconds=job['time_submit'])).strftime("%Y-%m-%dT%H:%M:%S"),
+            'short',
+            _format_duration(job['time_limit']),
+            str(job['nodes']),
+            str(job['cpus']),
+            f"{job['memory']}G",
+            _format_duration(time_left),
+            str(10_000_000 - int(job_id.partition('_')[0])),
+            reason,
+            job['user'],
+            self.account,
+            f"gres:gpu:{job['gpus'] // job['nodes']}" if job['gpus'] > 0 else 'N/A',  ## GPUs per node
+            f"job_{job_id}",
+        ])
+
+    def squeue(self, usernames=None, accounts=None, parser='delimited'):
+        assert parser == 'delimited', "SimulatedSlurmBackend only produces delimited squeue output."
+        self.n_calls += 1
+        usernames = set(usernames) if usernames else None
+        if accounts and (self.account not in accounts):
+            return []
+        jobs = [(job_id, job, self._reason(job)) for job_id, job in self.jobs.items() if (usernames is None) or (job['user'] in usernames)]
+        if not self.array_size:
+            self.n_squeue_lines += len(jobs)
+            return [self._squeue_line(job_id, job, reason) for job_id, job, reason in jobs]
+        ## Compress PENDING tasks of each array with the same reason into one row
+        lines, groups = [], {}
+        for job_id, job, reason in jobs:
+            if job['state'] == 'RUNNING':
+                lines.append(self._squeue_line(job_id, job, reason))
+            else:
+                parent, _, index = job_id.partition('_')
+                groups.setdefault((parent, reason), []).append((int(index), job))
+        for (parent, reason), tasks in groups.items():
+            tasks.sort(key=lambda t: t[0])
+            runs = [[i for _, i in run] for _, run in itertools.groupby(enumerate([i for i, _ in tasks]), key=lambda x: x[1] - x[0])]
+            spec = ",".join([f"{run[0]}-{run[-1]}" if len(run) > 1 else f"{run[0]}" for run in runs])
+            job_id = f"{parent}_[{spec}]" if len(tasks) > 1 else f"{parent}_{tasks[0][0]}"
+            lines.append(self._squeue_line(job_id, tasks[0][1], reason))
+        self.n_squeue_lines += len(lines)
+        return lines
+
+    def sshare(self, users):
+        """Fairshare decays with the number of RUNNING nodes of each user."""
+        self.n_calls += 1
+        lines = ['Account|User|FairShare', f'{self.account}||']
+        for user in users:
+            nodes = sum([job['nodes'] for job in self.jobs.values() if (job['user'] == user) and (job['state'] == 'RUNNING')])
+            lines.append(f"{self.account}|{user}|{1 / (1 + nodes / 10):.6f}")
+        return '\n'.join(lines) + '\n'
+
+    def scontrol(self, action, job_id_lists):
+        results = []
+        for job_id_list in job_id_lists:
+            self.n_calls += 1
+            errors = []
+            for job_id in [j for token in job_id_list.split(',') for j in job_holder._array_task_ids(token)]:
+                job = self.jobs.get(job_id)
+                if (job is None) or (job['state'] != 'PENDING'):
+                    errors.append(f"scontrol: error: Invalid job id specified for job {job_id}")
+                elif action == 'hold':
+                    job['held'], job['time_eligible'] = True, None
+                elif action == 'release' and job['held']:
+                    job['held'], job['time_eligible'] = False, self.time + self.start_delay
+            stderr = ('\n'.join(errors) + '\n').encode() if errors else b''
+            results.append(subprocess.CompletedProcess(['scontrol', action, job_id_list], 1 if errors else 0, stdout=b'', stderr=stderr))
+        return results
+
+    def whoami(self):
+        return self.users[0]
+
+
+def _format_duration(seconds):
+    """Formats seconds as a slurm duration string: D-HH:MM:SS."""
+    seconds = max(int(seconds), 0)
+    days, seconds = divmod(seconds, 24*60*60)
+    return f"{days}-{seconds // 3600:02d}:{(seconds % 3600) // 60:02d}:{seconds % 60:02d}"
+
+
+def simulate(
+    backend,
+    limits={'nodes': 36, 'memory': 2048, 'gpus': 8},
+    release_policy='prefix',
+    order_by='job_id',
+    dt=60,
+    max_command_length=4000,
+    time_max=30*24*60*60,
+    kwargs_manage_jobs={},
+):
+    """
+    Replays the jobs of a SimulatedSlurmBackend through job_holder.manage_jobs,
+    calling it every dt simulated seconds until all jobs have finished.
+    RH 2024
+
+    Args:
+        backend (SimulatedSlurmBackend):
+            Simulated cluster.
+        limits (dict):
+            {constraint: value_max}. Passed to manage_jobs.
+        release_policy (str):
+            Passed to manage_jobs.
+        order_by (str):
+            Passed to manage_jobs (ascending order).
+        dt (float):
+            Simulated seconds between ticks.
+        max_command_length (int):
+            Passed to manage_jobs. None for one scontrol call per job.
+        time_max (float):
+            Maximum simulated time in seconds.
+        kwargs_manage_jobs (dict):
+            Extra keyword arguments for manage_jobs.
+
+    Returns:
+        (dict):
+            * n_ticks (int): Number of ticks.\n
+            * latency_mean (float): Mean wall time of a tick in seconds.\n
+            * latency_p95 (float): 95th percentile wall time of a tick.\n
+            * decisions_per_second (float): Holds + releases per second of
+              tick wall time.\n
+            * calls_per_tick (float): Slurm calls per tick.\n
+            * calls_max (int): Largest number of slurm calls in one tick.\n
+            * utilisation (dict): Time-averaged usage / value_max for each
+              limit.\n
+            * idle (dict): Idle-slot time for each limit: integral of
+              (value_max - usage) over the time during which jobs were
+              PENDING, in units of the constraint times hours (e.g.
+              node-hours).\n
+            * usage_max (dict): Peak usage / value_max for each limit.\n
+            * makespan (float): Simulated hours until all jobs finished.
+    """
+    cache = job_holder.SqueueCache()
+    latencies, n_decisions, calls_max = [], 0, 0
+    usage_integral = {key: 0.0 for key in limits}
+    idle_integral = {key: 0.0 for key in limits}
+    usage_max = {key: 0.0 for key in limits}
+    while (not backend.done) and (backend.time < time_max):
+        tic, n_calls = time.perf_counter(), backend.n_calls
+        summary = job_holder.manage_jobs(
+            username=backend.whoami(),
+            limits=limits,
+            order_jobs_by=order_by,
+            order_ascending=True,
+            release_policy=release_policy,
+            max_command_length=max_command_length,
+            cache=cache,
+            backend=backend,
+            verbose=0,
+            **kwargs_manage_jobs,
+        )
+        latencies.append(time.perf_counter() - tic)
+        calls_max = max(calls_max, backend.n_calls - n_calls)
+        n_decisions += summary['n_hold'] + summary['n_release']
+        if (summary['n_release'] == 0) and (summary['n_running'] == 0) and (len(backend._arrivals) == 0) and all([not j['time_eligible'] for j in backend.jobs.values()]):
+            break  ## Remaining jobs can never fit within the limits
+        backend.step(dt)
+        usage = backend.usage(limits.keys())
+        usage_integral = {key: usage_integral[key] + usage[key] * dt for key in limits}
+        usage_max = {key: max(usage_max[key], usage[key]) for key in limits}
+        if backend.n_pending > 0:
+            idle_integral = {key: idle_integral[key] + max(limits[key] - usage[key], 0) * dt for key in limits}
+
+    latencies_sorted = sorted(latencies)
+    return {
+        'n_ticks': len(latencies),
+        'latency_mean': sum(latencies) / len(latencies),
+        'latency_p95': latencies_sorted[int(0.95 * (len(latencies_sorted) - 1))],
+        'decisions_per_second': n_decisions / sum(latencies),
+        'calls_per_tick': backend.n_calls / len(latencies),
+        'calls_max': calls_max,
+        'utilisation': {key: usage_integral[key] / (limits[key] * backend.time) for key in limits},
+        'idle': {key: idle_integral[key] / 3600 for key in limits},
+        'usage_max': {key: usage_max[key] / limits[key] for key in limits},
+        'makespan': backend.time / 3600,
+    }
+
+
+def _print_simulation(name, result):
+    str_util = ", ".join([f"{key}: {u*100:5.1f}%" for key, u in result['utilisation'].items()])
+    print(f"    {name:8s} utilisation: {str_util}. Makespan: {result['makespan']:.1f} h.")
+
+
+def benchmark_release_policies(
+    n_jobs=500,
+    limits={'nodes': 36, 'memory': 2048, 'gpus': 8},
+    limits_saturated={'nodes': 36, 'memory': 2048, 'gpus': 2},
+    key_saturated='gpus',
+    dt=300,
+    seed=0,
+):
+    """
+    Compares the cluster utilisation achieved by each release policy in
+    job_holder.decide_jobs under several simultaneous limits.\n
+    A second case uses limits where one resource ('key_saturated') is at its
+    limit most of the time. Jobs that do not need that resource should
+    still be released into the free capacity of the others, so their mean
+    wait from submission to start is reported too.
+    RH 2024
+    """
+    for name, limits_case in [('', limits), ('saturated ', limits_saturated)]:
+        print(f"Release policies, {n_jobs} jobs, {name}limits: {limits_case}:")
+        for release_policy in ['prefix', 'greedy']:
+            backend = SimulatedSlurmBackend(n_jobs=n_jobs, seed=seed)
+            result = simulate(backend=backend, limits=limits_case, release_policy=release_policy, dt=dt)
+            _print_simulation(release_policy, result)
+            if name:
+                waits = [wait for wait, job in backend.starts if job[key_saturated] == 0]
+                print(f"    {'':8s} mean wait of {len(waits)} jobs without {key_saturated}: {sum(waits) / max(len(waits), 1) / 3600:.1f} h.")
+
+
+def benchmark_simulation(
+    n_jobs=2000,
+    limits={'nodes': 96, 'memory': 8192, 'gpus': 32},
+    arrival_rate=100,
+    preemption_rate=0.02,
+    start_delay=120,
+    release_policy='greedy',
+    dt=120,
+    max_command_length=4000,
+    seed=0,
+):
+    """
+    Replays thousands of jobs through job_holder.manage_jobs on a simulated
+    cluster and reports tick latency, decisions per second and achieved
+    utilisation versus value_max.
+    RH 2024
+    """
+    backend = SimulatedSlurmBackend(n_jobs=n_jobs, arrival_rate=arrival_rate, preemption_rate=preemption_rate, start_delay=start_delay, seed=seed)
+    metrics = job_holder.Metrics()
+    result = simulate(backend=backend, limits=limits, release_policy=release_policy, dt=dt, max_command_length=max_command_length, kwargs_manage_jobs={'metrics': metrics})
+    print(f"Simulation, {n_jobs} jobs, {arrival_rate} arrivals / h, limits: {limits}, release_policy: {release_policy}:")
+    print(f"    ticks:            {result['n_ticks']}")
+    print(f"    tick latency:     mean {result['latency_mean']*1000:.1f} ms, p95 {result['latency_p95']*1000:.1f} ms")
+    print(f"    decisions / s:    {result['decisions_per_second']:.0f}")
+    print(f"    slurm calls/tick: {result['calls_per_tick']:.2f}")
+    print("    mean phase times: " + ", ".join([f"{phase}: {total / n * 1000:.2f} ms" for phase, (_, total, n) in metrics.histograms.items()]))
+    print(f"    job stats:        {backend.stats}")
+    _print_simulation(release_policy, result)
+
+
+def benchmark_journal(n_jobs=20000, limits={'nodes': 96}, n_ticks=40, dt=120, seed=0):
+    """
+    Measures what the DecisionJournal saves across a restart of job_holder.
+    Jobs are submitted unheld and held by job_holder. After n_ticks the
+    daemon is restarted (new SqueueCache, journal reopened from disk) and the
+    user submits one job with 'sbatch --hold' that sorts first. Reports the
+    number of job IDs sent to scontrol after the initial burst of holds, the
+    journal warm-up time, and whether the user's held job was released by
+    job_holder.
+    RH 2024
+    """
+    print(f"Journal, {n_jobs} jobs, limits: {limits}, {n_ticks} ticks before and after a restart:")
+    for use_journal in [False, True]:
+        backend = SimulatedSlurmBackend(n_jobs=n_jobs, submit_held=False, start_delay=2 * dt, capacity_nodes=2 * limits["nodes"], seed=seed)
+        path = os.path.join(tempfile.mkdtemp(), 'journal.sqlite')
+        journal = job_holder.DecisionJournal(path) if use_journal else None
+        tick = lambda cache, journal: job_holder.manage_jobs(username=backend.whoami(), limits=limits, order_jobs_by='job_id', order_ascending=True, max_command_length=4000, cache=cache, backend=backend, journal=journal)
+
+        cache = job_holder.SqueueCache()
+        n_ids = []
+        for _ in range(n_ticks):
+            summary = tick(cache, journal)
+            n_ids.append(summary['n_hold'] + summary['n_release'])
+            backend.step(dt)
+
+        ## Restart, and hold one job manually
+        journal.close() if use_journal else None
+        tic = time.perf_counter()
+        journal = job_holder.DecisionJournal(path) if use_journal else None
+        time_warmup = time.perf_counter() - tic
+        cache = job_holder.SqueueCache()
+        job_id_manual = '100'  ## Sorts before the other job IDs
+        job = next(iter(backend.jobs.values()))
+        backend.jobs[job_id_manual] = {**job, 'state': 'PENDING', 'held': True, 'time_start': None, 'time_eligible': None, 'nodes': 1, 'memory': 1, 'gpus': 0, 'cpus': 1}
+        summary = tick(cache, journal)
+        n_ids_restart = summary['n_hold'] + summary['n_release']
+        released_manual = False
+        for _ in range(n_ticks):
+            backend.step(dt)
+            tick(cache, journal)
+            released_manual = released_manual or (job_id_manual not in backend.jobs) or (not backend.jobs[job_id_manual]['held'])
+
+        print(f"    journal: {str(use_journal):5s}. job IDs sent to scontrol after the initial holds: {sum(n_ids) - max(n_ids):5d}, on the first tick after restart: {n_ids_restart:5d}. Warm-up: {time_warmup*1000:6.1f} ms. User's held job released: {released_manual}.")
+
+
+def benchmark_horizon(
+    n_jobs=1000,
+    limits={'nodes': 64},
+    horizons=(0, 300, 600, 1200),
+    start_delay=300,
+    arrival_rate=None,
+    release_policy='greedy',
+    dt=60,
+    seed=0,
+):
+    """
+    Compares look-ahead horizons for predictive release (see
+    job_holder.decide_jobs). Released jobs wait 'start_delay' seconds in the
+    simulated slurm scheduler before starting. Reports utilisation, idle-slot
+    time (capacity unused while jobs are PENDING), peak usage and makespan.
+    RH 2024
+    """
+    print(f"Look-ahead horizon, {n_jobs} jobs, limits: {limits}, start delay: {start_delay} s:")
+    for horizon in horizons:
+        backend = SimulatedSlurmBackend(n_jobs=n_jobs, arrival_rate=arrival_rate, start_delay=start_delay, seed=seed)
+        result = simulate(backend=backend, limits=limits, release_policy=release_policy, dt=dt, kwargs_manage_jobs={'horizon': horizon})
+        str_util = ", ".join([f"{key}: {result['utilisation'][key]*100:5.1f}%" for key in limits])
+        str_idle = ", ".join([f"{key}: {result['idle'][key]:7.1f}" for key in limits])
+        str_max = ", ".join([f"{key}: {result['usage_max'][key]*100:5.1f}%" for key in limits])
+        print(f"    horizon {horizon:5.0f} s. utilisation: {str_util}. idle-slot hours: {str_idle}. peak usage: {str_max}. Makespan: {result['makespan']:.1f} h.")
+
+
+def benchmark_arrays(n_jobs=10000, array_size=1000, limits={'nodes': 96}, dt=120, time_max=24*60*60, seed=0):
+    """
+    Compares a queue of job arrays with a queue of the same number of
+    individual jobs. Jobs are submitted unheld to a cluster with twice the
+    capacity of the limit, so job_holder holds most of the queue on its
+    first ticks. scontrol is called once per job ID (no --batch), so the
+    number of calls shows how many tasks are handled by each array range
+    expression.
+    RH 2024
+    """
+    print(f"Job arrays, {n_jobs} tasks, limits: {limits}, {time_max / 3600:.0f} simulated hours, one scontrol call per job ID:")
+    for size in [None, array_size]:
+        backend = SimulatedSlurmBackend(n_jobs=n_jobs, submit_held=False, start_delay=dt, capacity_nodes=2 * limits['nodes'], array_size=size, seed=seed)
+        metrics = job_holder.Metrics()
+        result = simulate(backend=backend, limits=limits, release_policy='prefix', dt=dt, max_command_length=None, time_max=time_max, kwargs_manage_jobs={'metrics': metrics})
+        name = f"arrays of {size}" if size else "individual jobs"
+        hist = metrics.histograms['scontrol']
+        print(f"    {name:16s} squeue lines / tick: {backend.n_squeue_lines / result['n_ticks']:8.1f}, scontrol calls / tick: {result['calls_per_tick'] - 1:7.2f} (max {result['calls_max'] - 1:5d}), scontrol time / tick: {hist[1] / hist[2] * 1000:6.2f} ms, tick latency: mean {result['latency_mean']*1000:.1f} ms.")
+        _print_simulation('', result)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks for job_holder.py.")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    p = subparsers.add_parser('squeue_cache', help="Full vs incremental parsing of squeue output.")
+    p.add_argument("--n_jobs", type=int, default=50000, help="Number of jobs in the synthetic squeue output. Default: 50000.")
+    p.add_argument("--frac_changed", type=float, default=0.01, help="Fraction of rows that change between ticks. Default: 0.01.")
+    p.add_argument("--n_ticks", type=int, default=5, help="Number of ticks to average over. Default: 5.")
+
+    p = subparsers.add_parser('parsers', help="Fixed width vs delimited squeue parsers.")
+    p.add_argument("--n_jobs", type=int, default=100000, help="Number of jobs in the synthetic squeue output. Default: 100000.")
+    p.add_argument("--n_repeats", type=int, default=3, help="Number of repeats. Default: 3.")
+
+    p = subparsers.add_parser('release_policy', help="Cluster utilisation of each release policy under several limits.")
+    p.add_argument("--n_jobs", type=int, default=500, help="Number of jobs to simulate. Default: 500.")
+    p.add_argument("--limits", type=str, nargs='+', default=['nodes=36', 'memory=2048', 'gpus=8'], help="constraint=value_max pairs. Default: nodes=36 memory=2048 gpus=8.")
+    p.add_argument("--limits_saturated", type=str, nargs='+', default=['nodes=36', 'memory=2048', 'gpus=2'], help="constraint=value_max pairs for the case with one saturated resource. Default: nodes=36 memory=2048 gpus=2.")
+    p.add_argument("--key_saturated", type=str, default='gpus', help="Resource that is saturated in the second case. Default: 'gpus'.")
+    p.add_argument("--dt", type=float, default=300, help="Simulated seconds between job_holder ticks. Default: 300.")
+
+    p = subparsers.add_parser('simulation', help="Replay jobs through manage_jobs on a simulated cluster.")
+    p.add_argument("--n_jobs", type=int, default=2000, help="Number of jobs to simulate. Default: 2000.")
+    p.add_argument("--limits", type=str, nargs='+', default=['nodes=96', 'memory=8192', 'gpus=32'], help="constraint=value_max pairs. Default: nodes=96 memory=8192 gpus=32.")
+    p.add_argument("--arrival_rate", type=float, default=100, help="Job arrivals per hour. Default: 100.")
+    p.add_argument("--preemption_rate", type=float, default=0.02, help="Probability per hour that a running job is preempted. Default: 0.02.")
+    p.add_argument("--start_delay", type=float, default=120, help="Seconds between a job being released and starting. Default: 120.")
+    p.add_argument("--release_policy", type=str, default='greedy', choices=['prefix', 'greedy'], help="Default: 'greedy'.")
+    p.add_argument("--dt", type=float, default=120, help="Simulated seconds between job_holder ticks. Default: 120.")
+
+    p = subparsers.add_parser('horizon', help="Idle-slot time and utilisation for several look-ahead horizons (predictive release).")
+    p.add_argument("--n_jobs", type=int, default=1000, help="Number of jobs to simulate. Default: 1000.")
+    p.add_argument("--limits", type=str, nargs='+', default=['nodes=64'], help="constraint=value_max pairs. Default: nodes=64.")
+    p.add_argument("--horizons", type=float, nargs='+', default=[0, 300, 600, 1200], help="Look-ahead horizons in seconds. Default: 0 300 600 1200.")
+    p.add_argument("--start_delay", type=float, default=300, help="Seconds between a job being released and starting. Default: 300.")
+
+    p = subparsers.add_parser('arrays', help="Controller calls per tick for job arrays vs individual jobs.")
+    p.add_argument("--n_jobs", type=int, default=10000, help="Number of jobs / array tasks. Default: 10000.")
+    p.add_argument("--array_size", type=int, default=1000, help="Number of tasks per job array. Default: 1000.")
+
+    p = subparsers.add_parser('journal', help="scontrol calls and warm-up time across a restart, with and without the decision journal.")
+    p.add_argument("--n_jobs", type=int, default=20000, help="Number of jobs to simulate. Default: 20000.")
+    p.add_argument("--n_ticks", type=int, default=40, help="Number of ticks before and after the restart. Default: 40.")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.benchmark == 'squeue_cache':
+        benchmark_squeue_cache(n_jobs=args.n_jobs, frac_changed=args.frac_changed, n_ticks=args.n_ticks)
+    elif args.benchmark == 'parsers':
+        benchmark_parsers(n_jobs=args.n_jobs, n_repeats=args.n_repeats)
+    elif args.benchmark == 'release_policy':
+        limits = {k: float(v) for k, v in [l.split('=') for l in args.limits]}
+        limits_saturated = {k: float(v) for k, v in [l.split('=') for l in args.limits_saturated]}
+        benchmark_release_policies(n_jobs=args.n_jobs, limits=limits, limits_saturated=limits_saturated, key_saturated=args.key_saturated, dt=args.dt)
+    elif args.benchmark == 'horizon':
+        limits = {k: float(v) for k, v in [l.split('=') for l in args.limits]}
+        benchmark_horizon(n_jobs=args.n_jobs, limits=limits, horizons=args.horizons, start_delay=args.start_delay)
+    elif args.benchmark == 'arrays':
+        benchmark_arrays(n_jobs=args.n_jobs, array_size=args.array_size)
+    elif args.benchmark == 'journal':
+        benchmark_journal(n_jobs=args.n_jobs, n_ticks=args.n_ticks)
+    elif args.benchmark == 'simulation':
+        limits = {k: float(v) for k, v in [l.split('=') for l in args.limits]}
+        benchmark_simulation(
+            n_jobs=args.n_jobs,
+            limits=limits,
+            arrival_rate=args.arrival_rate,
+            preemption_rate=args.preemption_rate,
+            start_delay=args.start_delay,
+            release_policy=args.release_policy,
+            dt=args.dt,
+        )
@@ -0,0 +1,411 @@
+"""
+REMOTE INDEX
+RH 2024
+
+Cached index of remote (or local) directory trees for search_recursive-style
+file discovery. Pure/native Python 3.
+
+sftp.search_recursive walks a tree with one SFTP listdir round trip per
+directory and throws the listing away. Here the listing is kept in a local
+SQLite database (path, type, size, mtime):\n
+    * refresh(): The first time, one remote 'find -printf' streams the whole
+      tree back. After that, one 'find -type d' gets the mtime of every
+      directory, and only directories whose mtime changed (an entry was
+      added, removed or renamed) are listed again, with n_workers
+      concurrent 'find' commands.\n
+    * search(): Regex queries (like search_recursive's search_pattern_re and
+      search_pattern_inPath_re) are answered from the index, without
+      touching the remote.\n
+Note that a directory's mtime does not change when a file in it is modified
+in place (e.g. a video still being written). Use refresh(full=True) to
+re-list everything.
+
+Commands are run by a runner: run_local (find on this machine, e.g. on the
+transfer node), run_ssh (the ssh command; use a ControlMaster connection to
+avoid a 2FA prompt per command), or run_paramiko (an already connected
+paramiko SSHClient, e.g. ssh_t.client from bnpm.server.ssh_interface).
+Runners raise CommandError when a command fails, so that a failed listing is
+never mistaken for an empty directory.
+
+Demo:
+    index = RemoteIndex(root='/n/data1/hms/neurobio/sabatini/rich/data/res2p/round_5_experiments/', runner=run_paramiko(ssh_t.client), host='transfer.rc.hms.harvard.edu', max_depth=10)
+    index.refresh()
+    paths_source = index.search(
+        path='/n/data1/hms/neurobio/sabatini/rich/data/res2p/round_5_experiments/mouse_2_6/Camera_data/',
+        search_pattern_re='cam4.*avi',
+        search_pattern_inPath_re='/experiment/',
+        max_depth=8,
+    )
+
+Usage:
+    python remote_index.py refresh --root /n/data1/.../Camera_data --host transfer.rc.hms.harvard.edu --max_depth 8
+    python remote_index.py search --root /n/data1/.../Camera_data --host transfer.rc.hms.harvard.edu --search_pattern_re 'cam4.*avi' --search_pattern_inPath_re '/experiment/'
+"""
+
+import argparse
+import bisect
+import concurrent.futures
+import re
+import shlex
+import sqlite3
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+
+PATH_DB_DEFAULT = str(Path.home() / '.remote_index.sqlite')
+## One record per entry: type, size, mtime and path. NUL terminated, so any file name is safe.
+FORMAT_FIND = r'%y\t%s\t%T@\t%p\0'
+
+
+class CommandError(Exception):
+    """A command run by a runner failed (nonzero exit status). Raised after all of its stdout was yielded."""
+    def __init__(self, command, returncode, stderr=''):
+        super().__init__(f"Command failed with exit status {returncode}: {command}\n{stderr.strip()[-2000:]}")
+        self.command = command
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+def _run_process(args, command):
+    """Runs args. Yields chunks of stdout, then raises CommandError if the exit status is not 0."""
+    with tempfile.TemporaryFile() as f_stderr:  ## A file, so a chatty stderr cannot block stdout
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=f_stderr)
+        for chunk in iter(lambda: proc.stdout.read(2**16), b''):
+            yield chunk
+        proc.wait()
+        if proc.returncode != 0:
+            f_stderr.seek(0)
+            raise CommandError(command, proc.returncode, f_stderr.read().decode(errors='replace'))
+
+
+def run_local(command):
+    """
+    Runs a shell command on this machine. Yields chunks of its stdout, then
+    raises CommandError if it failed.
+    """
+    yield from _run_process(['bash', '-c', command], command)
+
+
+def run_ssh(host, options=[]):
+    """
+    Makes a runner that runs commands on host with the ssh command. It
+    raises CommandError if the command (or ssh) failed.
+
+    Args:
+        host (str):
+            '[user@]host'.
+        options (list of str):
+            ssh options. e.g. ['-o', 'ControlPath=~/.ssh/cm-%r@%h:%p'] to
+            reuse an authenticated connection.
+    """
+    def runner(command):
+        yield from _run_process(['ssh', *options, host, command], command)
+    return runner
+
+
+def run_paramiko(client):
+    """
+    Makes a runner that runs commands with a connected paramiko SSHClient.
+    Each command is its own channel, so commands can run concurrently on one
+    connection. It raises CommandError if the command failed.
+    """
+    def runner(command):
+        _, stdout, stderr = client.exec_command(command)
+        for chunk in iter(lambda: stdout.read(2**16), b''):
+            yield chunk
+        returncode = stdout.channel.recv_exit_status()
+        if returncode != 0:
+            raise CommandError(command, returncode, stderr.read().decode(errors='replace'))
+    return runner
+
+
+def iter_records(chunks):
+    """
+    Parses the stream of 'find -printf FORMAT_FIND'.
+
+    Yields:
+        (tuple):
+            (path, type, size, mtime)
+    """
+    buffer = b''
+    for chunk in chunks:
+        buffer += chunk
+        *records, buffer = buffer.split(b'\0')
+        for record in records:
+            type_, size, mtime, path = record.decode(errors='replace').split('\t', 3)
+            yield path, type_, int(size), float(mtime)
+
+
+def depth_of(path, root):
+    """Number of levels of path below root (root itself is 0)."""
+    return len(Path(path).relative_to(root).parts)
+
+
+class RemoteIndex:
+    """
+    Local index of a directory tree on a remote host.
+    RH 2024
+
+    Args:
+        root (str):
+            Root directory of the index.
+        runner (callable):
+            Runs a shell command where the tree is and yields chunks of its
+            stdout. See run_local, run_ssh and run_paramiko.
+        host (str):
+            Name of the host. Entries of different hosts are kept apart in
+            the database. '' for local.
+        max_depth (int):
+            Entries down to this many levels below root are indexed.
+        path_db (str):
+            Path to the SQLite database. Created if it does not exist.
+        n_workers (int):
+            Number of concurrent listing commands during incremental
+            refreshes.
+        chunk_size (int):
+            Number of directories listed by one command.
+        verbose (int):
+            Verbosity level.
+    """
+    def __init__(
+        self,
+        root,
+        runner=run_local,
+        host='',
+        max_depth=8,
+        path_db=PATH_DB_DEFAULT,
+        n_workers=4,
+        chunk_size=200,
+        verbose=1,
+    ):
+        self.root = str(Path(root)).rstrip('/') or '/'
+        self.runner = runner
+        self.host = host
+        self.max_depth = max_depth
+        self.n_workers = n_workers
+        self.chunk_size = chunk_size
+        self.verbose = verbose
+
+        self.conn = sqlite3.connect(str(path_db), timeout=30)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                host TEXT, path TEXT, parent TEXT, type TEXT, size INTEGER, mtime REAL,
+                PRIMARY KEY (host, path)
+            );
+            CREATE INDEX IF NOT EXISTS entries_parent ON entries (host, parent);
+            CREATE TABLE IF NOT EXISTS listed (
+                host TEXT, path TEXT, mtime REAL, time_listed REAL,
+                PRIMARY KEY (host, path)
+            );
+        """)
+        self._cache = None  ## See _load
+
+    def _under_root(self, table):
+        """SQL condition and args selecting rows of table at or under root."""
+        prefix = self.root.rstrip('/') + '/'
+        return f"{table}.host = ? AND ({table}.path = ? OR substr({table}.path, 1, ?) = ?)", (self.host, self.root, len(prefix), prefix)
+
+    def _listed(self):
+        """{dir: mtime} of the directories under root whose contents are indexed."""
+        cond, args = self._under_root('listed')
+        return dict(self.conn.execute(f"SELECT path, mtime FROM listed WHERE {cond}", args))
+
+    def _scan_dirs(self):
+        """{dir: mtime} of the directories under root whose contents should be indexed. One command."""
+        command = f"find {shlex.quote(self.root)} -maxdepth {self.max_depth - 1} -type d -printf {shlex.quote(FORMAT_FIND)}"
+        return {path: mtime for path, _, _, mtime in iter_records(self.runner(command))}
+
+    def _list_dirs(self, dirs):
+        """Lists the contents of dirs with one command. Returns the records."""
+        command = f"find {' '.join(shlex.quote(d) for d in dirs)} -mindepth 1 -maxdepth 1 -printf {shlex.quote(FORMAT_FIND)}"
+        return list(iter_records(self.runner(command)))
+
+    def _insert(self, records):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO entries (host, path, parent, type, size, mtime) VALUES (?, ?, ?, ?, ?, ?)",
+            ((self.host, path, str(Path(path).parent), type_, size, mtime) for path, type_, size, mtime in records),
+        )
+
+    def refresh(self, full=False):
+        """
+        Updates the index of the tree under root.
+        RH 2024
+
+        Args:
+            full (bool):
+                If True, re-lists the whole tree with one streamed find.
+                Else, only directories whose mtime changed are listed again
+                (the whole tree the first time).
+                If a command fails, the index is left as it was and the
+                CommandError is raised.
+
+        Returns:
+            (dict):
+                n_dirs (total), n_listed (directories listed again), n_removed
+                (directories gone), seconds.
+        """
+        tic = time.time()
+        self._cache = None
+        try:
+            return self._refresh(full=full, tic=tic)
+        except BaseException:
+            ## A failed command must not look like an empty directory: keep the index as it was
+            self.conn.rollback()
+            raise
+
+    def _refresh(self, full, tic):
+        """See refresh. Changes the database in one transaction, committed at the end."""
+        listed = self._listed()
+        if full or len(listed) == 0:
+            cond, args = self._under_root('entries')
+            self.conn.execute(f"DELETE FROM entries WHERE {cond}", args)
+            cond, args = self._under_root('listed')
+            self.conn.execute(f"DELETE FROM listed WHERE {cond}", args)
+            command = f"find {shlex.quote(self.root)} -maxdepth {self.max_depth} -printf {shlex.quote(FORMAT_FIND)}"
+            dirs = {}
+            def records():
+                for path, type_, size, mtime in iter_records(self.runner(command)):
+                    if type_ == 'd' and depth_of(path, self.root) < self.max_depth:
+                        dirs[path] = mtime  ## Its contents are in the same stream
+                    if path != self.root:
+                        yield path, type_, size, mtime
+            self._insert(records())
+            self.conn.executemany("INSERT OR REPLACE INTO listed (host, path, mtime, time_listed) VALUES (?, ?, ?, ?)", ((self.host, d, m, tic) for d, m in dirs.items()))
+            self.conn.commit()
+            out = {'n_dirs': len(dirs), 'n_listed': len(dirs), 'n_removed': 0, 'seconds': time.time() - tic}
+            print(f"Indexed {self.host + ':' if self.host else ''}{self.root}: {len(dirs)} directories in {out['seconds']:.1f} s (full)") if self.verbose > 0 else None
+            return out
+
+        dirs = self._scan_dirs()
+        removed = [d for d in listed if d not in dirs]
+        changed = [d for d, m in dirs.items() if listed.get(d) != m]
+        for d in removed:
+            self.conn.execute("DELETE FROM entries WHERE host = ? AND (path = ? OR parent = ?)", (self.host, d, d))
+            self.conn.execute("DELETE FROM listed WHERE host = ? AND path = ?", (self.host, d))
+        chunks = [changed[i:i + self.chunk_size] for i in range(0, len(changed), self.chunk_size)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.n_workers) as pool:
+            for chunk, records in zip(chunks, pool.map(self._list_dirs, chunks)):
+                self.conn.executemany("DELETE FROM entries WHERE host = ? AND parent = ?", ((self.host, d) for d in chunk))
+                self._insert(records)
+                self.conn.executemany("INSERT OR REPLACE INTO listed (host, path, mtime, time_listed) VALUES (?, ?, ?, ?)", ((self.host, d, dirs[d], tic) for d in chunk))
+        self.conn.commit()
+        out = {'n_dirs': len(dirs), 'n_listed': len(changed), 'n_removed': len(removed), 'seconds': time.time() - tic}
+        print(f"Indexed {self.host + ':' if self.host else ''}{self.root}: {len(dirs)} directories, {len(changed)} listed again, {len(removed)} removed, in {out['seconds']:.1f} s") if self.verbose > 0 else None
+        return out
+
+    def search(
+        self,
+        path=None,
+        search_pattern_re='',
+        search_pattern_inPath_re=None,
+        max_depth=None,
+        find_files=True,
+        find_folders=False,
+        min_size=None,
+    ):
+        """
+        Finds entries in the index, like sftp.search_recursive.
+        RH 2024
+
+        Args:
+            path (str):
+                Directory to search under. Default is root.
+            search_pattern_re (str):
+                Regex searched for in the name of each entry.
+            search_pattern_inPath_re (str):
+                Regex searched for in the full path of each entry. None to
+                skip.
+            max_depth (int):
+                Entries down to this many levels below path. None for all.
+            find_files (bool):
+                If True, returns files (and links).
+            find_folders (bool):
+                If True, returns directories.
+            min_size (int):
+                Only files of at least this many bytes. None to skip.
+
+        Returns:
+            (list of str):
+                Sorted paths.
+        """
+        path = self.root if path is None else (str(Path(path)).rstrip('/') or '/')
+        prefix = path.rstrip('/') + '/'
+        paths, types, sizes = self._load()
+        ## Paths under prefix are one contiguous run of the sorted paths. '0' sorts right after '/'.
+        i_start, i_end = bisect.bisect_left(paths, prefix), bisect.bisect_left(paths, prefix[:-1] + '0')
+        types_ok = set((['f', 'l'] if find_files else []) + (['d'] if find_folders else []))
+        pattern = re.compile(search_pattern_re)
+        pattern_inPath = re.compile(search_pattern_inPath_re) if search_pattern_inPath_re is not None else None
+        out = []
+        for i in range(i_start, i_end):
+            p = paths[i]
+            if (
+                (types[i] in types_ok)
+                and pattern.search(p[p.rfind('/') + 1:])
+                and ((pattern_inPath is None) or pattern_inPath.search(p))
+                and ((max_depth is None) or (p.count('/', len(prefix)) < max_depth))
+                and ((min_size is None) or (sizes[i] >= min_size))
+            ):
+                out.append(p)
+        return out
+
+    def _load(self):
+        """Sorted paths, types and sizes of the entries under root. Kept in memory until the next refresh."""
+        if self._cache is None:
+            cond, args = self._under_root('entries')
+            rows = self.conn.execute(f"SELECT path, type, size FROM entries WHERE {cond} ORDER BY path", args).fetchall()
+            self._cache = ([r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows])
+        return self._cache
+
+    def stat(self, paths):
+        """{path: (type, size, mtime)} of paths in the index."""
+        out = {}
+        for p in paths:
+            row = self.conn.execute("SELECT type, size, mtime FROM entries WHERE host = ? AND path = ?", (self.host, str(p))).fetchone()
+            if row is not None:
+                out[str(p)] = row
+        return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cached index of a remote directory tree.')
+    parser.add_argument('command', type=str, choices=['refresh', 'search'])
+    parser.add_argument('--root', type=str, required=True, help='Root directory of the index.')
+    parser.add_argument('--host', type=str, default='', help='[user@]host to ssh to. Empty for this machine.')
+    parser.add_argument('--max_depth', type=int, default=8, help='Levels below root to index.')
+    parser.add_argument('--path_db', type=str, default=PATH_DB_DEFAULT, help='Path to the index database.')
+    parser.add_argument('--n_workers', type=int, default=4, help='Concurrent listing commands.')
+    parser.add_argument('--full', action='store_true', help='Re-list the whole tree (refresh).')
+    parser.add_argument('--path', type=str, default=None, help='Directory to search under (search). Default is root.')
+    parser.add_argument('--search_pattern_re', type=str, default='', help='Regex for names (search).')
+    parser.add_argument('--search_pattern_inPath_re', type=str, default=None, help='Regex for full paths (search).')
+    parser.add_argument('--search_max_depth', type=int, default=None, help='Levels below path (search).')
+    parser.add_argument('--find_folders', action='store_true', help='Return directories instead of files (search).')
+    args = parser.parse_args()
+
+    index = RemoteIndex(
+        root=args.root,
+        runner=run_ssh(args.host) if args.host else run_local,
+        host=args.host,
+        max_depth=args.max_depth,
+        path_db=args.path_db,
+        n_workers=args.n_workers,
+        verbose=1 if args.command == 'refresh' else 0,
+    )
+    if args.command == 'refresh':
+        index.refresh(full=args.full)
+    elif args.command == 'search':
+        print('\n'.join(index.search(
+            path=args.path,
+            search_pattern_re=args.search_pattern_re,
+            search_pattern_inPath_re=args.search_pattern_inPath_re,
+            max_depth=args.search_max_depth,
+            find_files=not args.find_folders,
+            find_folders=args.find_folders,
+        )))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,553 @@
+"""
+TRANSFER
+RH 2024
+
+Parallel, resumable bulk transfers with rsync or Globus. Pure/native
+Python 3.
+
+Replaces the serial loop of masterController_transfer.ipynb (one rsync per
+directory from search_recursive, run one after another through send_expect).
+Items are source -> destination pairs (e.g. one per directory). They are run
+by a bounded pool of n_workers workers, each item in its own rsync (or
+globus) process, so a slow directory only holds up one worker. Progress is
+kept in a manifest directory:\n
+    * items.jsonl: The items, written once. Resuming reads them from here
+      instead of searching the source again.\n
+    * log.jsonl: One line per finished attempt of an item (state, bytes,
+      seconds, returncode), appended and flushed as soon as it ends.\n
+    * logs/{key}.log: Output of the last attempt of each item.\n
+Items whose last record is 'complete' are skipped when the transfer is run
+again, so a crash or a dropped ssh session only costs the items in flight
+(rsync --partial keeps partly sent files). Each finished item prints its
+throughput and the aggregate GB/s of the transfer. rsync return code 24
+(files vanished during the transfer, normal in a directory that is still
+being acquired) counts as complete, with a warning in the log and summary.
+
+Demo:
+    items = [{'source': d + '/', 'destination': str(Path(dir_destination_stem) / Path(d).parts[-4])} for d in dirs_source]
+    transfer = Transfer(dir_manifest='~/transfers/mouse_0403R', items=items, backend='rsync', n_workers=8)
+    summary = transfer.run()
+
+Usage (e.g. on the transfer node, in tmux or through send_expect):
+    python transfer.py run --dir_manifest ~/transfers/mouse_0403R --path_items items.tsv --n_workers 8
+    python transfer.py run --dir_manifest ~/transfers/mouse_0403R  ## resume
+    python transfer.py status --dir_manifest ~/transfers/mouse_0403R
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import shlex
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+
+## Globus endpoint IDs by name. Same as globus_helpers/globusTransfer.sh.
+ENDPOINTS = {
+    'hms': 'b0718922-7031-11e9-b7f8-0a37f382de32',
+    'fas': '1156ed9e-6984-11ea-af52-0201714f6eab',
+}
+RE_UUID = re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
+
+
+def key_item(item):
+    """
+    Key of an item: hash of its source and destination, and of its
+    'retransfer' round if it has one (see verify.retransfer_items), so that
+    copying a file again is a new item, not the one that is already
+    complete.
+    """
+    retransfer = f"\0{item['retransfer']}" if item.get('retransfer') is not None else ''
+    return hashlib.sha1(f"{item['source']}\0{item['destination']}{retransfer}".encode()).hexdigest()[:16]
+
+
+def split_remote(path):
+    """Splits 'host:path' into (host, path). host is None for local paths."""
+    m = re.match(r'^([^/:]+):(.*)$', str(path))
+    return (m.group(1), m.group(2)) if m else (None, str(path))
+
+
+def globus_path(path):
+    """
+    Converts '{endpoint}:{path}' to '{endpoint ID}:{path}' for globus-cli.
+    Raises ValueError if the path does not start with a name in ENDPOINTS or
+    an endpoint ID.
+    """
+    endpoint, path_endpoint = split_remote(path)
+    endpoint = ENDPOINTS.get(endpoint, endpoint)
+    if (endpoint is None) or (not RE_UUID.match(endpoint)):
+        raise ValueError(f"Globus path must be '{{endpoint}}:{{path}}' with an endpoint ID or one of {list(ENDPOINTS)}, not {path}")
+    return f"{endpoint}:{path_endpoint}"
+
+
+def make_rsync_command(source, destination, preserve_attributes=True, partial=True, options=[]):
+    """
+    Makes an rsync command that copies source to destination and prints
+    transfer statistics. The destination directory is created if needed, also
+    on a remote host (with --rsync-path).
+    RH 2024
+
+    Args:
+        source (str):
+            Source path ('host:path' for a remote one). A trailing '/' copies
+            the contents of the directory, not the directory itself.
+        destination (str):
+            Destination path ('host:path' for a remote one).
+        preserve_attributes (bool):
+            If True, uses -a (times, permissions, links). Else -r.
+        partial (bool):
+            If True, keeps partly transferred files, so an interrupted
+            transfer resumes them.
+        options (list of str):
+            Extra rsync options (e.g. ['--bwlimit=50M', '--exclude=*.tmp']).
+
+    Returns:
+        (list of str):
+            Command.
+    """
+    command = ['rsync', '-a' if preserve_attributes else '-r', '--stats']
+    command += ['--partial'] if partial else []
+    host, path = split_remote(destination)
+    if host is not None:
+        command += [f'--rsync-path=mkdir -p {shlex.quote(path)} && rsync']
+    return command + list(options) + [str(source), str(destination)]
+
+
+def parse_rsync_stats(text):
+    """
+    Parses the --stats summary of rsync.
+
+    Returns:
+        (dict):
+            bytes (int): Total size of the files transferred. None if not
+            found.\n
+            n_files (int): Number of files transferred.\n
+    """
+    out = {}
+    for name, pattern in [('bytes', r'Total transferred file size: ([\d,]+)'), ('n_files', r'Number of (?:regular )?files transferred: ([\d,]+)')]:
+        m = re.search(pattern, text)
+        out[name] = int(m.group(1).replace(',', '')) if m else None
+    return out
+
+
+def run_process(command, path_log, timeout=None, procs=None):
+    """
+    Runs a command with its output to path_log. Kills it after timeout
+    seconds.
+
+    Args:
+        procs (set):
+            Running processes. The process is added while it runs, so that it
+            can be terminated from another thread.
+
+    Returns:
+        (tuple):
+            (returncode, output). returncode is None if the command timed out.
+    """
+    with open(path_log, 'w') as f_log:
+        f_log.write(' '.join(shlex.quote(c) for c in command) + '\n')
+        f_log.flush()
+        proc = subprocess.Popen(command, stdout=f_log, stderr=subprocess.STDOUT)
+        procs.add(proc) if procs is not None else None
+        try:
+            returncode = proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            returncode = None
+        finally:
+            procs.discard(proc) if procs is not None else None
+    with open(path_log, 'r', errors='replace') as f:
+        return returncode, f.read()
+
+
+def run_rsync(item, path_log, timeout=None, procs=None, preserve_attributes=True, options=[]):
+    """
+    Transfers an item with rsync. item may have 'options': extra rsync options
+    for this item.
+
+    Returns:
+        (dict):
+            returncode, bytes and n_files. Also warning, if the returncode
+            is one of RSYNC_WARNINGS.
+    """
+    if split_remote(item['destination'])[0] is None:
+        Path(item['destination']).parent.mkdir(parents=True, exist_ok=True)  ## rsync makes the last level itself
+    command = make_rsync_command(item['source'], item['destination'], preserve_attributes=preserve_attributes, options=list(options) + item.get('options', []))
+    returncode, output = run_process(command, path_log, timeout=timeout, procs=procs)
+    return {'returncode': returncode, **parse_rsync_stats(output), **({'warning': RSYNC_WARNINGS[returncode]} if returncode in RSYNC_WARNINGS else {})}
+
+
+def run_globus(item, path_log, timeout=None, procs=None, sync_level='checksum', options=[]):
+    """
+    Transfers an item with one Globus task (globus-cli): submits it, waits
+    for it, and reads its bytes transferred. Source and destination are
+    '{endpoint}:{path}', where endpoint is an ID or a name in ENDPOINTS (see
+    globus_path).
+
+    Returns:
+        (dict):
+            returncode, bytes, n_files and task_id. 'error' if the source or
+            destination does not name an endpoint.
+    """
+    try:
+        source, destination = [globus_path(p) for p in [item['source'], item['destination']]]
+    except ValueError as e:
+        return {'returncode': -1, 'bytes': None, 'n_files': None, 'task_id': None, 'error': str(e)}
+    command = ['globus', 'transfer', source, destination, '--sync-level', sync_level, '--format', 'unix', '--jmespath', 'task_id']
+    command += ['--recursive'] if item.get('recursive', str(item['source']).endswith('/')) else []
+    returncode, output = run_process(command + list(options), path_log, timeout=60, procs=procs)
+    if returncode != 0:
+        return {'returncode': returncode, 'bytes': None, 'n_files': None, 'task_id': None}
+    task_id = output.splitlines()[-1].strip()
+    command = ['globus', 'task', 'wait', task_id, '--polling-interval', '30'] + (['--timeout', str(int(timeout))] if timeout else [])
+    returncode, _ = run_process(command, str(path_log) + '.wait', timeout=None, procs=procs)
+    if returncode != 0:
+        return {'returncode': returncode, 'bytes': None, 'n_files': None, 'task_id': task_id}
+    _, output = run_process(['globus', 'task', 'show', task_id, '--format', 'json'], str(path_log) + '.show', timeout=60, procs=procs)
+    try:
+        task = json.loads(output[output.index('{'):])
+    except ValueError:
+        task = {}
+    return {'returncode': 0 if task.get('status') == 'SUCCEEDED' else 1, 'bytes': task.get('bytes_transferred'), 'n_files': task.get('files_transferred'), 'task_id': task_id}
+
+
+BACKENDS = {
+    'rsync': run_rsync,
+    'globus': run_globus,
+}
+## rsync return codes that still leave the item complete. Files that vanish are normal in a directory that is still being acquired.
+RSYNC_WARNINGS = {
+    24: 'some files vanished before they could be transferred',
+}
+## Return codes of each backend for which an item is complete
+RETURNCODES_COMPLETE = {
+    'rsync': {0, *RSYNC_WARNINGS},
+    'globus': {0},
+}
+
+
+class Manifest:
+    """
+    Persistent record of the items of a transfer and of each finished
+    attempt. Appends are flushed and fsynced, so the record survives a crash.
+    RH 2024
+
+    Args:
+        dir_manifest (str):
+            Directory of the manifest. Created if it does not exist.
+    """
+    def __init__(self, dir_manifest):
+        self.dir_manifest = Path(dir_manifest).expanduser().resolve()
+        (self.dir_manifest / 'logs').mkdir(parents=True, exist_ok=True)
+        self.path_items = self.dir_manifest / 'items.jsonl'
+        self.path_log = self.dir_manifest / 'log.jsonl'
+        self._lock = threading.Lock()
+
+    def read_items(self):
+        """Items of the transfer, in order. Empty if none were written."""
+        if not self.path_items.exists():
+            return []
+        with open(self.path_items, 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def add_items(self, items):
+        """
+        Adds items that are not in the manifest yet (by key_item). Written
+        atomically.
+
+        Returns:
+            (int):
+                Number of items added.
+        """
+        items_old = self.read_items()
+        keys = {item['key'] for item in items_old}
+        items_new = []
+        for item in items:
+            item = {**item, 'key': key_item(item)}
+            if item['key'] not in keys:
+                keys.add(item['key'])
+                items_new.append(item)
+        if len(items_new) > 0:
+            path_tmp = self.path_items.with_suffix('.jsonl.tmp')
+            with open(path_tmp, 'w') as f:
+                f.writelines(json.dumps(item) + '\n' for item in items_old + items_new)
+            os.replace(path_tmp, self.path_items)
+        return len(items_new)
+
+    def append(self, record):
+        """Appends a record to log.jsonl. Thread safe."""
+        with self._lock:
+            with open(self.path_log, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def read_log(self):
+        """All records, in order. A line cut off by a crash is ignored."""
+        if not self.path_log.exists():
+            return []
+        records = []
+        with open(self.path_log, 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+        return records
+
+    def last_records(self):
+        """{key: last record} of each item that has one."""
+        return {r['key']: r for r in self.read_log()}
+
+
+class Transfer:
+    """
+    Runs the items of a manifest with a bounded pool of concurrent transfers.
+    RH 2024
+
+    Args:
+        dir_manifest (str):
+            Directory of the manifest. See Manifest.
+        items (list of dict):
+            Items to add to the manifest: dicts with 'source' and
+            'destination', and optionally 'options' (extra rsync options).
+            Items already in the manifest are not added again. Can be empty
+            to resume.
+        backend (str):
+            'rsync' or 'globus'. See BACKENDS. With 'globus', a ValueError
+            is raised if a source or destination of 'items' does not name
+            an endpoint (see globus_path).
+        n_workers (int):
+            Number of items transferred at once.
+        max_retries (int):
+            Number of times a failed item is retried (in the same run).
+        backoff (float):
+            Seconds waited before the first retry. Doubles each retry.
+        timeout (float):
+            Seconds after which an attempt is killed and counts as failed.
+            None for no limit.
+        kwargs_backend (dict):
+            Keyword arguments of the backend function (e.g. {'options':
+            ['--bwlimit=100M']}).
+        verbose (int):
+            Verbosity level. 1 prints each finished item and the aggregate
+            throughput.
+    """
+    def __init__(
+        self,
+        dir_manifest,
+        items=[],
+        backend='rsync',
+        n_workers=4,
+        max_retries=2,
+        backoff=30,
+        timeout=None,
+        kwargs_backend={},
+        verbose=1,
+    ):
+        assert backend in BACKENDS, f"backend must be one of {list(BACKENDS)}, not {backend}"
+        if backend == 'globus':
+            ## Catch paths without an endpoint before anything is transferred
+            [globus_path(item[key]) for item in items for key in ['source', 'destination']]
+        self.manifest = Manifest(dir_manifest)
+        self.backend = backend
+        self.n_workers = n_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.kwargs_backend = dict(kwargs_backend)
+        self.verbose = verbose
+
+        n_added = self.manifest.add_items(items)
+        self.items = self.manifest.read_items()
+        print(f"Manifest {self.manifest.dir_manifest}: {len(self.items)} items ({n_added} new)") if verbose > 0 else None
+
+        self._procs = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _run_item(self, item):
+        """Transfers one item, with retries. Returns its last record."""
+        for attempt in range(self.max_retries + 1):
+            if self._stop.is_set():
+                return None
+            time_start = time.time()
+            try:
+                out = BACKENDS[self.backend](
+                    item, self.manifest.dir_manifest / 'logs' / f"{item['key']}.log", timeout=self.timeout, procs=self._procs, **self.kwargs_backend,
+                )
+            except OSError as e:
+                out = {'returncode': -1, 'bytes': None, 'n_files': None, 'error': str(e)}
+            if self._stop.is_set():
+                return None  ## Interrupted: not recorded, rerun on resume
+            state = 'complete' if out['returncode'] in RETURNCODES_COMPLETE[self.backend] else ('timeout' if out['returncode'] is None else 'failed')
+            record = {
+                'key': item['key'],
+                'state': state,
+                'attempt': attempt,
+                'time_start': time_start,
+                'time_end': time.time(),
+                'seconds': time.time() - time_start,
+                **out,
+            }
+            self.manifest.append(record)
+            if state == 'complete':
+                print(f"Warning: {item['source']} (returncode {out['returncode']}): {out['warning']}") if ('warning' in out) and self.verbose > 0 else None
+                return record
+            if attempt < self.max_retries:
+                print(f"{state}: {item['source']} (returncode {out['returncode']}). Retrying in {self.backoff * 2**attempt:.0f} s") if self.verbose > 0 else None
+                self._stop.wait(self.backoff * 2**attempt)
+        return record
+
+    def run(self):
+        """
+        Transfers all items that are not complete.
+
+        Returns:
+            (dict):
+                Summary of the manifest. See summarize.
+        """
+        records = self.manifest.last_records()
+        queue = [item for item in self.items if records.get(item['key'], {}).get('state') != 'complete']
+        n_total, n_done, n_bytes = len(queue), 0, 0
+        print(f"Transferring {n_total} items with {self.n_workers} workers ({len(self.items) - n_total} already complete)") if self.verbose > 0 else None
+
+        time_start = time.time()
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.n_workers)  ## Each item is its own process; threads only wait on them
+        try:
+            futures = {pool.submit(self._run_item, item): item for item in queue}
+            for future in concurrent.futures.as_completed(futures):
+                record, item = future.result(), futures[future]
+                if record is None:
+                    continue
+                n_done += 1
+                n_bytes += record['bytes'] or 0
+                if self.verbose > 0:
+                    elapsed = time.time() - time_start
+                    gb = (record['bytes'] or 0) / 1e9
+                    print(
+                        f"[{n_done}/{n_total}] {record['state']}: {item['source']} -> {item['destination']}"
+                        f" ({gb:.2f} GB in {record['seconds']:.0f} s, {gb / max(record['seconds'], 1e-9):.3f} GB/s)"
+                        f" | total {n_bytes / 1e9:.2f} GB, {n_bytes / 1e9 / max(elapsed, 1e-9):.3f} GB/s, ETA {elapsed / n_done * (n_total - n_done):.0f} s"
+                    )
+        except KeyboardInterrupt:
+            print("Interrupted. Stopping transfers; rerun to resume.") if self.verbose > 0 else None
+            self._stop.set()
+            for proc in list(self._procs):
+                proc.terminate()
+            raise
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        summary = summarize(self.manifest)
+        print(format_summary(summary)) if self.verbose > 0 else None
+        return summary
+
+
+def summarize(manifest):
+    """
+    Summarizes a manifest from the last record of each item.
+    RH 2024
+
+    Returns:
+        (dict):
+            * counts (dict): Number of items per state ('pending' for items
+              with no record).\n
+            * bytes (int): Bytes transferred by complete items.\n
+            * seconds_wall (float): Time from the start of the first to the
+              end of the last complete attempt.\n
+            * gb_per_s (float): Aggregate throughput: bytes / seconds_wall.\n
+            * failed (list): Items whose last attempt failed.\n
+            * warnings (list): Complete items whose last attempt had a
+              warning (e.g. rsync return code 24), with 'warning'.\n
+            * slowest (list): The 5 complete items with the lowest
+              throughput, with 'gb_per_s'.\n
+    """
+    items = manifest.read_items()
+    records = manifest.last_records()
+    counts = {}
+    for item in items:
+        state = records.get(item['key'], {}).get('state', 'pending')
+        counts[state] = counts.get(state, 0) + 1
+    complete = [(item, records[item['key']]) for item in items if records.get(item['key'], {}).get('state') == 'complete']
+    n_bytes = sum(r['bytes'] or 0 for _, r in complete)
+    seconds_wall = (max(r['time_end'] for _, r in complete) - min(r['time_start'] for _, r in complete)) if complete else 0
+    slowest = sorted(
+        [{**item, 'gb_per_s': (r['bytes'] or 0) / 1e9 / max(r['seconds'], 1e-9), 'seconds': r['seconds']} for item, r in complete],
+        key=lambda d: d['gb_per_s'],
+    )[:5]
+    return {
+        'counts': counts,
+        'bytes': n_bytes,
+        'seconds_wall': seconds_wall,
+        'gb_per_s': n_bytes / 1e9 / max(seconds_wall, 1e-9),
+        'failed': [item for item in items if records.get(item['key'], {}).get('state') in ['failed', 'timeout']],
+        'warnings': [{**item, 'warning': r['warning']} for item, r in complete if 'warning' in r],
+        'slowest': slowest,
+    }
+
+
+def format_summary(summary):
+    """Formats a summary as lines of text."""
+    lines = [
+        f"Items: {summary['counts']}",
+        f"Transferred {summary['bytes'] / 1e9:.2f} GB in {summary['seconds_wall']:.0f} s: {summary['gb_per_s']:.3f} GB/s",
+    ]
+    lines += [f"Slowest: {d['source']} ({d['gb_per_s']:.3f} GB/s, {d['seconds']:.0f} s)" for d in summary['slowest']]
+    lines += [f"Warning: {d['source']} -> {d['destination']}: {d['warning']}" for d in summary.get('warnings', [])]
+    lines += [f"Failed: {item['source']} -> {item['destination']}" for item in summary['failed']]
+    return '\n'.join(lines)
+
+
+def read_items(path_items):
+    """
+    Reads items from a file: a JSON list of {'source', 'destination'} dicts,
+    or lines of 'source<TAB>destination'.
+    """
+    with open(path_items, 'r') as f:
+        text = f.read()
+    if str(path_items).endswith('.json'):
+        return json.loads(text)
+    return [dict(zip(['source', 'destination'], line.split('\t'))) for line in text.splitlines() if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parallel, resumable bulk transfers with rsync or Globus.')
+    parser.add_argument('command', type=str, choices=['run', 'status'], help='run: transfer items that are not complete. status: summarize the manifest.')
+    parser.add_argument('--dir_manifest', type=str, required=True, help='Directory of the manifest.')
+    parser.add_argument('--path_items', type=str, default=None, help='Items to add: .json list of {source, destination}, or source<TAB>destination lines.')
+    parser.add_argument('--backend', type=str, default='rsync', choices=list(BACKENDS), help='Transfer backend.')
+    parser.add_argument('--n_workers', type=int, default=4, help='Number of items transferred at once.')
+    parser.add_argument('--max_retries', type=int, default=2, help='Retries of a failed item.')
+    parser.add_argument('--backoff', type=float, default=30, help='Seconds before the first retry. Doubles each retry.')
+    parser.add_argument('--timeout', type=float, default=None, help='Seconds after which an attempt is killed.')
+    parser.add_argument('--options', type=str, nargs='*', default=[], help='Extra rsync options, e.g. --options=--bwlimit=100M.')
+    parser.add_argument('--verbose', type=int, default=1, help='Verbosity level.')
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        print(format_summary(summarize(Manifest(args.dir_manifest))))
+        return
+    transfer = Transfer(
+        dir_manifest=args.dir_manifest,
+        items=read_items(args.path_items) if args.path_items is not None else [],
+        backend=args.backend,
+        n_workers=args.n_workers,
+        max_retries=args.max_retries,
+        backoff=args.backoff,
+        timeout=args.timeout,
+        kwargs_backend={'options': args.options},
+        verbose=args.verbose,
+    )
+    summary = transfer.run()
+    raise SystemExit(1 if len(summary['failed']) > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
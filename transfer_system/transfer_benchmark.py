@@ -0,0 +1,201 @@
+"""
+TRANSFER BENCHMARKS
+RH 2024
+
+Local test harness for transfer.py and verify.py: runs rsync between two
+temporary directories. Pure/native Python 3. Needs rsync on the PATH.
+
+Demo:
+python transfer_benchmark.py parallel --n_items 32 --n_files 8 --size_mb 4 --n_workers 1 4 8 --n_slow 1 --bwlimit 2000
+python transfer_benchmark.py resume --n_items 32 --n_workers 4 --kill_after 8
+python transfer_benchmark.py verify --n_items 16 --n_files 8 --size_mb 16 --n_workers 1 8
+"""
+
+import argparse
+import filecmp
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import transfer
+import verify
+
+
+def make_source(dir_source, n_items=32, n_files=8, size_mb=4, seed=0):
+    """
+    Makes n_items directories of n_files random files of size_mb MB each, like
+    one directory of videos per session.
+
+    Returns:
+        (list of str):
+            Paths of the directories.
+    """
+    rng = random.Random(seed)
+    dirs = []
+    for i_item in range(n_items):
+        d = Path(dir_source) / f'session_{i_item:04d}' / 'experiment'
+        d.mkdir(parents=True, exist_ok=True)
+        for i_file in range(n_files):
+            with open(d / f'cam4_{i_file:03d}.avi', 'wb') as f:
+                f.write(rng.randbytes(int(size_mb * 2**20)))
+        dirs.append(str(d))
+    return dirs
+
+
+def make_items(dirs_source, dir_destination, n_slow=0, bwlimit=2000):
+    """
+    Makes one item per source directory, like the notebook: the destination
+    is named after the session. The first n_slow items are slowed with
+    --bwlimit (KB/s).
+    """
+    return [
+        {
+            'source': d + '/',
+            'destination': str(Path(dir_destination) / Path(d).parts[-2]),
+            **({'options': [f'--bwlimit={bwlimit}']} if i < n_slow else {}),
+        }
+        for i, d in enumerate(dirs_source)
+    ]
+
+
+def compare_trees(dir_a, dir_b):
+    """True if dir_a and dir_b have the same files with the same contents."""
+    cmp = filecmp.dircmp(dir_a, dir_b)
+    if cmp.left_only or cmp.right_only or cmp.funny_files:
+        return False
+    _, mismatch, errors = filecmp.cmpfiles(dir_a, dir_b, cmp.common_files, shallow=False)
+    if mismatch or errors:
+        return False
+    return all(compare_trees(os.path.join(dir_a, d), os.path.join(dir_b, d)) for d in cmp.common_dirs)
+
+
+def bench_parallel(n_items=32, n_files=8, size_mb=4, n_workers=[1, 4, 8], n_slow=1, bwlimit=2000):
+    """Wall time and throughput of the same transfer with more and more workers."""
+    with tempfile.TemporaryDirectory() as dir_tmp:
+        dirs_source = make_source(Path(dir_tmp) / 'source', n_items=n_items, n_files=n_files, size_mb=size_mb)
+        gb = n_items * n_files * size_mb * 2**20 / 1e9
+        print(f"{n_items} items, {gb:.2f} GB, {n_slow} slowed to {bwlimit} KB/s")
+        for n in n_workers:
+            dir_destination = Path(dir_tmp) / f'destination_{n}'
+            items = make_items(dirs_source, dir_destination, n_slow=n_slow, bwlimit=bwlimit)
+            t = transfer.Transfer(dir_manifest=Path(dir_tmp) / f'manifest_{n}', items=items, n_workers=n, verbose=0)
+            tic = time.time()
+            summary = t.run()
+            toc = time.time() - tic
+            ok = all(compare_trees(d, Path(dir_destination) / Path(d).parts[-2]) for d in dirs_source)
+            print(f"n_workers={n:>3}: {toc:7.2f} s, {gb / toc:.3f} GB/s, {summary['counts']}, destination matches source: {ok}")
+
+
+def bench_resume(n_items=32, n_files=8, size_mb=4, n_workers=4, kill_after=8):
+    """
+    Kills a transfer (SIGKILL, like a crash) after kill_after items are
+    complete, then resumes it. Complete items must not be transferred again.
+    """
+    with tempfile.TemporaryDirectory() as dir_tmp:
+        dirs_source = make_source(Path(dir_tmp) / 'source', n_items=n_items, n_files=n_files, size_mb=size_mb)
+        items = make_items(dirs_source, Path(dir_tmp) / 'destination', n_slow=n_items, bwlimit=int(n_files * size_mb * 1024))  ## ~1 s per item
+        path_items = Path(dir_tmp) / 'items.json'
+        with open(path_items, 'w') as f:
+            json.dump(items, f)
+        dir_manifest = Path(dir_tmp) / 'manifest'
+
+        proc = subprocess.Popen(
+            [sys.executable, str(Path(__file__).parent / 'transfer.py'), 'run', '--dir_manifest', str(dir_manifest), '--path_items', str(path_items), '--n_workers', str(n_workers), '--verbose', '0'],
+            start_new_session=True,
+        )
+        path_log = dir_manifest / 'log.jsonl'
+        while (not path_log.exists()) or (len(path_log.read_text().splitlines()) < kill_after):
+            time.sleep(0.05)
+            assert proc.poll() is None, "Transfer ended before it was killed. Increase n_items or lower kill_after."
+        os.killpg(proc.pid, signal.SIGKILL)  ## Kills rsync too
+        proc.wait()
+        n_complete_before = transfer.summarize(transfer.Manifest(dir_manifest))['counts'].get('complete', 0)
+        print(f"Killed after {n_complete_before} of {n_items} items were complete")
+
+        tic = time.time()
+        summary = transfer.Transfer(dir_manifest=dir_manifest, n_workers=n_workers, verbose=0).run()
+        toc = time.time() - tic
+        records = transfer.Manifest(dir_manifest).read_log()
+        n_rerun = len(records) - len({r['key'] for r in records})
+        ok = all(compare_trees(d, Path(dir_tmp) / 'destination' / Path(d).parts[-2]) for d in dirs_source)
+        print(f"Resumed in {toc:.2f} s: {summary['counts']}. Items transferred twice: {n_rerun}. Destination matches source: {ok}")
+
+
+def corrupt(path):
+    """Overwrites a few bytes in the middle of a file, keeping its size and mtime, like silent corruption."""
+    st = os.stat(path)
+    with open(path, 'r+b') as f:
+        f.seek(st.st_size // 2)
+        f.write(os.urandom(7))
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def bench_verify(n_items=16, n_files=8, size_mb=16, n_workers=[1, 8]):
+    """
+    Transfers a source tree (directory items and one single-file item) and
+    verifies the copy: cold (no cached hashes) with each number of workers,
+    then warm (all hashes cached). Then, twice, files are corrupted without
+    changing their size or mtime (one in a directory item and the
+    single-file item; in the first round another file is also deleted),
+    found, transferred again with the same manifest, and must then verify
+    clean.
+    """
+    with tempfile.TemporaryDirectory() as dir_tmp:
+        dirs_source = make_source(Path(dir_tmp) / 'source', n_items=n_items, n_files=n_files, size_mb=size_mb)
+        items = make_items(dirs_source, Path(dir_tmp) / 'destination')
+        items.append({'source': str(Path(dirs_source[0]) / 'cam4_001.avi'), 'destination': str(Path(dir_tmp) / 'destination_files')})
+        dir_manifest = Path(dir_tmp) / 'manifest'
+        transfer.Transfer(dir_manifest=dir_manifest, items=items, n_workers=4, verbose=0).run()
+        gb = (n_items * n_files + 1) * size_mb * 2**20 / 1e9
+        print(f"{len(items)} items, {n_items * n_files + 1} files, {gb:.2f} GB per side")
+
+        for n in n_workers:
+            report = verify.verify(items, n_workers=n, n_workers_remote=n, n_parallel_remote=1, path_db=Path(dir_tmp) / f'hashes_{n}.sqlite', verbose=0)
+            print(f"cold, n_workers={n:>3}: {report['seconds']:6.2f} s ({2 * gb / report['seconds']:.2f} GB/s hashed), {report['n_bad']} bad")
+        path_db = Path(dir_tmp) / f'hashes_{n_workers[-1]}.sqlite'
+        report = verify.verify(items, n_workers=n_workers[-1], path_db=path_db, verbose=0)
+        print(f"warm (cached):     {report['seconds']:6.2f} s, {report['n_bad']} bad")
+
+        for i_round in range(2):
+            corrupt(Path(items[0]['destination']) / 'cam4_000.avi')
+            corrupt(Path(items[-1]['destination']) / 'cam4_001.avi')
+            (Path(items[-2]['destination']) / 'cam4_001.avi').unlink() if i_round == 0 else None
+            report = verify.verify(items, n_workers=n_workers[-1], path_db=path_db, verbose=0)
+            bad = [(r['source'], r['hash_mismatch'], r['missing']) for r in report['items'] if r['n_ok'] < r['n_files']]
+            items_retransfer = verify.retransfer_items(report)
+            summary = transfer.Transfer(dir_manifest=dir_manifest, items=items_retransfer, verbose=0).run()
+            report = verify.verify(items, n_workers=n_workers[-1], path_db=path_db, verbose=0)
+            print(f"Round {i_round + 1}: found {bad}. After transferring {len(items_retransfer)} items again ({summary['counts']}): {report['n_ok']} of {report['n_files']} files ok, {report['n_bad']} bad")
+            assert report['n_bad'] == 0, "Files found bad were not copied again"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local test harness for transfer.py and verify.py.')
+    parser.add_argument('benchmark', type=str, choices=['parallel', 'resume', 'verify'])
+    parser.add_argument('--n_items', type=int, default=32)
+    parser.add_argument('--n_files', type=int, default=8)
+    parser.add_argument('--size_mb', type=float, default=4)
+    parser.add_argument('--n_workers', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--n_slow', type=int, default=1)
+    parser.add_argument('--bwlimit', type=int, default=2000)
+    parser.add_argument('--kill_after', type=int, default=8)
+    args = parser.parse_args()
+
+    assert shutil.which('rsync') is not None, "rsync not found on the PATH"
+    if args.benchmark == 'parallel':
+        bench_parallel(n_items=args.n_items, n_files=args.n_files, size_mb=args.size_mb, n_workers=args.n_workers, n_slow=args.n_slow, bwlimit=args.bwlimit)
+    elif args.benchmark == 'resume':
+        bench_resume(n_items=args.n_items, n_files=args.n_files, size_mb=args.size_mb, n_workers=args.n_workers[0], kill_after=args.kill_after)
+    elif args.benchmark == 'verify':
+        bench_verify(n_items=args.n_items, n_files=args.n_files, size_mb=args.size_mb, n_workers=args.n_workers)
+
+
+if __name__ == '__main__':
+    main()
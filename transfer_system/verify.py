@@ -0,0 +1,474 @@
+"""
+VERIFY
+RH 2024
+
+Parallel checksum verification of completed transfers. Pure/native Python 3.
+
+Compares every file of each transfer item (source -> destination, as in a
+transfer.py manifest) by hash, on both sides at the same time:\n
+    * Source (local): Files are hashed by a process pool, each file read in
+      chunks through mmap.\n
+    * Destination (local or remote): One 'find' lists the files of an item
+      (size, mtime, ctime), and one batched md5sum command per directory hashes
+      them, several files at once (xargs -P). Commands are run by a runner
+      from remote_index.py (run_local, run_ssh or run_paramiko).\n
+Hashes are cached in a local SQLite database, one per (host, path,
+algorithm). A cached hash is used only if the file's size, mtime and ctime
+are still those it was hashed with, so unchanged files (e.g. multi-GB .avi
+videos) are not hashed again on later runs. ctime is checked because rsync
+-a gives a file that it writes again the mtime of the source, but cannot set
+its ctime.
+
+The report lists missing, extra and mismatched files, and retransfer_items()
+turns it into transfer.py items that copy them again (with rsync
+--checksum, since a corrupted file can have the right size and mtime).
+
+Demo:
+    report = verify(transfer.Manifest(dir_manifest).read_items(), runner=remote_index.run_paramiko(ssh_t.client), n_workers=8)
+    transfer.Transfer(dir_manifest, items=retransfer_items(report)).run()
+
+Usage:
+    python verify.py --dir_manifest ~/transfers/mouse_0403R --n_workers 8 --path_report report.json --path_retransfer retransfer.json
+    python transfer.py run --dir_manifest ~/transfers/mouse_0403R --path_items retransfer.json
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import mmap
+import os
+import re
+import shlex
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import remote_index
+import transfer
+
+
+PATH_DB_DEFAULT = str(Path.home() / '.hash_cache.sqlite')
+## One record per file: size, mtime, ctime and path. NUL terminated, so any file name is safe.
+FORMAT_FIND = r'%s\t%T@\t%C@\t%p\0'
+## Command that prints the same digest as hashlib for each algorithm
+COMMANDS_HASH = {
+    'md5': 'md5sum',
+    'sha1': 'sha1sum',
+    'sha256': 'sha256sum',
+}
+
+
+def hash_file(path, algorithm='md5', chunk_size=2**26):
+    """
+    Hashes a file, reading it in chunks of chunk_size bytes through mmap.
+
+    Returns:
+        (str):
+            Hex digest.
+    """
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return h.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            mm.madvise(mmap.MADV_SEQUENTIAL) if hasattr(mm, 'madvise') else None
+            with memoryview(mm) as view:
+                for i in range(0, size, chunk_size):
+                    h.update(view[i:i + chunk_size])
+    return h.hexdigest()
+
+
+def _hash_file_star(args):
+    path, algorithm, chunk_size = args
+    try:
+        return path, hash_file(path, algorithm=algorithm, chunk_size=chunk_size)
+    except OSError:
+        return path, None
+
+
+class HashCache:
+    """
+    Local database of file hashes keyed on (host, path, algorithm). An entry
+    is only used if the file still has the size, mtime and ctime it was
+    hashed with.
+    RH 2024
+
+    Args:
+        path_db (str):
+            Path to the SQLite database. Created if it does not exist.
+    """
+    def __init__(self, path_db=PATH_DB_DEFAULT):
+        self.conn = sqlite3.connect(str(path_db), timeout=30, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS hashes (
+                host TEXT, path TEXT, algorithm TEXT, size INTEGER, mtime REAL, ctime REAL, digest TEXT, time_hashed REAL,
+                PRIMARY KEY (host, path, algorithm)
+            )
+        """)
+        self.conn.commit()
+        self._lock = threading.Lock()  ## Source and destination are hashed from different threads
+
+    def get(self, host, algorithm, files):
+        """
+        Args:
+            files (dict):
+                {path: (size, mtime, ctime)}
+
+        Returns:
+            (dict):
+                {path: digest} of the files with a valid entry.
+        """
+        out = {}
+        with self._lock:
+            rows = {path: self.conn.execute("SELECT size, mtime, ctime, digest FROM hashes WHERE host = ? AND path = ? AND algorithm = ?", (host, path, algorithm)).fetchone() for path in files}
+        for path, stat in files.items():
+            row = rows[path]
+            if (row is not None) and (tuple(row[:3]) == tuple(stat)):
+                out[path] = row[3]
+        return out
+
+    def put(self, host, algorithm, files, digests):
+        """Stores {path: digest} for files {path: (size, mtime, ctime)}."""
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO hashes (host, path, algorithm, size, mtime, ctime, digest, time_hashed) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(host, p, algorithm, *files[p], d, time.time()) for p, d in digests.items() if d is not None],
+            )
+            self.conn.commit()
+
+
+def list_local(root):
+    """
+    Lists the files under root (or root itself if it is a file).
+
+    Returns:
+        (dict):
+            {relative path: (path, size, mtime, ctime)}
+    """
+    root = Path(root)
+    if root.is_file():
+        st = root.stat()
+        return {root.name: (str(root), st.st_size, st.st_mtime, st.st_ctime)}
+    out = {}
+    for dirpath, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(dirpath, name)
+            st = os.stat(path)
+            out[os.path.relpath(path, root)] = (path, st.st_size, st.st_mtime, st.st_ctime)
+    return out
+
+
+def list_remote(runner, root):
+    """
+    Lists the files under root (or root itself if it is a file) with one
+    find command.
+
+    Returns:
+        (dict):
+            {relative path: (path, size, mtime, ctime)}
+    """
+    ## A missing root is an empty listing (nothing transferred yet); any other failure raises
+    command = f"[ -e {shlex.quote(root)} ] || exit 0; find {shlex.quote(root)} -type f -printf {shlex.quote(FORMAT_FIND)}"
+    out = {}
+    buffer = b''
+    for chunk in runner(command):
+        buffer += chunk
+        *records, buffer = buffer.split(b'\0')
+        for record in records:
+            size, mtime, ctime, path = record.decode(errors='replace').split('\t', 3)
+            out[os.path.relpath(path, root) if path != root else Path(root).name] = (path, int(size), float(mtime), float(ctime))
+    return out
+
+
+def parse_hash_output(text):
+    """
+    Parses md5sum-style output: '<digest>  <name>' lines. Names with a
+    newline or backslash are escaped by md5sum and the line starts with '\\'.
+
+    Returns:
+        (dict):
+            {name: digest}
+    """
+    out = {}
+    for line in text.splitlines():
+        escaped = line.startswith('\\')
+        line = line[1:] if escaped else line
+        digest, _, name = line.partition('  ')
+        if not name:
+            continue
+        if escaped:
+            name = re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), name)
+        out[name] = digest
+    return out
+
+
+def hash_local(files, cache, algorithm='md5', n_workers=None, chunk_size=2**26):
+    """
+    Hashes local files with a process pool, largest first. Uses and fills
+    the cache.
+
+    Args:
+        files (dict):
+            {path: (size, mtime, ctime)}
+        n_workers (int):
+            Number of processes. None for the number of CPUs.
+
+    Returns:
+        (dict):
+            {path: digest}. None for files that could not be read.
+    """
+    digests = cache.get('', algorithm, files)
+    todo = sorted([p for p in files if p not in digests], key=lambda p: -files[p][0])
+    if len(todo) > 0:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as pool:
+            new = dict(pool.map(_hash_file_star, [(p, algorithm, chunk_size) for p in todo]))
+        cache.put('', algorithm, files, new)
+        digests.update(new)
+    return digests
+
+
+def hash_remote(files, runner, cache, host='', algorithm='md5', n_workers=4, n_parallel=4, max_names=1000):
+    """
+    Hashes files where runner runs commands, with one command per directory.
+    Uses and fills the cache.
+
+    Args:
+        files (dict):
+            {path: (size, mtime, ctime)}
+        n_workers (int):
+            Number of directories hashed at once.
+        n_parallel (int):
+            Number of files of a directory hashed at once (xargs -P).
+        max_names (int):
+            Most files hashed by one command.
+
+    Returns:
+        (dict):
+            {path: digest}. Files that could not be hashed are left out.
+    """
+    digests = cache.get(host, algorithm, files)
+    by_dir = {}
+    for p in files:
+        if p not in digests:
+            by_dir.setdefault(os.path.dirname(p), []).append(os.path.basename(p))
+    ## One command per directory, split if its file names would not fit on a command line
+    batches = [(d, names[i:i + max_names]) for d, names in by_dir.items() for i in range(0, len(names), max_names)]
+
+    def run(dir_names):
+        d, names = dir_names
+        command = (
+            f"cd {shlex.quote(d)} && printf '%s\\0' {' '.join(shlex.quote(n) for n in names)}"
+            f" | xargs -0 -P {n_parallel} -n 1 {COMMANDS_HASH[algorithm]} --; exit 0"
+        )  ## Unreadable files are left out of the output, not an error. A lost connection still raises.
+        text = b''.join(runner(command)).decode(errors='replace')
+        names = set(names)  ## Ignores anything md5sum printed that was not asked for
+        return {os.path.join(d, name): digest for name, digest in parse_hash_output(text).items() if name in names}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as pool:
+        for new in pool.map(run, batches):
+            cache.put(host, algorithm, files, new)
+            digests.update(new)
+    return digests
+
+
+def resolve_item(item):
+    """
+    Finds the directories (or files) that an rsync-style item made equal:
+    'src/' -> 'dst' compares src with dst, and 'src' -> 'dst' compares src
+    with dst/{name of src}.
+
+    Returns:
+        (tuple):
+            (source path, destination host or None, destination path)
+    """
+    host_source, _ = transfer.split_remote(item['source'])
+    assert host_source is None, f"The source must be local to verify: {item['source']}"
+    host, destination = transfer.split_remote(item['destination'])
+    source = str(item['source'])
+    if not source.endswith('/'):
+        destination = os.path.join(destination, Path(source).name)
+    return source.rstrip('/') or '/', host, destination
+
+
+def verify(
+    items,
+    runner=None,
+    algorithm='md5',
+    n_workers=None,
+    n_workers_remote=4,
+    n_parallel_remote=4,
+    path_db=PATH_DB_DEFAULT,
+    verbose=1,
+):
+    """
+    Verifies transfer items by comparing the hashes of every file on both
+    sides. The source side and the destination side are hashed at the same
+    time.
+    RH 2024
+
+    Args:
+        items (list of dict):
+            Items with 'source' (local) and 'destination' (local or
+            'host:path'). See transfer.py.
+        runner (callable):
+            Runs commands where the destination is. None for run_ssh(host)
+            of 'host:path' destinations, and run_local for local ones.
+        algorithm (str):
+            'md5', 'sha1' or 'sha256'.
+        n_workers (int):
+            Number of processes hashing source files. None for the number of
+            CPUs.
+        n_workers_remote (int):
+            Number of destination directories hashed at once.
+        n_parallel_remote (int):
+            Number of files of a destination directory hashed at once.
+        path_db (str):
+            Path to the hash cache. See HashCache.
+        verbose (int):
+            Verbosity level.
+
+    Returns:
+        (dict):
+            * items (list): Per item: source, destination, n_files, n_ok,
+              missing, extra, size_mismatch and hash_mismatch (lists of
+              relative paths), and unreadable (files that could not be
+              hashed).\n
+            * n_files, n_ok, n_bad (int): Totals.\n
+            * bytes (int): Bytes compared.\n
+            * time (float): Time the verification started (POSIX).\n
+            * seconds (float): Wall time.\n
+    """
+    assert algorithm in COMMANDS_HASH, f"algorithm must be one of {list(COMMANDS_HASH)}, not {algorithm}"
+    tic = time.time()
+    cache = HashCache(path_db)
+
+    ## List both sides of every item. Destination listings run concurrently.
+    resolved = [resolve_item(item) for item in items]
+    hosts = {host for _, host, _ in resolved}
+    runners = {host: (runner if runner is not None else (remote_index.run_ssh(host) if host is not None else remote_index.run_local)) for host in hosts}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers_remote) as pool:
+        listings_destination = list(pool.map(lambda r: list_remote(runners[r[1]], r[2]), resolved))
+    listings_source = [list_local(source) if os.path.exists(source) else {} for source, _, _ in resolved]
+
+    files_source = {path: stat for listing in listings_source for path, *stat in listing.values()}
+    files_destination = {}  ## {host: {path: (size, mtime, ctime)}}
+    for (_, host, _), listing in zip(resolved, listings_destination):
+        files_destination.setdefault(host, {}).update({path: stat for path, *stat in listing.values()})
+    print(f"Hashing {len(files_source)} source files and {sum(len(f) for f in files_destination.values())} destination files") if verbose > 0 else None
+
+    ## Hash both sides at the same time: the source with a process pool, the destination with remote commands.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1 + len(files_destination)) as pool:
+        future_source = pool.submit(hash_local, files_source, cache, algorithm, n_workers)
+        futures_destination = {
+            host: pool.submit(hash_remote, files, runners[host], cache, host or '', algorithm, n_workers_remote, n_parallel_remote)
+            for host, files in files_destination.items()
+        }
+        digests_source = future_source.result()
+        digests_destination = {host: f.result() for host, f in futures_destination.items()}
+
+    report = {'items': [], 'n_files': 0, 'n_ok': 0, 'n_bad': 0, 'bytes': 0, 'time': tic}
+    for item, (source, host, destination), ls, ld in zip(items, resolved, listings_source, listings_destination):
+        r = {
+            'source': item['source'], 'destination': item['destination'], 'source_root': source, 'destination_root': destination,
+            'is_file': os.path.isfile(source), 'n_files': len(ls), 'n_ok': 0, 'missing': [], 'extra': sorted(set(ld) - set(ls)), 'size_mismatch': [], 'hash_mismatch': [], 'unreadable': [],
+        }
+        for rel, (path, size, _, _) in sorted(ls.items()):
+            if rel not in ld:
+                r['missing'].append(rel)
+                continue
+            path_d, size_d, _, _ = ld[rel]
+            digest_s, digest_d = digests_source.get(path), digests_destination[host].get(path_d)
+            if size != size_d:
+                r['size_mismatch'].append(rel)
+            elif (digest_s is None) or (digest_d is None):
+                r['unreadable'].append(rel)
+            elif digest_s != digest_d:
+                r['hash_mismatch'].append(rel)
+            else:
+                r['n_ok'] += 1
+                report['bytes'] += size
+        n_bad = r['n_files'] - r['n_ok']
+        report['items'].append(r)
+        report['n_files'] += r['n_files']
+        report['n_ok'] += r['n_ok']
+        report['n_bad'] += n_bad
+        if (n_bad > 0) and verbose > 0:
+            print(f"{item['source']} -> {item['destination']}: {len(r['missing'])} missing, {len(r['size_mismatch'])} size mismatch, {len(r['hash_mismatch'])} hash mismatch, {len(r['unreadable'])} unreadable")
+    report['seconds'] = time.time() - tic
+    print(f"Verified {report['n_ok']} of {report['n_files']} files ({report['bytes'] / 1e9:.2f} GB) in {report['seconds']:.1f} s. {report['n_bad']} bad.") if verbose > 0 else None
+    return report
+
+
+def retransfer_items(report):
+    """
+    Makes transfer.py items that copy again the missing and mismatched files
+    of a report: one item per file, into its destination directory, with
+    rsync --checksum.\n
+    Each item has a 'retransfer' round (the time of the report), which is
+    part of its transfer.key_item. Otherwise a single-file item would have
+    the key of the original, complete item (and a file found bad again in a
+    later round the key of the earlier retransfer), and transfer.py would
+    skip it. Items from the same report keep their keys, so an interrupted
+    retransfer resumes.
+
+    Returns:
+        (list of dict):
+            Items.
+    """
+    retransfer = report.get('time', time.time())
+    items = []
+    for r in report['items']:
+        host, _ = transfer.split_remote(r['destination'])
+        for rel in r['missing'] + r['size_mismatch'] + r['hash_mismatch'] + r['unreadable']:
+            source = r['source_root'] if r['is_file'] else os.path.join(r['source_root'], rel)
+            destination = os.path.dirname(r['destination_root'] if r['is_file'] else os.path.join(r['destination_root'], rel))
+            items.append({
+                'source': source,
+                'destination': f'{host}:{destination}' if host is not None else destination,
+                'options': ['--checksum'],
+                'retransfer': retransfer,
+            })
+    return items
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parallel checksum verification of completed transfers.')
+    parser.add_argument('--dir_manifest', type=str, default=None, help='Verify the complete items of this transfer.py manifest.')
+    parser.add_argument('--path_items', type=str, default=None, help='Or verify these items: .json list of {source, destination}, or source<TAB>destination lines.')
+    parser.add_argument('--algorithm', type=str, default='md5', choices=list(COMMANDS_HASH))
+    parser.add_argument('--n_workers', type=int, default=None, help='Processes hashing source files. Default is the number of CPUs.')
+    parser.add_argument('--n_workers_remote', type=int, default=4, help='Destination directories hashed at once.')
+    parser.add_argument('--n_parallel_remote', type=int, default=4, help='Files of a destination directory hashed at once.')
+    parser.add_argument('--path_db', type=str, default=PATH_DB_DEFAULT, help='Path to the hash cache.')
+    parser.add_argument('--path_report', type=str, default=None, help='Write the report (JSON) here.')
+    parser.add_argument('--path_retransfer', type=str, default=None, help='Write items that need to be transferred again (JSON) here.')
+    args = parser.parse_args()
+
+    assert (args.dir_manifest is None) != (args.path_items is None), "Give one of --dir_manifest and --path_items"
+    if args.dir_manifest is not None:
+        manifest = transfer.Manifest(args.dir_manifest)
+        records = manifest.last_records()
+        items = [item for item in manifest.read_items() if records.get(item['key'], {}).get('state') == 'complete']
+    else:
+        items = transfer.read_items(args.path_items)
+
+    report = verify(
+        items,
+        algorithm=args.algorithm,
+        n_workers=args.n_workers,
+        n_workers_remote=args.n_workers_remote,
+        n_parallel_remote=args.n_parallel_remote,
+        path_db=args.path_db,
+    )
+    for path, obj in [(args.path_report, report), (args.path_retransfer, retransfer_items(report))]:
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(obj, f, indent=1)
+    raise SystemExit(1 if report['n_bad'] > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()